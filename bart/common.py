@@ -10,11 +10,19 @@
 
 
 import os
+import bz2
+import gzip
+import lzma
 import time
+import zlib
+import threading
 import datetime
 import logging
+from functools import lru_cache
+from concurrent import futures
 
 from bart import config
+from bart.usagerecord import usagerecord
 
 def getIncrementalDate(date, date_format):
     """
@@ -28,6 +36,46 @@ def getIncrementalDate(date, date_format):
     next_date = time.strftime(date_format, d2.timetuple())
     return next_date
 
+# compressed siblings of a log file, e.g. a rotated 20120612.gz, and how to
+# open them
+COMPRESSED_SUFFIXES = [ ('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open) ]
+
+def findLogFile(log_file):
+    """
+    Returns the path of a log file, or of a compressed sibling of it if only
+    that exists, and the function to open it with.
+    """
+    if not os.path.exists(log_file):
+        for suffix, opener in COMPRESSED_SUFFIXES:
+            if os.path.exists(log_file + suffix):
+                return log_file + suffix, opener
+    return log_file, open
+
+def getLogFileDates(log_dir, first_date, last_date, date_format):
+    """
+    Returns the dates of the day files in log_dir from first_date up to and
+    including last_date, in date order. The directory is listed once, and
+    compressed day files count as the day they are for. Other files are
+    ignored.
+    """
+    first = datetime.datetime.strptime(first_date, date_format)
+    last = datetime.datetime.strptime(last_date, date_format)
+
+    index = {}
+    for name in os.listdir(log_dir):
+        for suffix, _ in COMPRESSED_SUFFIXES:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+        try:
+            d = datetime.datetime.strptime(name, date_format)
+        except ValueError:
+            continue
+        if first <= d <= last:
+            index[d] = name
+
+    return [ index[d] for d in sorted(index) ]
+
 def readGeneratorState(lrms):        
     """
     Get the content of state file provided by lrmsObj
@@ -41,20 +89,136 @@ def readGeneratorState(lrms):
 
     lrms.parseGeneratorState(state_data)
 
-def writeGeneratorState(lrms):
+def getStateFilePath(lrms):
     """
-    Write the state of where the logs have been parsed to.
+    Return the path of the state file of lrmsObj.
     """
     state_dir = lrms.cfg.getConfigValue(config.SECTION_COMMON, config.STATEDIR, config.DEFAULT_STATEDIR)
-    state_file = os.path.join(state_dir, lrms.getStateFile())
+    return os.path.join(state_dir, lrms.getStateFile())
+
+def syncDirectory(dirpath):
+    """
+    Make renames and new files in a directory durable.
+    """
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def syncFiles(paths):
+    """
+    Make the content of the given files, and their directory entries, durable.
+    """
+    dirpaths = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        dirpaths.add(os.path.dirname(path) or '.')
 
+    for dirpath in dirpaths:
+        syncDirectory(dirpath)
+
+def writeStateFile(state_file, state):
+    """
+    Atomically replace the content of state_file with state.
+    """
     dirpath = os.path.dirname(state_file)
     if not os.path.exists(dirpath):
         os.makedirs(dirpath, mode=0o750)
 
-    f = open(state_file, 'w')
-    f.write(lrms.createGeneratorState())
+    # write to a temporary file and rename it, so the state file is never
+    # left truncated or half written
+    tmp_file = state_file + '.tmp'
+    f = open(tmp_file, 'w')
+    f.write(state)
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.rename(tmp_file, state_file)
+    syncDirectory(dirpath)
+
+def writeGeneratorState(lrms):
+    """
+    Write the state of where the logs have been parsed to.
+    """
+    writeStateFile(getStateFilePath(lrms), lrms.createGeneratorState())
+
+class CheckpointManager:
+    """
+    Group commit of the generator state of a backend. Instead of writing the
+    state after every usage record, it is written every 'records' records or
+    'seconds' seconds, whichever comes first (0 disables either), and when
+    commit() is called. Before the state is written, the usage records
+    written since the last commit are made durable, so the state never
+    points past a record that could be lost in a crash.
+
+    The state is written with writeStateFile, or by calling write_state if
+    given.
+
+    With the segment layout, 'records' defaults to SEGMENT_BATCH_SIZE, as a
+    checkpoint appends the batch of records added so far to the segment
+    whether it is full or not. Batches are then only cut short by 'seconds'.
+    """
+    def __init__(self, lrms, records=None, seconds=None, write_state=None):
+        self.lrms = lrms
+        if records is None:
+            records = lrms.cfg.getConfigValue(config.SECTION_COMMON, config.CHECKPOINT_RECORDS)
+        if records is None:
+            layout = lrms.cfg.getConfigValue(config.SECTION_COMMON, config.SPOOL_LAYOUT, config.DEFAULT_SPOOL_LAYOUT)
+            records = SEGMENT_BATCH_SIZE if layout == 'segment' else config.DEFAULT_CHECKPOINT_RECORDS
+        if seconds is None:
+            seconds = lrms.cfg.getConfigValue(config.SECTION_COMMON, config.CHECKPOINT_SECONDS, config.DEFAULT_CHECKPOINT_SECONDS)
+        self.records = int(records)
+        self.seconds = float(seconds)
+        self.write_state = write_state
+        # resolved once, not for every commit
+        self.state_file = None if write_state else getStateFilePath(lrms)
+
+        self.ur_files = []
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def written(self, ur_file=None):
+        """
+        Called after each written usage record, once the state of the
+        backend includes it. Commits if a checkpoint is due.
+        """
+        self.pending += 1
+        if ur_file is not None:
+            self.ur_files.append(ur_file)
+
+        if (self.records > 0 and self.pending >= self.records) or \
+           (self.seconds > 0 and time.time() - self.last_commit >= self.seconds):
+            self.commit()
+
+    def syncUsageRecords(self, seal=False):
+        """
+        Make the usage records written since the last commit durable, and
+        with seal also hand over the open segments, see syncSpool.
+        """
+        flushUsageRecords()
+        if self.ur_files:
+            syncFiles(self.ur_files)
+            self.ur_files = []
+        syncSpool(seal)
+
+    def commit(self):
+        """
+        Make the written usage records durable, then write the state.
+        """
+        self.syncUsageRecords()
+
+        if self.write_state is not None:
+            self.write_state()
+        else:
+            writeStateFile(self.state_file, self.lrms.createGeneratorState())
+
+        self.pending = 0
+        self.last_commit = time.time()
 
 def getSeconds(time_str):
     """
@@ -65,26 +229,47 @@ def getSeconds(time_str):
     if not time_str:
         return 0
 
-    # sometimes the timestamp includs a fractional second part
-    time_str = time_str.split('.')[0]
+    return parseDuration(time_str)
+
+@lru_cache(maxsize=65536)
+def parseDuration(time_str):
+    """
+    Convert a non-empty duration string to seconds, returns -1 if the string
+    does not match any of the formats accepted by getSeconds. The number of
+    hours is not limited to 23, as torque reports long durations as e.g.
+    '100:00:00'.
+    """
 
-    if '-' in time_str:
-        days, time_str = time_str.split('-')
-        st = time.strptime(time_str, '%H:%M:%S')
-        sec = int(days)*86400+st.tm_hour*3600+st.tm_min*60+st.tm_sec
+    # sometimes the timestamp includs a fractional second part
+    dot = time_str.find('.')
+    if dot != -1:
+        duration = time_str[:dot]
     else:
-        try:
-            st = time.strptime(time_str, '%H:%M:%S')
-            sec = st.tm_hour*3600+st.tm_min*60+st.tm_sec
-        except ValueError:
-            try:
-                st = time.strptime(time_str, '%M:%S')
-                sec = st.tm_min*60+st.tm_sec
-            except ValueError:
-                logging.error('String: %s does not match time format.' % time_str)
-                return -1
+        duration = time_str
+
+    days = 0
+    dash = duration.find('-')
+    if dash != -1:
+        days = duration[:dash]
+        duration = duration[dash+1:]
+        if not days.isdigit() or duration.count(':') != 2:
+            logging.error('String: %s does not match time format.' % time_str)
+            return -1
+        days = int(days)
 
-    return sec
+    fields = duration.split(':')
+    if not 2 <= len(fields) <= 3:
+        logging.error('String: %s does not match time format.' % time_str)
+        return -1
+
+    sec = 0
+    for field in fields:
+        if not field.isdigit():
+            logging.error('String: %s does not match time format.' % time_str)
+            return -1
+        sec = sec*60 + int(field)
+
+    return days*86400 + sec
 
 def datetimeFromIsoStr(dt_str):
     """
@@ -94,15 +279,462 @@ def datetimeFromIsoStr(dt_str):
     # why the parameter unfold?
     return datetime.datetime(*(time.strptime(dt_split[0], "%Y-%m-%dT%H:%M:%S")[0:6]))
 
+# Directories in the spool (logdir), bart-registrant can be configured to use
+# others for the state and archive
+RECORDS_DIRECTORY = 'urs'
+STATE_DIRECTORY   = 'state'
+ARCHIVE_DIRECTORY = 'archive'
+SEGMENTS_DIRECTORY = 'segments'
+
+# a segment is sealed when it reaches this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# or at the first checkpoint after it has been open this many seconds, so that
+# a following bart-logger hands over its records too
+SEGMENT_AGE = 3600
+
+# records kept in a batch before they are serialized to the segment together
+SEGMENT_BATCH_SIZE = 1000
+
+# records that may wait for each writer thread before writeUr blocks
+WRITER_QUEUE_PER_THREAD = 64
+
+# shard directories known to exist, so they are not looked for on every write
+spool_dirs = set()
+
+def getSpoolShard(record_id, layout, timestamp=None):
+    """
+    Returns the shard directory of a usage record in the spool layout, ''
+    for the flat layout. The date layout uses the UTC day of timestamp, now
+    if not given.
+    """
+    if layout == 'flat':
+        return ''
+    if layout == 'hashed':
+        # stable between runs and hosts, unlike hash()
+        return '%02x' % (zlib.crc32(record_id.encode('utf-8')) & 0xff)
+    if layout == 'date':
+        return time.strftime('%Y%m%d', time.gmtime(timestamp))
+    raise ValueError('Unknown spool layout %s, valid layouts are %s' % (layout, ', '.join(config.VALID_SPOOL_LAYOUTS)))
+
+def makeSpoolDir(spool_dir):
+    """
+    Create a spool directory if it does not exist, durably.
+    """
+    if spool_dir in spool_dirs:
+        return
+    if not os.path.exists(spool_dir):
+        os.makedirs(spool_dir)
+        syncDirectory(os.path.dirname(spool_dir))
+    spool_dirs.add(spool_dir)
+
+def listSpoolFiles(spool_dir):
+    """
+    Returns the paths, relative to spool_dir, of the files in a spool
+    directory of any layout: files directly in it, and files one shard
+    directory down. A missing spool directory, as the records directory
+    is with the segment layout, has no files.
+    """
+    paths = []
+    if not os.path.isdir(spool_dir):
+        return paths
+    for entry in os.scandir(spool_dir):
+        if entry.is_file():
+            paths.append(entry.name)
+        elif entry.is_dir():
+            for shard_entry in os.scandir(entry.path):
+                if shard_entry.is_file():
+                    paths.append(os.path.join(entry.name, shard_entry.name))
+    return paths
+
+def migrateSpool(log_dir, layout, state_directory=STATE_DIRECTORY, archive_directory=ARCHIVE_DIRECTORY):
+    """
+    Move the usage records of a spool, and their registration state, into the
+    given layout. The date layout uses the modification time of each record.
+    Returns the number of moved records.
+    """
+    def move(spool_dir, path, new_path):
+        makeSpoolDir(os.path.dirname(os.path.join(spool_dir, new_path)))
+        os.rename(os.path.join(spool_dir, path), os.path.join(spool_dir, new_path))
+
+    moved = 0
+    for directory, state_dir in [ (RECORDS_DIRECTORY, state_directory), (archive_directory, None) ]:
+        spool_dir = os.path.join(log_dir, directory)
+        if not os.path.isdir(spool_dir):
+            continue
+
+        for path in listSpoolFiles(spool_dir):
+            record_id = os.path.basename(path)
+            mtime = os.stat(os.path.join(spool_dir, path)).st_mtime
+            new_path = os.path.join(getSpoolShard(record_id, layout, mtime), record_id)
+            if new_path == path:
+                continue
+
+            # the state goes first, a record must never be seen without it
+            if state_dir is not None and os.path.exists(os.path.join(log_dir, state_dir, path)):
+                move(os.path.join(log_dir, state_dir), path, new_path)
+            move(spool_dir, path, new_path)
+            moved += 1
+
+    for directory in [ RECORDS_DIRECTORY, state_directory, archive_directory ]:
+        spool_dir = os.path.join(log_dir, directory)
+        if os.path.isdir(spool_dir):
+            syncDirectory(spool_dir)
+            for entry in os.scandir(spool_dir):
+                if entry.is_dir():
+                    syncDirectory(entry.path)
+
+    return moved
+
+class SegmentWriter:
+    """
+    Writer of the segment spool layout. Usage records are appended to a
+    segment file, <name>.seg.part, in the segments directory of the spool.
+    When sealed, the segment is synced, an index <name>.idx with a line
+    "offset length record_id" per record is written next to it, and it is
+    renamed to <name>.seg, after which bart-registrant may take it.
+
+    Records are added to a columnar batch first, and a full batch is
+    serialized and appended at once, so many records can be kept cheaply
+    while the segment is filled.
+
+    The segment stays open across checkpoints: syncSpool, which
+    CheckpointManager calls before writing the state, syncs it and appends
+    the index lines of the records written since the last checkpoint to
+    <name>.idx.part, the committed part of the segment. A segment is sealed
+    when it reaches max_size, at the first checkpoint after it is max_age
+    seconds old, and by syncSpool(seal=True) at the end of a run. When a
+    writer starts, the unsealed segments of processes that are gone are cut
+    back to their committed records and sealed, the records after them are
+    not covered by the state and are written again.
+    """
+    def __init__(self, segment_dir, max_size=SEGMENT_SIZE, batch_size=SEGMENT_BATCH_SIZE, max_age=SEGMENT_AGE):
+        self.segment_dir = segment_dir
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.batch = usagerecord.UsageRecordBatch()
+        self.pid = os.getpid()
+        self.sequence = 0
+        self.file_ = None
+        self.part_path = None
+        self.index = []
+        self.committed = 0
+        self.size = 0
+        self.opened = None
+        # records are appended by the writer threads
+        self.lock = threading.Lock()
+
+        makeSpoolDir(segment_dir)
+        self.removeStaleSegments()
+
+
+    def removeStaleSegments(self):
+        names = set(os.listdir(self.segment_dir))
+        for name in sorted(names):
+            if name.endswith('.seg.part'):
+                name = name[:-len('.seg.part')]
+            elif name.endswith('.idx.part') and name[:-len('.idx.part')] + '.seg.part' not in names:
+                name = name[:-len('.idx.part')]
+            else:
+                continue
+            try:
+                pid = int(name.split('-')[-2])
+                os.kill(pid, 0)
+                continue # still being written
+            except ProcessLookupError:
+                pass
+            except (ValueError, IndexError, PermissionError):
+                continue # not ours to remove
+            if name + '.seg.part' in names:
+                self.recoverSegment(name)
+            else:
+                # left when stopped while sealing
+                os.unlink(os.path.join(self.segment_dir, name + '.idx.part'))
+
+
+    def recoverSegment(self, name):
+        """
+        Seal the committed records of a segment left unsealed by a process
+        that is gone, and drop the rest.
+        """
+        part_path = os.path.join(self.segment_dir, name + '.seg.part')
+        committed_path = os.path.join(self.segment_dir, name + '.idx.part')
+        index = []
+        if os.path.exists(committed_path):
+            with open(committed_path) as f:
+                # a line cut short was not committed
+                index = [ line for line in f if line.endswith('\n') ]
+
+        if not index:
+            logging.warning('Removing unsealed segment %s, its records will be written again' % name)
+            os.unlink(part_path)
+            if os.path.exists(committed_path):
+                os.unlink(committed_path)
+            return
+
+        offset, length = index[-1].split()[:2]
+        with open(part_path, 'r+b') as f:
+            f.truncate(int(offset) + int(length))
+            os.fsync(f.fileno())
+        with open(committed_path, 'w') as f:
+            f.write(''.join(index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(committed_path, os.path.join(self.segment_dir, name + '.idx'))
+        os.rename(part_path, os.path.join(self.segment_dir, name + '.seg'))
+        syncDirectory(self.segment_dir)
+        logging.warning('Sealed the %d committed usage records of unsealed segment %s, the rest will be written again' % (len(index), name))
+
+
+    def add(self, ur):
+        """
+        Add a usage record to the batch. Returns the batch once it is full,
+        for appendBatch, else None.
+        """
+        with self.lock:
+            self.batch.append(ur)
+            if len(self.batch) < self.batch_size:
+                return None
+            batch, self.batch = self.batch, usagerecord.UsageRecordBatch()
+            return batch
+
+
+    def appendBatch(self, batch):
+        """
+        Serialize and append a batch of usage records. Returns the name of
+        the segment of the last record.
+        """
+        documents = zip(batch.recordIds(), batch.toXML())
+        with self.lock:
+            name = None
+            for record_id, data in documents:
+                name = self._append(record_id, data)
+            return name
+
+
+    def append(self, record_id, data):
+        """
+        Append the XML document of a usage record. Returns the name of the
+        segment.
+        """
+        with self.lock:
+            return self._append(record_id, data)
+
+
+    def _append(self, record_id, data):
+        if self.file_ is None:
+            self.sequence += 1
+            name = '%s-%d-%d' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime()), self.pid, self.sequence)
+            self.part_path = os.path.join(self.segment_dir, name + '.seg.part')
+            self.file_ = open(self.part_path, 'wb')
+            self.index = []
+            self.committed = 0
+            self.size = 0
+            self.opened = time.time()
+
+        self.file_.write(data)
+        self.index.append('%d %d %s\n' % (self.size, len(data), record_id))
+        self.size += len(data)
+
+        name = os.path.basename(self.part_path)[:-len('.seg.part')]
+        if self.size >= self.max_size:
+            self._seal()
+        return name
+
+
+    def checkpoint(self):
+        """
+        Make the records added so far durable in the current segment, which
+        is kept open unless it is old enough to be sealed.
+        """
+        with self.lock:
+            self._appendPending()
+            if self.file_ is None:
+                return
+            if time.time() - self.opened >= self.max_age:
+                self._seal()
+                return
+
+            self.file_.flush()
+            os.fsync(self.file_.fileno())
+            # the new records are committed once their index lines are durable
+            with open(self.part_path[:-len('.seg.part')] + '.idx.part', 'a') as f:
+                f.write(''.join(self.index[self.committed:]))
+                f.flush()
+                os.fsync(f.fileno())
+            if self.committed == 0:
+                syncDirectory(self.segment_dir)
+            self.committed = len(self.index)
+
+
+    def seal(self):
+        """
+        Make the current segment durable and hand it over to the registrant.
+        """
+        with self.lock:
+            self._appendPending()
+            self._seal()
+
+
+    def _appendPending(self):
+        if len(self.batch):
+            batch, self.batch = self.batch, usagerecord.UsageRecordBatch()
+            for record_id, data in zip(batch.recordIds(), batch.toXML()):
+                self._append(record_id, data)
+
+
+    def _seal(self):
+        if self.file_ is None:
+            return
+
+        self.file_.flush()
+        os.fsync(self.file_.fileno())
+        self.file_.close()
+        self.file_ = None
+
+        segment_path = self.part_path[:-len('.part')]
+        index_path = segment_path[:-len('.seg')] + '.idx'
+        with open(index_path, 'w') as f:
+            f.write(''.join(self.index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.part_path, segment_path)
+        if self.committed:
+            os.unlink(index_path + '.part')
+        syncDirectory(self.segment_dir)
+        logging.info('Sealed segment %s with %d usage records' % (segment_path, len(self.index)))
+
+# writers of the segment layout by directory, of this process only
+segment_writers = {}
+
+def getSegmentWriter(log_dir):
+    segment_dir = os.path.join(log_dir, SEGMENTS_DIRECTORY)
+    writer = segment_writers.get(segment_dir)
+    # a worker process inherits the writers of its parent, but not their files
+    if writer is None or writer.pid != os.getpid():
+        writer = segment_writers[segment_dir] = SegmentWriter(segment_dir)
+    return writer
+
+class UsageRecordWriter:
+    """
+    Serializes and writes usage records on a pool of threads, so that the
+    backend can parse the next entries meanwhile. At most queue_size records
+    wait to be written, beyond that writeUr blocks until one is done.
+
+    A failed write is raised by the next writeUr or flush. flush() is called
+    by syncSpool, before any state is written, so the state never covers a
+    record that has not been written.
+    """
+    def __init__(self, threads, queue_size):
+        self.pid = os.getpid()
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.error = None
+
+
+    def submit(self, fn, *args):
+        self.raiseError()
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+            if future.exception() is not None and self.error is None:
+                self.error = future.exception()
+        self.slots.release()
+
+
+    def raiseError(self):
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+
+    def flush(self):
+        """
+        Wait until all submitted records have been written.
+        """
+        with self.lock:
+            pending = list(self.pending)
+        futures.wait(pending)
+        self.raiseError()
+
+# the writer of this process, None when writing synchronously
+usage_record_writer = None
+
+def getUsageRecordWriter(cfg):
+    global usage_record_writer
+    # a worker process inherits the writer of its parent, but not its threads
+    if usage_record_writer is None or usage_record_writer.pid != os.getpid():
+        threads = int(cfg.getConfigValue(config.SECTION_COMMON, config.WRITER_THREADS, config.DEFAULT_WRITER_THREADS))
+        if threads <= 0:
+            return None
+        usage_record_writer = UsageRecordWriter(threads, threads * WRITER_QUEUE_PER_THREAD)
+    return usage_record_writer
+
+def flushUsageRecords():
+    """
+    Wait for the usage records being written in the background.
+    """
+    if usage_record_writer is not None and usage_record_writer.pid == os.getpid():
+        usage_record_writer.flush()
+
+def syncSpool(seal=False):
+    """
+    Wait for the usage records being written, and make the records of the
+    open segments of this process durable for the segment layout. With
+    seal, at the end of a run, the segments are also sealed.
+    """
+    flushUsageRecords()
+    for writer in segment_writers.values():
+        if writer.pid == os.getpid():
+            if seal:
+                writer.seal()
+            else:
+                writer.checkpoint()
+
+def writeRecordFile(ur, ur_file):
+    ur.writeXML(ur_file)
+    logging.info('Wrote usage record to %s' % ur_file)
+
+def writeSegmentBatch(segment_writer, batch):
+    segment = segment_writer.appendBatch(batch)
+    logging.info('Wrote %d usage records to segment %s' % (len(batch), segment))
+
 def writeUr(ur,cfg):
     """
-    Write ur to disk
+    Write ur to disk, in the shard directory of the spool layout, or to the
+    current segment. With writer_threads, the record is written in the
+    background and must not be changed afterwards. Returns the file the
+    record is written to, None for segments.
     """    
     log_dir = cfg.getConfigValue(config.SECTION_COMMON, config.LOGDIR, config.DEFAULT_LOG_DIR)    
-    ur_dir = os.path.join(log_dir, 'urs')
-    if not os.path.exists(ur_dir):
-        os.makedirs(ur_dir)
-    ur_file = os.path.join(ur_dir, ur.record_id)
-    ur.writeXML(ur_file)
-    
-    logging.info('Wrote usage record to %s' % ur_file)
+    layout = cfg.getConfigValue(config.SECTION_COMMON, config.SPOOL_LAYOUT, config.DEFAULT_SPOOL_LAYOUT)
+    if layout == 'segment':
+        ur_file = None
+        segment_writer = getSegmentWriter(log_dir)
+        batch = segment_writer.add(ur)
+        if batch is None:
+            return ur_file
+        job = (writeSegmentBatch, segment_writer, batch)
+    else:
+        ur_dir = os.path.normpath(os.path.join(log_dir, RECORDS_DIRECTORY, getSpoolShard(ur.record_id, layout)))
+        makeSpoolDir(ur_dir)
+        ur_file = os.path.join(ur_dir, ur.record_id)
+        job = (writeRecordFile, ur, ur_file)
+
+    writer = getUsageRecordWriter(cfg)
+    if writer is None:
+        job[0](*job[1:])
+    else:
+        writer.submit(*job)
+    return ur_file
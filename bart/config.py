@@ -25,6 +25,10 @@ DEFAULT_STATEDIR        = '/var/spool/bart'
 DEFAULT_SUPPRESS_USERMAP_INFO = 'false'
 DEFAULT_LOG_LEVEL       = 'INFO'
 DEFAULT_STDERR_LEVEL    = None
+DEFAULT_CHECKPOINT_RECORDS = 100
+DEFAULT_CHECKPOINT_SECONDS = 10
+DEFAULT_SPOOL_LAYOUT    = 'flat'
+DEFAULT_WRITER_THREADS  = 0
 
 # Common section
 SECTION_COMMON = 'common'
@@ -39,6 +43,16 @@ LOGLEVEL   = 'loglevel'
 STDERR_LEVEL = 'stderr_level'
 STATEDIR   = 'statedir'
 SUPPRESS_USERMAP_INFO = 'suppress_usermap_info'
+CHECKPOINT_RECORDS = 'checkpoint_records'
+CHECKPOINT_SECONDS = 'checkpoint_seconds'
+SPOOL_LAYOUT = 'spool_layout'
+WRITER_THREADS = 'writer_threads'
+
+# flat: <logdir>/urs/<record id>
+# hashed: <logdir>/urs/<2 hex digits from the record id>/<record id>
+# date: <logdir>/urs/<YYYYMMDD when written>/<record id>
+# segment: records appended to <logdir>/segments/<name>.seg, see common.SegmentWriter
+VALID_SPOOL_LAYOUTS = ('flat', 'hashed', 'date', 'segment')
 
 VALID_LOGLEVELS = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING, 'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL}
 
@@ -51,6 +65,8 @@ def getParser():
     parser.add_option('-d', '--debug', action="store_true", default=False, help='Set log level to DEBUG')
     parser.add_option('-c', '--config', dest='config', help='Configuration file.',
                       default=DEFAULT_CONFIG_FILE, metavar='FILE')
+    parser.add_option('-f', '--follow', action="store_true", default=False,
+                      help='Keep running and write usage records as jobs finish (Torque only).')
     return parser
 
 class BartConfig:
@@ -104,6 +120,15 @@ class BartConfig:
             raise ValueError("Unknown loglevel '%s' in config file %s\nValid log elevels are %s\n" %
                              (s, self.config_file, ', '.join(VALID_LOGLEVELS)))
         return VALID_LOGLEVELS[s] 
+
+
+    def getSpoolLayout(self):
+        s = self.getConfigValue(SECTION_COMMON, SPOOL_LAYOUT, DEFAULT_SPOOL_LAYOUT)
+
+        if s not in VALID_SPOOL_LAYOUTS:
+            raise ValueError("Unknown spool layout '%s' in config file %s\nValid spool layouts are %s\n" %
+                             (s, self.config_file, ', '.join(VALID_SPOOL_LAYOUTS)))
+        return s
         
        
     # Check for missing items and check syntax
@@ -171,3 +196,9 @@ class BartMapFile:
         except KeyError:
             return self.default
 
+    def __contains__(self, key):
+        return key in self.map_
+
+    def __getitem__(self, key):
+        return self.map_[key]
+
@@ -6,12 +6,9 @@
 # Author: Magnus Jonsson <magnus@hpc2n.umu.se>
 # Copyright: Nordic Data Grid Facility (2010)
 
-import time
-import datetime
 import logging
-import re
 
-from bart import common
+from bart import common, timestamp
 from bart.usagerecord import usagerecord
 
 SECTION = 'example'
@@ -63,15 +60,14 @@ class Example:
             job_id       = str(self.state)      
             account_name = 'default'
             user_name    = 'default'
-            submit_time  = time.mktime(common.datetimeFromIsoStr('2012-01-01T00:00:00').timetuple())
-            start_time   = time.mktime(common.datetimeFromIsoStr('2012-01-02T01:23:45').timetuple())
-            end_time     = time.mktime(common.datetimeFromIsoStr('2012-01-02T02:34:56').timetuple())
+            submit_time  = timestamp.fromIsoStr('2012-01-01T00:00:00')
+            start_time   = timestamp.fromIsoStr('2012-01-02T01:23:45')
+            end_time     = timestamp.fromIsoStr('2012-01-02T02:34:56')
 
             # clean data and create various composite entries from the work load trace
             fqdn_job_id = hostname + ':' + job_id
             if self.idtimestamp:
-                record_id_timestamp = re.sub("[-:TZ]","",usagerecord.epoch2isoTime(start_time)) # remove characters
-                record_id = fqdn_job_id + ':' + record_id_timestamp
+                record_id = fqdn_job_id + ':' + start_time.id_time
             else:
                 record_id = fqdn_job_id
 
@@ -82,7 +78,7 @@ class Example:
             mapped_project = project_map.get(account_name)
             if mapped_project is not None:
                 voi = usagerecord.VOInformation()
-                voi.type = 'lrmsurgen-projectmap'
+                voi.type_ = 'lrmsurgen-projectmap'
                 voi.name = mapped_project
                 vo_info = [voi]
 
@@ -98,9 +94,9 @@ class Example:
             ur.processors       = 1
             ur.node_count       = 1
             ur.host             = hostname
-            ur.submit_time      = usagerecord.epoch2isoTime(submit_time)
-            ur.start_time       = usagerecord.epoch2isoTime(start_time)
-            ur.end_time         = usagerecord.epoch2isoTime(end_time)
+            ur.submit_time      = submit_time.ur_time
+            ur.start_time       = start_time.ur_time
+            ur.end_time         = end_time.ur_time
             ur.cpu_duration     = 90
             ur.wall_duration    = 100
             ur.project_name     = account_name
@@ -0,0 +1,109 @@
+#
+# Waiting for changes in a directory
+#
+# Module for the SGAS Batch system Reporting Tool (BaRT).
+#
+# Used when following LRMS logs as they are written. On Linux the directory is
+# watched with inotify, through ctypes as there is no inotify module in the
+# standard library, so waiting costs no CPU. Elsewhere, or if inotify can not
+# be set up (e.g. on some network file systems), the directory is polled.
+
+import os
+import time
+import errno
+import select
+import logging
+import ctypes
+import ctypes.util
+
+# inotify event masks and flags, from <sys/inotify.h>
+IN_MODIFY      = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_NONBLOCK    = os.O_NONBLOCK
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+READ_SIZE = 65536
+
+DEFAULT_POLL_INTERVAL = 5
+
+
+class InotifyWatcher:
+    """
+    Wait for files in a directory to be created, written or moved there.
+    """
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'C library not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1 failed: %s' % os.strerror(error))
+
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'Watching %s failed: %s' % (directory, os.strerror(error)))
+
+
+    def wait(self, timeout):
+        """
+        Wait at most timeout seconds for a change. Returns False on timeout.
+        """
+        readable, _, _ = select.select([ self.fd ], [], [], timeout)
+        if not readable:
+            return False
+
+        # the events only tell that something changed, drain them all
+        try:
+            while os.read(self.fd, READ_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+class PollingWatcher:
+    """
+    Fallback watcher, which assumes a change every poll interval.
+    """
+    def __init__(self, directory, interval=DEFAULT_POLL_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return True
+
+
+    def close(self):
+        pass
+
+
+
+def getWatcher(directory, poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Return an inotify watcher for directory if possible, else a polling one.
+    """
+    try:
+        return InotifyWatcher(directory)
+    except OSError as e:
+        logging.warning('Can not watch %s with inotify (%s), polling every %s seconds' % (directory, e, poll_interval))
+        return PollingWatcher(directory, poll_interval)
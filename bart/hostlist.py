@@ -0,0 +1,141 @@
+#
+# Hostlist expansion and compression
+#
+# Module for the SGAS Batch system Reporting Tool (BaRT).
+#
+# Expands compressed host lists as used by Slurm, e.g.
+#
+#   "compute-1-[0-1,3],compute-11-12,rack[1-2]-node[01-02]"
+#
+# and compresses lists of hosts into that form.
+#
+# The same host lists are typically seen over and over again (every job on a
+# node, or every job in an array), so both directions are cached.
+
+import itertools
+from functools import lru_cache
+
+CACHE_SIZE = 4096
+
+
+def splitTopLevel(hostlist):
+    """
+    Split a host list on the commas that are not inside brackets.
+    """
+    items = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(hostlist):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(hostlist[start:i])
+            start = i + 1
+    items.append(hostlist[start:])
+    return [ item for item in items if item ]
+
+
+def expandRanges(ranges):
+    """
+    Expand the inside of a bracket, e.g. "1-3,07-09,12" into
+    ['1', '2', '3', '07', '08', '09', '12']. Zero padding is kept.
+    """
+    values = []
+    for sequence in ranges.split(','):
+        if '-' in sequence:
+            first, last = sequence.split('-', 1)
+            width = len(first)
+            for i in range(int(first), int(last) + 1):
+                values.append("{0:0>{width}}".format(i, width=width))
+        else:
+            values.append(sequence)
+    return values
+
+
+def expandItem(item):
+    """
+    Expand a single host list item, which may contain several bracket
+    groups, e.g. "rack[1-2]-node[01-02]".
+    """
+    if '[' not in item:
+        return [ item ]
+
+    # alternating literal text and bracket contents
+    parts = []
+    rest = item
+    while '[' in rest:
+        prefix, rest = rest.split('[', 1)
+        ranges, rest = rest.split(']', 1)
+        parts.append([ prefix ])
+        parts.append(expandRanges(ranges))
+    parts.append([ rest ])
+
+    return [ ''.join(p) for p in itertools.product(*parts) ]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def expand(hostlist):
+    """
+    Return a tuple of all the hosts in the compressed host list.
+    """
+    hosts = []
+    for item in splitTopLevel(hostlist):
+        hosts += expandItem(item)
+    return tuple(hosts)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def expandString(hostlist):
+    """
+    Return the expanded host list as a comma separated string.
+    """
+    return ','.join(expand(hostlist))
+
+
+def formatRanges(numbers, width):
+    """
+    Format sorted numbers as bracket contents, e.g. [1, 2, 3, 7] as "1-3,7".
+    """
+    ranges = []
+    first = last = numbers[0]
+    for n in numbers[1:] + [ None ]:
+        if n is not None and n == last + 1:
+            last = n
+            continue
+        if first == last:
+            ranges.append('%0*d' % (width, first))
+        else:
+            ranges.append('%0*d-%0*d' % (width, first, width, last))
+        first = last = n
+    return ','.join(ranges)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compress(hosts):
+    """
+    Return a compressed host list for a tuple of hosts, e.g.
+    ('node01', 'node02', 'node03', 'login1') as "node[01-03],login1".
+    Hosts are grouped on the text before their trailing number, zero padded
+    numbers are only grouped with numbers of the same width.
+    """
+    groups = {}
+    for host in hosts:
+        stripped = host.rstrip('0123456789')
+        digits = host[len(stripped):]
+        if not digits:
+            groups.setdefault((host, None), [])
+            continue
+        width = len(digits) if digits[0] == '0' and len(digits) > 1 else 0
+        groups.setdefault((stripped, width), set()).add(int(digits))
+
+    items = []
+    for (prefix, width), numbers in groups.items():
+        if width is None:
+            items.append(prefix)
+        elif len(numbers) == 1:
+            items.append('%s%0*d' % (prefix, width, min(numbers)))
+        else:
+            items.append('%s[%s]' % (prefix, formatRanges(sorted(numbers), width)))
+    return ','.join(items)
@@ -10,8 +10,11 @@
 import os
 import time
 import logging
+import operator
+import collections
+from concurrent import futures
 
-from bart import common
+from bart import common, timestamp
 from bart.usagerecord import usagerecord
 
 MAUI_DATE_FORMAT = '%a_%b_%d_%Y'
@@ -26,27 +29,77 @@ DEFAULT_STATEFILE = SECTION + '.state'
 SPOOL_DIR = 'spooldir'
 DEFAULT_SPOOL_DIR = '/var/spool/maui'
 
+# Number of worker processes reading complete past day files in parallel,
+# when catching up over several days.
+BACKFILL_WORKERS = 'backfill_workers'
+DEFAULT_BACKFILL_WORKERS = 1
+
 CONFIG = {
             STATEFILE:       { 'required': False },
             SPOOL_DIR:       { 'required': False },
+            BACKFILL_WORKERS: { 'required': False, type: 'int' },
           }
 
+# Columns of a stats line (workload trace version 230) that are used
+FIELD_COUNT  = 44
+JOB_ID       = 0
+USER_NAME    = 3
+JOB_STATE    = 6
+REQ_CLASS    = 7
+SUBMIT_TIME  = 8
+START_TIME   = 10
+END_TIME     = 11
+ALLOC_TASKS  = 21
+ACCOUNT_NAME = 25
+UTILIZED_CPU = 29
+TASK_CORES   = 31
+HOSTS        = 37
+
+COMPLETED = 'Completed'
+
+MauiEntry = collections.namedtuple('MauiEntry', ['job_id', 'user_name', 'job_state', 'req_class',
+                                                 'submit_time', 'start_time', 'end_time', 'alloc_tasks',
+                                                 'account_name', 'utilized_cpu', 'task_cores', 'hosts'])
+
+projectEntry = operator.itemgetter(JOB_ID, USER_NAME, JOB_STATE, REQ_CLASS,
+                                   SUBMIT_TIME, START_TIME, END_TIME, ALLOC_TASKS,
+                                   ACCOUNT_NAME, UTILIZED_CPU, TASK_CORES, HOSTS)
+
 class MauiLogParser:
     """
     Parser for maui stats log.
+
+    If only a compressed sibling of the log file exists (e.g.
+    Tue_Jun_12_2012.gz), it is read through a decompressing stream. Only
+    complete lines are returned, a partially written last line is left for
+    the next run. After each entry, entry_offset is the byte offset of its
+    line and offset where the next line starts, in the decompressed data.
     """
     def __init__(self, log_file):
         self.log_file = log_file
         self.file_ = None
+        self.inode = None
+        self.compressed = False
+        self.offset = 0
+        self.entry_offset = None
 
 
     def openFile(self):
-        self.file_ = open(self.log_file)
+        path, opener = common.findLogFile(self.log_file)
+        self.compressed = opener is not open
+        self.file_ = opener(path, 'rb')
+        self.inode = os.stat(path).st_ino
+
+
+    def seek(self, offset):
+        if self.file_ is None:
+            self.openFile()
+        self.file_.seek(offset)
+        self.offset = offset
 
 
     def splitLineEntry(self, line):
-        fields = [ e.strip() for e in line.split(' ') if e != '' ]
-        return fields
+        return line.split()
 
 
     def getNextLogLine(self):
@@ -55,14 +108,21 @@ class MauiLogParser:
 
         while True:
             line = self.file_.readline()
+            if not line.endswith(b'\n'):
+                # last line, or one that is still being written
+                self.file_.seek(self.offset)
+                return None
+
+            self.entry_offset = self.offset
+            self.offset += len(line)
+            line = line.decode('utf-8', 'replace')
+
             if line.startswith('VERSION'):
                 continue # maui log files starts with a version, typically 230
             if line.startswith('#'):
                 continue # maui somtimes creates explanatory lines in the log file
-            if line == '\n':
+            if line.strip() == '':
                 continue # Ignore empty lines
-            if line == '': # last line
-                return None
 
             return line
 
@@ -74,16 +134,80 @@ class MauiLogParser:
         return self.splitLineEntry(line)
 
 
+    def getNextJobId(self):
+        """
+        Return the job id of the next entry, without splitting the rest of
+        the line.
+        """
+        line = self.getNextLogLine()
+        if line is None:
+            return None
+        return line.split(None, 1)[0]
+
+
     def spoolToEntry(self, entry_id):
+        """
+        Read up to and including the first entry of job entry_id, returns
+        False if there is no such entry.
+        """
         while True:
-            log_entry = self.getNextLogEntry()
-            if log_entry is None or log_entry[0] == entry_id:
-                break
+            job_id = self.getNextJobId()
+            if job_id is None:
+                return False
+            if job_id == entry_id:
+                return True
+
+
+    def resumeAfterEntry(self, entry_id, inode, offset):
+        """
+        Continue after the entry of job entry_id, which starts at offset in
+        the file with the given inode. The job id is only used to check that
+        the file is still the same, if not, the file is searched for the job
+        id. Returns False if the entry could not be found, reading then
+        starts from the beginning of the file.
+        """
+        if self.file_ is None:
+            self.openFile()
+
+        # a compressed log has a new inode, but the same offsets
+        if (inode == self.inode or self.compressed) and offset is not None:
+            self.seek(offset)
+            if self.getNextJobId() == entry_id and self.entry_offset == offset:
+                return True
+            logging.warning('Entry at offset %d in %s is not job %s, searching for it' % (offset, self.log_file, entry_id))
+
+        self.seek(0)
+        if self.spoolToEntry(entry_id):
+            return True
+
+        self.seek(0)
+        return False
+
+def backfillLogFile(cfg, maui_date, maui_date_today, hostname, user_map, vo_map, maui_server_host):
+    """
+    Write the usage records of a complete day file, run in a worker process.
+    The records are synced to disk, but the state is left to the parent.
+    Returns the state after the file, (job id, inode, offset) or None if no
+    record was written, and the missing user mappings.
+    """
+    maui = Maui(cfg)
+    maui.missing_user_mappings = {}
+    checkpoint = common.CheckpointManager(maui, records=0, seconds=0)
+
+    if maui.processLogFile(maui_date, maui_date_today, None, hostname, user_map, vo_map, maui_server_host, checkpoint) == 0:
+        return None, maui.missing_user_mappings
+
+    # the worker may not be used again, hand over its segment
+    checkpoint.syncUsageRecords(seal=True)
+    return (maui.state_job_id, maui.state_inode, maui.state_offset), maui.missing_user_mappings
+
 
 class Maui():
 
     state_job_id = None
     state_log_file = None    
+    state_inode = None
+    state_offset = None
     missing_user_mappings = {}
         
     def __init__(self,cfg):
@@ -102,7 +226,7 @@ class Maui():
         maui_cfg_path = os.path.join(maui_spool_dir, MAUI_CFG_FILE)
     
         if os.path.exists(maui_cfg_path):
-            for line in file(maui_cfg_path):
+            for line in open(maui_cfg_path):
                 line = line.strip()
                 if line.startswith(SERVERHOST):
                     entry = line.replace(SERVERHOST,'').strip()
@@ -115,22 +239,22 @@ class Maui():
     
     def createUsageRecord(self, log_entry, hostname, user_map, vo_map, maui_server_host):
         """
-        Creates a Usage Record object given a Maui log entry.
+        Creates a Usage Record object given a MauiEntry.
         """
     
         # extract data from the workload trace (log_entry)
     
-        job_id       = log_entry[0]
-        user_name    = log_entry[3]
-        req_class    = log_entry[7]
-        submit_time  = int(log_entry[8])
-        start_time   = int(log_entry[10])
-        end_time     = int(log_entry[11])
-        alo_tasks    = int(log_entry[21])
-        account_name = log_entry[25]
-        utilized_cpu = float(log_entry[29])
-        core_count   = int(log_entry[31])*alo_tasks
-        hosts        = log_entry[37].split(':')
+        job_id       = log_entry.job_id
+        user_name    = log_entry.user_name
+        req_class    = log_entry.req_class
+        submit_time  = timestamp.fromEpoch(log_entry.submit_time)
+        start_time   = timestamp.fromEpoch(log_entry.start_time)
+        end_time     = timestamp.fromEpoch(log_entry.end_time)
+        alo_tasks    = int(log_entry.alloc_tasks)
+        account_name = log_entry.account_name
+        utilized_cpu = float(log_entry.utilized_cpu)
+        core_count   = int(log_entry.task_cores)*alo_tasks
+        hosts        = log_entry.hosts.split(':')
     
         # clean data and create various composite entries from the work load trace
     
@@ -161,7 +285,7 @@ class Maui():
             voi = usagerecord.VOInformation(name=mapped_vo, type_='bart-vomap')
             vo_info = [voi]
     
-        wall_time = end_time - start_time
+        wall_time = end_time.epoch - start_time.epoch
     
         # okay, this is somewhat ridiculous and complicated:
         # When compiled on linux, maui will think that it will only get cputime reading
@@ -195,9 +319,9 @@ class Maui():
         ur.node_count = len(hosts)
         ur.host = ','.join(hosts)
     
-        ur.submit_time = usagerecord.epoch2isoTime(submit_time)
-        ur.start_time  = usagerecord.epoch2isoTime(start_time)
-        ur.end_time    = usagerecord.epoch2isoTime(end_time)
+        ur.submit_time = submit_time.ur_time
+        ur.start_time  = start_time.ur_time
+        ur.end_time    = end_time.ur_time
     
         ur.cpu_duration = utilized_cpu
         ur.wall_duration = wall_time
@@ -212,13 +336,13 @@ class Maui():
     def shouldGenerateUR(self, log_entry, user_map):
         """
         Decides wheater a log entry is 'suitable' for generating
-        a ur from.
+        a ur from. Only the fields up to the job state are needed.
         """
-        job_id    = log_entry[0]
-        user_name = log_entry[3]
-        job_state = log_entry[6]
+        job_id    = log_entry[JOB_ID]
+        user_name = log_entry[USER_NAME]
+        job_state = log_entry[JOB_STATE]
     
-        if not job_state == 'Completed':
+        if not job_state == COMPLETED:
             logging.info('Job %s: Skipping UR generation (state %s)' % (job_id, job_state))
             return False
         if user_name in user_map and user_map[user_name] is None:
@@ -229,89 +353,154 @@ class Maui():
     
     
     
-    def generateUsageRecords(self, hostname, user_map, vo_map):
+    def processLogFile(self, maui_date, maui_date_today, job_id, hostname, user_map, vo_map, maui_server_host, checkpoint):
         """
-        Starts the UR generation process.
+        Write the usage records of the stats file of a day, continuing after
+        the entry of job_id if given. Returns the number of written records.
         """
-    
         maui_spool_dir = self.cfg.getConfigValue(SECTION, SPOOL_DIR, DEFAULT_SPOOL_DIR)
-        maui_server_host = self.getMauiServer(maui_spool_dir)
-        maui_date_today = time.strftime(MAUI_DATE_FORMAT, time.gmtime())
+        log_file = os.path.join(maui_spool_dir, STATS_DIR, maui_date)
+        mlp = MauiLogParser(log_file)
+        try:
+            mlp.openFile()
+        except IOError:
+            if maui_date != maui_date_today: # todays entry might not exist yet
+                logging.error('Error opening log file at %s for date %s' % (log_file, maui_date))
+            return 0
 
-        # set initial job_id        
-        job_id    = self.state_job_id
-        maui_date = self.state_log_file
-    
-        self.missing_user_mappings = {}
-    
-        while True:
-    
-            log_file = os.path.join(maui_spool_dir, STATS_DIR, maui_date)
-            mlp = MauiLogParser(log_file)
+        count = 0
+        try:
             if job_id is not None:
-                mlp.spoolToEntry(job_id)
-    
+                if not mlp.resumeAfterEntry(job_id, self.state_inode, self.state_offset):
+                    logging.warning('Job %s not found in log file %s, reading all of it' % (job_id, log_file))
+
             while True:
-    
-                try:
-                    log_entry = mlp.getNextLogEntry()
-                except IOError:
-                    if maui_date == maui_date_today: # todays entry might not exist yet
-                        break
-                    logging.error('Error opening log file at %s for date %s' % (log_file, maui_date))
-                    break
-    
-                if log_entry is None:
+                line = mlp.getNextLogLine()
+                if line is None:
                     break # no more log entries
-    
-                if len(log_entry) != 44:
+
+                # only the fields up to the hosts are used, the rest of the
+                # line is left in one piece and only counted
+                fields = line.split(None, HOSTS + 1)
+                field_count = len(fields)
+                if field_count > HOSTS + 1:
+                    field_count += len(fields[-1].split()) - 1
+                if field_count != FIELD_COUNT:
                     logging.error('Read entry with an invalid number fields:')
-                    logging.error(' - File %s contains entry with %i fields. First field: %s' % (log_file, len(log_entry), log_entry[0]))
+                    logging.error(' - File %s contains entry with %i fields. First field: %s' % (log_file, field_count, fields[0]))
                     logging.error(' - No usage record will be generated from this line')
                     continue
-    
-                job_id = log_entry[0]
-                if not self.shouldGenerateUR(log_entry, user_map):
-                    logging.debug('Job %s: No UR will be generated.' % job_id)
+
+                if not self.shouldGenerateUR(fields, user_map):
+                    logging.debug('Job %s: No UR will be generated.' % fields[JOB_ID])
                     continue
-    
+
+                log_entry = MauiEntry._make(projectEntry(fields))
+                job_id = log_entry.job_id
+
                 ur = self.createUsageRecord(log_entry, hostname, user_map, vo_map, maui_server_host)
-                common.writeUr(ur,self.cfg)
-                
+                ur_file = common.writeUr(ur,self.cfg)
+                count += 1
+
                 # write generated state
-                self.state_job_id = ur.job_id
+                self.state_job_id = job_id
                 self.state_log_file = maui_date
-                common.writeGeneratorState(self)
-    
-                job_id = None
-    
-            if maui_date == maui_date_today:
-                break
-    
-            maui_date = common.getIncrementalDate(maui_date, MAUI_DATE_FORMAT)
-            job_id = None
-    
+                self.state_inode = mlp.inode
+                self.state_offset = mlp.entry_offset
+                checkpoint.written(ur_file)
+        finally:
+            mlp.file_.close()
+
+        return count
+
+
+    def generateUsageRecords(self, hostname, user_map, vo_map):
+        """
+        Starts the UR generation process.
+
+        The day files from the day of the state on are found by listing the
+        log directory once. The day of the state, which may be partly done,
+        and the last file, which may still be growing, are read here. With
+        backfill_workers larger than 1, the complete days in between are read
+        in parallel by worker processes, and committed in date order.
+        """
+        maui_spool_dir = self.cfg.getConfigValue(SECTION, SPOOL_DIR, DEFAULT_SPOOL_DIR)
+        maui_server_host = self.getMauiServer(maui_spool_dir)
+        maui_date_today = time.strftime(MAUI_DATE_FORMAT, time.gmtime())
+        workers = int(self.cfg.getConfigValue(SECTION, BACKFILL_WORKERS, DEFAULT_BACKFILL_WORKERS))
+
+        self.missing_user_mappings = {}
+        checkpoint = common.CheckpointManager(self)
+
+        log_dir = os.path.join(maui_spool_dir, STATS_DIR)
+        try:
+            dates = common.getLogFileDates(log_dir, self.state_log_file, maui_date_today, MAUI_DATE_FORMAT)
+        except OSError as e:
+            logging.error('Error listing log files in %s (%s)' % (log_dir, str(e)))
+            return
+
+        if dates and dates[0] == self.state_log_file:
+            self.processLogFile(dates.pop(0), maui_date_today, self.state_job_id, hostname, user_map, vo_map, maui_server_host, checkpoint)
+
+        backfill_dates = dates[:-1]
+        if workers > 1 and len(backfill_dates) > 1:
+            logging.info('Reading %d day files with %d workers' % (len(backfill_dates), workers))
+            checkpoint.commit()
+            executor = futures.ProcessPoolExecutor(max_workers=workers)
+            try:
+                jobs = [ executor.submit(backfillLogFile, self.cfg, maui_date, maui_date_today, hostname, user_map, vo_map, maui_server_host)
+                         for maui_date in backfill_dates ]
+                # commit in date order, so the state never goes backwards
+                for maui_date, job in zip(backfill_dates, jobs):
+                    state, missing_user_mappings = job.result()
+                    self.missing_user_mappings.update(missing_user_mappings)
+                    if state is not None:
+                        self.state_job_id, self.state_inode, self.state_offset = state
+                        self.state_log_file = maui_date
+                        checkpoint.commit()
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            for maui_date in backfill_dates:
+                self.processLogFile(maui_date, maui_date_today, None, hostname, user_map, vo_map, maui_server_host, checkpoint)
+
+        if dates:
+            self.processLogFile(dates[-1], maui_date_today, None, hostname, user_map, vo_map, maui_server_host, checkpoint)
+
+        checkpoint.commit()
+
     def parseGeneratorState(self,state):        
         """
-        Get state of where to the UR generation has reached in the log.
+        Get state of where to the UR generation has reached in the log: the
+        job id of the last written entry and the log file, optionally followed
+        by the inode of the log file and the byte offset of the entry.
         """
         job_id = None
         log_file = None
+        inode = None
+        offset = None
         if state is None or len(state) == 0:            
             # Empty state data happens sometimes, usually NFS is involved :-|
             # Start from yesterday (24 hours back), this should be fine assuming (at least) daily invokation.
             t_old = time.time() - (24 * 3600)
             log_file = time.strftime(MAUI_DATE_FORMAT, time.gmtime(t_old))
         else:
-            job_id, log_file = state.split(' ', 2)
+            fields = state.split()
+            job_id, log_file = fields[0:2]
             if job_id == '-':
                 job_id = None
+            if len(fields) == 4:
+                inode, offset = int(fields[2]), int(fields[3])
 
         self.state_job_id = job_id
         self.state_log_file = log_file
+        self.state_inode = inode
+        self.state_offset = offset
 
     def createGeneratorState(self):
         """
         Create the current state of where to the UR generation has reached.
         """
+        if self.state_job_id is not None and self.state_inode is not None:
+            return '%s %s %d %d' % (self.state_job_id, self.state_log_file, self.state_inode, self.state_offset)
         return '%s %s' % (self.state_job_id or '-', self.state_log_file)
\ No newline at end of file
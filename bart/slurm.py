@@ -14,8 +14,15 @@ import logging
 import subprocess
 import sys
 import re
+import itertools
+import tempfile
+import collections
+import json
+import queue
+import multiprocessing
+from concurrent import futures
 
-from bart import config, common
+from bart import config, common, hostlist, timestamp, tres
 from bart.usagerecord import usagerecord
 
 SECTION = 'slurm'
@@ -32,6 +39,12 @@ DEFAULT_IDTIMESTAMP = 'true'
 MAX_DAYS = 'max_days'
 MAX_DAYS_DEFAULT = 7
 
+# The state is committed after every window, and within a window every
+# checkpoint_records records or checkpoint_seconds seconds (from the [common]
+# section). If not set here, checkpoint_records of [common] is used.
+CHECKPOINT_RECORDS = 'checkpoint_records'
+DEFAULT_CHECKPOINT_RECORDS = None
+
 # This fills in the "processors" field.
 PROCESSORS_UNIT         = 'processors_unit'
 DEFAULT_PROCESSORS_UNIT = 'cpu'  # GPU-clusters should likely use "gres/gpu"
@@ -46,23 +59,97 @@ DEFAULT_CHARGE_UNIT  = None
 CHARGE_SCALE         = 'charge_scale'
 DEFAULT_CHARGE_SCALE = 1.
 
+# Where to read the job records from: "sacct" queries slurmdbd, "jobcomp" reads
+# the job completion log of slurmctld (JobCompType=jobcomp/filetxt).
+SOURCE = 'source'
+SOURCE_SACCT = 'sacct'
+SOURCE_JOBCOMP = 'jobcomp'
+DEFAULT_SOURCE = SOURCE_SACCT
+
+JOBCOMP_LOG = 'jobcomp_log'
+DEFAULT_JOBCOMP_LOG = '/var/log/slurm/jobcomp.log'
+DEFAULT_JOBCOMP_STATEFILE = SECTION + '-jobcomp.state'
+
 # If this is set to a comma separated list of users, we will fetch jobs of only
 # those users. If unset/None, all users' jobs are fetched.
 USERS = 'users'
 USERS_DEFAULT = None
 
+# Comma separated list of clusters sharing the slurmdbd, each optionally
+# followed by ':' and the machine name to report for it, e.g.
+# "alvis:alvis.example.org,vera". The machine name defaults to the cluster
+# name. The clusters are processed concurrently, one process per cluster, and
+# each has its own position in the state file.
+CLUSTERS = 'clusters'
+DEFAULT_CLUSTERS = None
+
+# Number of sacct processes to run concurrently. If larger than 1, the period
+# from the state up to now is split into windows of window_hours hours which
+# are fetched in parallel, and written in time order.
+SACCT_WORKERS = 'sacct_workers'
+DEFAULT_SACCT_WORKERS = 1
+
+WINDOW_HOURS = 'window_hours'
+DEFAULT_WINDOW_HOURS = 24
+
+# How long (in seconds) the detected capabilities of the Slurm installation are
+# cached in the state directory before they are probed again.
+CAPABILITIES_TTL = 'capabilities_ttl'
+DEFAULT_CAPABILITIES_TTL = 86400
+CAPABILITIES_FILE = SECTION + '.capabilities'
+
+# How job steps (.batch, .extern, .0, ...) are handled. With "skip" only the
+# job allocations are fetched from sacct. With "aggregate" the steps are
+# fetched as well, and their usage is folded into the job record.
+STEPS = 'steps'
+STEPS_SKIP = 'skip'
+STEPS_AGGREGATE = 'aggregate'
+DEFAULT_STEPS = STEPS_SKIP
+
+# Report every allocated TRES (cpu, mem, node, billing, energy, gres/*, ...) as
+# an AllocResource in the usage records. If disabled only the number of GPUs
+# is reported, as before, and AllocTRES is only fetched from sacct if needed.
+ALLOC_RESOURCES = 'alloc_resources'
+DEFAULT_ALLOC_RESOURCES = 'false'
+
+# Report the host list in the compressed Slurm form, e.g. "node[1-4]", rather
+# than as a comma separated list of all hosts.
+COMPRESS_HOSTS = 'compress_hosts'
+DEFAULT_COMPRESS_HOSTS = 'false'
+
 CONFIG = {
             STATEFILE:         { 'required': False },
             STATEFILE_DEFAULT: { 'required': False, type: 'int' },
             IDTIMESTAMP:       { 'required': False, type: 'bool' },
             MAX_DAYS:          { 'required': False, type: 'int' },
+            CHECKPOINT_RECORDS: { 'required': False, type: 'int' },
             PROCESSORS_UNIT:   { 'required': False },
             CHARGE_UNIT:       { 'required': False },
             CHARGE_SCALE:      { 'required': False, type: 'float' },
             USERS:             { 'required': False },
+            CLUSTERS:          { 'required': False },
+            SOURCE:            { 'required': False },
+            JOBCOMP_LOG:       { 'required': False },
+            SACCT_WORKERS:     { 'required': False, type: 'int' },
+            WINDOW_HOURS:      { 'required': False, type: 'int' },
+            STEPS:             { 'required': False },
+            CAPABILITIES_TTL:  { 'required': False, type: 'int' },
+            ALLOC_RESOURCES:   { 'required': False, type: 'bool' },
+            COMPRESS_HOSTS:    { 'required': False, type: 'bool' },
           }
 
-COMMAND = 'sacct %(users)s --duplicates --parsable2 --format=JobIDRaw,User,Partition,Submit,Start,End,Account,Elapsed,UserCPU,AllocTRES,Nodelist,NNodes --state=%(states)s --starttime="%(starttime)s" --endtime="%(endtime)s"'
+# base fields, their positions are fixed. AllocTRES may be replaced by AllocCPUS
+# by the query planner, see planQuery()
+FIELDS = [ 'JobIDRaw', 'User', 'Partition', 'Submit', 'Start', 'End', 'Account',
+           'Elapsed', 'UserCPU', 'AllocTRES', 'Nodelist', 'NNodes' ]
+
+# extra fields fetched when aggregating steps, appended after FIELDS
+STEP_FIELDS = [ 'SystemCPU', 'MaxRSS' ]
+ALLOC_TRES_INDEX = 9
+SYSTEM_CPU_INDEX = len(FIELDS)
+MAX_RSS_INDEX    = len(FIELDS) + 1
+
+COMMAND = 'sacct %(users)s %(options)s --format=%(format)s --state=%(states)s --starttime="%(starttime)s" --endtime="%(endtime)s"'
 
 def exec_cmd(cmd):
     """
@@ -81,6 +168,49 @@ def exec_cmd(cmd):
         return data.decode(encoding='utf-8').strip().split('\n')
 
 
+def streamCommand(cmd):
+    """
+    Execute the shell command 'cmd', and yield the output one line at a time,
+    as the command produces it. If the command fails, IOError is raised once
+    its output has been read, so a truncated output is never taken as
+    complete.
+    """
+
+    logging.debug("Executing command '%s'" % cmd)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+    exhausted = False
+    try:
+        for line in process.stdout:
+            yield line.decode(encoding='utf-8').strip()
+        exhausted = True
+    finally:
+        # closing the pipe makes the command exit if we stopped reading early
+        process.stdout.close()
+        returncode = process.wait()
+        if exhausted and returncode != 0:
+            raise IOError("Command '%s' exited with status %d" % (cmd, returncode))
+
+
+def spoolCommand(cmd):
+    """
+    Execute the shell command 'cmd' with the output going to an anonymous
+    temporary file, which is returned rewound to the start. Raises IOError if
+    the command fails.
+    """
+
+    logging.debug("Executing command '%s'" % cmd)
+
+    spool = tempfile.TemporaryFile()
+    returncode = subprocess.call(cmd, stdout=spool, shell=True)
+    if returncode != 0:
+        spool.close()
+        raise IOError("Command '%s' exited with status %d" % (cmd, returncode))
+
+    spool.seek(0)
+    return spool
+
+
 def versioncmp(a, b):
     """
     return -1 if a < b, 0 if a = b, and +1 if a > b, where a and b are
@@ -97,21 +227,201 @@ def versioncmp(a, b):
             return 1
 
     ## If we get here, all common components are equal. Decide by the number of components:
-    return cmp(a_length, b_length)
+    return (len(aa) > len(bb)) - (len(aa) < len(bb))
+
+
+def sacctCommand(starttime, endtime, user_list, plan):
+    """
+    Build the sacct command line for the period between starttime and endtime,
+    as planned by planQuery().
+    """
+    args = {
+        "starttime": starttime,
+        "endtime": endtime,
+        "users": '--user=%s' % user_list if user_list else '--allusers',
+        "options": plan['options'],
+        "format": ','.join(plan['fields']),
+        "states": plan['states'],
+    }
+    return COMMAND % args
+
+
+def probeCapabilities():
+    """
+    Find out what the installed Slurm supports: the version, the job states
+    to fetch, whether sacct has --json and --noconvert, and the names of the
+    TRES in use.
+    """
+    version = exec_cmd("sacct --version")[0].split(' ')[1]
+    sacct_help = ' '.join(exec_cmd("sacct --help"))
+
+    tres_names = []
+    for line in exec_cmd("sacctmgr --noheader --parsable2 show tres format=type,name"):
+        if '|' in line:
+            type_, name = line.split('|', 1)
+            tres_names.append(type_ + '/' + name if name else type_)
+
+    states = [ 'ca', 'cd', 'f', 'nf', 'pr', 'rq', 'to' ]
+    if versioncmp(version, "17.11.0") >= 0:
+        states.append('oom')
+
+    return {
+        'version':   version,
+        'states':    states,
+        'json':      '--json' in sacct_help,
+        'noconvert': '--noconvert' in sacct_help,
+        'tres':      tres_names,
+    }
+
+
+def getCapabilities(cfg):
+    """
+    Return the capabilities of the Slurm installation, from the cache in the
+    state directory if it is younger than capabilities_ttl seconds.
+    """
+    state_dir = cfg.getConfigValue(config.SECTION_COMMON, config.STATEDIR, config.DEFAULT_STATEDIR)
+    cache_file = os.path.join(state_dir, CAPABILITIES_FILE)
+    ttl = int(cfg.getConfigValue(SECTION, CAPABILITIES_TTL, DEFAULT_CAPABILITIES_TTL))
+
+    try:
+        if time.time() - os.stat(cache_file).st_mtime < ttl:
+            f = open(cache_file)
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+    except (IOError, OSError, ValueError) as e:
+        logging.debug('No usable Slurm capabilities cache at %s (%s)' % (cache_file, str(e)))
+
+    capabilities = probeCapabilities()
+    logging.info('Detected Slurm %s capabilities: %s' % (capabilities['version'], capabilities))
+
+    try:
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir, mode=0o750)
+        # several processes may probe at once, each writes its own file
+        fd, tmp_file = tempfile.mkstemp(prefix=CAPABILITIES_FILE + '.', dir=state_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(capabilities, f)
+            os.replace(tmp_file, cache_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+    except (IOError, OSError) as e:
+        logging.warning('Could not cache Slurm capabilities in %s (%s)' % (cache_file, str(e)))
+
+    return capabilities
+
+
+def planQuery(capabilities, steps=DEFAULT_STEPS, need_tres=True):
+    """
+    Plan the sacct query: the smallest field list and the options that make
+    the output cheapest to produce and parse. The output is always requested
+    as --parsable2 rather than --json, even if available, as it can be parsed
+    while sacct is still running.
+
+    If the AllocTRES field is not needed (need_tres is False and no GRES are
+    configured), AllocCPUS is fetched in its place.
+    """
+    fields = list(FIELDS)
+    if not need_tres and not [ t for t in capabilities['tres'] if t.startswith('gres/') ] and capabilities['tres']:
+        fields[ALLOC_TRES_INDEX] = 'AllocCPUS'
+    if steps == STEPS_AGGREGATE:
+        fields += STEP_FIELDS
+
+    options = [ '--duplicates' ]
+    if steps == STEPS_SKIP:
+        options.append('--allocations')
+    if capabilities['noconvert']:
+        options.append('--noconvert')
+    options.append('--parsable2')
+
+    return {
+        'fields':  fields,
+        'options': ' '.join(options),
+        'states':  ','.join(capabilities['states']),
+    }
+
+
+SIZE_UNITS = { 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4, 'P': 1024**5 }
+
+def getBytes(size_str):
+    """
+    Convert a sacct size like '2252K', '1.50M' or '3G' to bytes. Values
+    without a unit are returned as is.
+    """
+    if not size_str:
+        return 0
+
+    unit = size_str[-1]
+    if unit in SIZE_UNITS:
+        return int(float(size_str[:-1]) * SIZE_UNITS[unit])
+
+    return int(float(size_str))
+
+
+def stepSeconds(entry, index):
+    """
+    Return a cpu time of a step entry in seconds, 0 if it cannot be parsed.
+    """
+    seconds = common.getSeconds(entry[index].strip())
+    if seconds < 0:
+        logging.warning('Job step %s: Invalid cpu time %s, counted as 0' % (entry[0], entry[index]))
+        return 0
+    return seconds
+
+
+def aggregateSteps(entries):
+    """
+    Fold the step entries following a job allocation entry into that entry,
+    in a single pass over the sacct output. A dict with the summed user and
+    system cpu time and the largest MaxRSS (in bytes) is appended to each job
+    entry, step entries are not passed on.
+
+    sacct lists the steps of a job right after its allocation, also for each
+    run of a requeued job with --duplicates, and heterogeneous job components
+    have JobIDRaw ids of their own. A step is matched on its job id, one that
+    does not follow its allocation is logged and left out.
+    """
+    job = None
+    for entry in entries:
+        job_id, dot, _ = entry[0].partition('.')
+        if dot:
+            if job is None or job_id != job[0]:
+                logging.warning('Job step %s does not follow its job allocation, its usage is left out' % entry[0])
+                continue
+            usage = job[-1]
+            usage['steps'] += 1
+            usage['user_cpu'] += stepSeconds(entry, 8)
+            usage['system_cpu'] += stepSeconds(entry, SYSTEM_CPU_INDEX)
+            usage['max_rss'] = max(usage['max_rss'], getBytes(entry[MAX_RSS_INDEX]))
+            continue
+
+        if job is not None:
+            yield job
+
+        job = entry
+        job.append({ 'steps': 0, 'user_cpu': 0, 'system_cpu': 0, 'max_rss': 0 })
+
+    if job is not None:
+        yield job
 
 
 class SlurmBackend:
     """
     DB backend for slurm accounting.
+
+    The sacct output is streamed, i.e. entries are handed out while sacct is
+    still running and are never kept in memory all at once.
     """
-    def __init__(self, state_starttime, max_days, user_list):
+    def __init__(self, state_starttime, max_days, user_list, plan):
 
         self.end_str = datetime.datetime.now().isoformat().split('.')[0]
-        self.results = []
+        self.results = iter(())
         croped = True
         search_days = 0
-        sacct_version = exec_cmd("sacct --version")[0].split(' ')[1]
-        while not self.results and croped:
+        while croped:
             # Check if number of days since last run is > search_days, if so only
             # advance max_days days        
             search_days += max_days
@@ -121,30 +431,283 @@ class SlurmBackend:
             else:
                 croped = False
 
-            args = {
-                "starttime": state_starttime,
-                "endtime": self.end_str,
-                "users": '--user=%s' % user_list if user_list else '--allusers',
-                "states": 'ca,cd,f,nf,pr,rq,to' if versioncmp(sacct_version, "17.11.0") < 0 else 'ca,cd,f,nf,pr,rq,to,oom'
-            }
-            command = COMMAND % args
+            command = sacctCommand(state_starttime, self.end_str, user_list, plan)
+
+            lines = (line for line in streamCommand(command) if line)
+            # remove description line
+            next(lines, None)
+
+            # peek at the first entry, an empty window means we should search further
+            first = next(lines, None)
+            if first is not None:
+                self.results = itertools.chain([first], lines)
+                break
+
+
+    def getLogEntries(self):
+        """
+        Yield the sacct entries, split into fields, one at a time.
+        """
+        for entry in self.results:
+            yield entry.split('|')
+
+    def getWindows(self):
+        """
+        Yield (end time, entries) for each window, in time order. This backend
+        only has a single window.
+        """
+        yield self.end_str, self.getLogEntries()
+
+
+class SlurmWindowBackend:
+    """
+    DB backend for slurm accounting, which splits the period from the state
+    up to now into windows that are fetched by a bounded pool of concurrent
+    sacct processes.
+
+    The output of each sacct process is spooled to a temporary file, so the
+    entries are still streamed from disk rather than kept in memory.
+    """
+    def __init__(self, state_starttime, window_hours, workers, user_list, plan, windows=None):
+
+        self.user_list = user_list
+        self.plan = plan
+        self.workers = max(workers, 1)
+
+        now = datetime.datetime.now().replace(microsecond=0)
+        start = datetime.datetime.strptime(state_starttime, "%Y-%m-%dT%H:%M:%S")
+        step = datetime.timedelta(hours=max(window_hours, 1))
+
+        # an explicit list of (start, end) windows can be given instead
+        self.windows = list(windows or [])
+        while windows is None and start < now:
+            end = min(start + step, now)
+            self.windows.append((start.isoformat(), end.isoformat()))
+            start = end
 
-            self.results = exec_cmd(command)
+        self.end_str = self.windows[-1][1] if self.windows else state_starttime
+
+
+    def getLogEntries(self, spool):
+        """
+        Yield the sacct entries of a spooled window, split into fields.
+        """
+        try:
+            lines = (line.decode(encoding='utf-8').strip() for line in spool)
             # remove description line
-            self.results = self.results[1:]
+            next(lines, None)
+            for line in lines:
+                if line:
+                    yield line.split('|')
+        finally:
+            spool.close()
+
 
+    def getWindows(self):
+        """
+        Yield (end time, entries) for each window, in time order. At most
+        'workers' windows are fetched ahead of the one being consumed. If
+        fetching a window fails, IOError is raised when that window is due.
+        """
+        if not self.windows:
+            return
 
-    def getNextLogEntry(self):
+        pending = collections.deque()
+        windows = iter(self.windows)
 
+        executor = futures.ThreadPoolExecutor(max_workers=self.workers)
+        spool = None
         try:
-            entry = self.results.pop(0)
-            return entry.strip().split('|')
-        except IndexError:
-            return None
+            while True:
+                for starttime, endtime in itertools.islice(windows, self.workers - len(pending)):
+                    command = sacctCommand(starttime, endtime, self.user_list, self.plan)
+                    pending.append((endtime, executor.submit(spoolCommand, command)))
+
+                if not pending:
+                    break
+
+                endtime, future = pending.popleft()
+                try:
+                    spool = future.result()
+                except IOError as e:
+                    raise IOError('Failed to fetch the window ending at %s: %s' % (endtime, str(e)))
+
+                yield endtime, self.getLogEntries(spool)
+        finally:
+            # windows fetched ahead are dropped and their spool files closed,
+            # as is the current one if its entries were not read to the end
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for _, future in pending:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    future.result().close()
+            if spool is not None:
+                spool.close()
+
+class SlurmJobCompParser:
+    """
+    Parser for the slurmctld job completion log (JobCompType=jobcomp/filetxt).
+
+    Reading starts at a byte offset in the file with a given inode. If the log
+    has been rotated since, the rest of the old file is read first, if it can
+    be found next to the log. After each entry, inode and offset tell where
+    the next entry starts.
+    """
+
+    # job states matching the ones fetched with sacct
+    STATES = ( 'CANCELLED', 'COMPLETED', 'FAILED', 'NODE_FAIL', 'PREEMPTED',
+               'REQUEUED', 'TIMEOUT', 'OUT_OF_MEMORY' )
+
+    FIELD_SPLIT = re.compile(r' (?=[A-Za-z]+=)')
+
+    def __init__(self, log_file, inode=None, offset=0):
+        self.log_file = log_file
+        self.inode = inode
+        self.offset = offset
+
+
+    def findRotated(self, inode):
+        """
+        Find the rotated log file with the given inode, e.g. jobcomp.log.1
+        """
+        log_dir = os.path.dirname(self.log_file) or '.'
+        prefix = os.path.basename(self.log_file)
+        for filename in sorted(os.listdir(log_dir)):
+            if filename.startswith(prefix) and filename != prefix:
+                path = os.path.join(log_dir, filename)
+                if os.stat(path).st_ino == inode:
+                    return path
+        return None
+
+
+    def readLines(self, path, offset):
+        """
+        Yield the complete lines of 'path' from 'offset', updating the offset
+        after each of them. An incomplete last line is left for the next run.
+        """
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                self.offset += len(line)
+                yield line.decode(encoding='utf-8', errors='replace').rstrip('\n')
+        finally:
+            f.close()
+
+
+    def splitLineEntry(self, line):
+        """
+        Split a line of 'Key=Value' pairs into a dict. Values may contain
+        spaces (Name, WorkDir), so the line is only split in front of keys.
+        """
+        return dict(item.split('=', 1) for item in self.FIELD_SPLIT.split(line) if '=' in item)
+
+
+    def toSacctEntry(self, fields):
+        """
+        Map a job completion entry to the fields of a sacct entry, see FIELDS.
+        """
+        start = fields.get('StartTime', 'Unknown')
+        end = fields.get('EndTime', 'Unknown')
+        try:
+            elapsed = timestamp.fromIsoStr(end).epoch - timestamp.fromIsoStr(start).epoch
+        except ValueError:
+            elapsed = 0
+        hours, rest = divmod(max(elapsed, 0), 3600)
+
+        alloc_tres = fields.get('Tres') or 'cpu=%s,node=%s' % (fields.get('ProcCnt', 0), fields.get('NodeCnt', 0))
+
+        return [ fields.get('JobId', ''),
+                 fields.get('UserId', '').split('(')[0],
+                 fields.get('Partition', ''),
+                 fields.get('SubmitTime', start),
+                 start,
+                 end,
+                 fields.get('Account', ''),
+                 '%d:%02d:%02d' % (hours, rest // 60, rest % 60),
+                 '',
+                 alloc_tres,
+                 fields.get('NodeList', ''),
+                 fields.get('NodeCnt', '0') ]
+
+
+    def getLogLines(self):
+        """
+        Yield the new lines of the job completion log.
+        """
+        st = os.stat(self.log_file)
+        if self.inode is not None and st.st_ino != self.inode:
+            rotated = self.findRotated(self.inode)
+            if rotated is None:
+                logging.warning('Could not find the rotated job completion log with inode %d, entries may be lost' % self.inode)
+                lines = iter(())
+            else:
+                logging.info('Reading the rest of rotated job completion log %s' % rotated)
+                lines = self.readLines(rotated, self.offset)
+            for line in lines:
+                yield line
+            self.inode, self.offset = st.st_ino, 0
+        elif self.inode is None or st.st_size < self.offset:
+            # first run, or the log has been truncated
+            self.inode, self.offset = st.st_ino, 0
+
+        for line in self.readLines(self.log_file, self.offset):
+            yield line
+
+
+    def getSacctEntries(self):
+        """
+        Yield the new job completion entries as sacct entries.
+        """
+        for line in self.getLogLines():
+            if not line:
+                continue
+            fields = self.splitLineEntry(line)
+            if fields.get('JobState', '').split(' ')[0] not in self.STATES:
+                continue
+            yield self.toSacctEntry(fields)
+
+
+# queue for the checkpoints of a cluster worker process, see
+# generateClusterUsageRecords()
+_cluster_updates = None
+
+def initClusterWorker(updates):
+    global _cluster_updates
+    _cluster_updates = updates
+
+
+def generateClusterUsageRecords(cfg, cluster, hostname, state, resume, user_map, project_map):
+    """
+    Generate the usage records of a single cluster, run in a worker process.
+    The state is not written by the worker, checkpoints are sent to the parent
+    process instead. Returns the number of written records, the final state
+    and the missing user mappings.
+    """
+    slurm = Slurm(cfg)
+    slurm.cluster = cluster
+    slurm.updates = _cluster_updates
+    slurm.state = state
+    slurm.resume = resume
+    slurm.missing_user_mappings = {}
+
+    count = slurm.generateSacctUsageRecords(hostname, user_map, project_map)
+    # the worker may not be used again, hand over its segment
+    common.syncSpool(seal=True)
+    return count, slurm.state, slurm.resume, slurm.missing_user_mappings
+
 
 class Slurm:   
     
     state = None
+    resume = None
+    cluster = None
+    updates = None
+    cluster_states = None
+    checkpoint = None
     cfg = None
     missing_user_mappings = {}
     idtimestamp = DEFAULT_IDTIMESTAMP
@@ -155,8 +718,32 @@ class Slurm:
         self.processors_unit = cfg.getConfigValue(SECTION, PROCESSORS_UNIT, DEFAULT_PROCESSORS_UNIT)
         self.charge_unit = cfg.getConfigValue(SECTION, CHARGE_UNIT, DEFAULT_CHARGE_UNIT)
         self.charge_scale = cfg.getConfigValue(SECTION, CHARGE_SCALE, DEFAULT_CHARGE_SCALE)
+        self.steps = cfg.getConfigValue(SECTION, STEPS, DEFAULT_STEPS)
+        self.source = cfg.getConfigValue(SECTION, SOURCE, DEFAULT_SOURCE)
+        if self.source not in (SOURCE_SACCT, SOURCE_JOBCOMP):
+            raise ValueError("Invalid value '%s' for %s in section [%s]" % (self.source, SOURCE, SECTION))
+        self.compress_hosts = cfg.getConfigValueBool(SECTION, COMPRESS_HOSTS, DEFAULT_COMPRESS_HOSTS)
+        self.alloc_resources = cfg.getConfigValueBool(SECTION, ALLOC_RESOURCES, DEFAULT_ALLOC_RESOURCES)
+        if self.steps not in (STEPS_SKIP, STEPS_AGGREGATE):
+            raise ValueError("Invalid value '%s' for %s in section [%s]" % (self.steps, STEPS, SECTION))
+        self.clusters = self.getClusters()
+        if self.clusters and self.source != SOURCE_SACCT:
+            raise ValueError("%s can only be used with %s=%s in section [%s]" % (CLUSTERS, SOURCE, SOURCE_SACCT, SECTION))
+
+    def getClusters(self):
+        """
+        Return the configured clusters as a list of (cluster, machine name).
+        """
+        clusters = []
+        for item in (self.cfg.getConfigValue(SECTION, CLUSTERS, DEFAULT_CLUSTERS) or '').split(','):
+            name, _, hostname = item.strip().partition(':')
+            if name:
+                clusters.append((name.strip(), hostname.strip() or name.strip()))
+        return clusters
 
     def getStateFile(self):
+        if self.source == SOURCE_JOBCOMP:
+            return self.cfg.getConfigValue(SECTION, STATEFILE, DEFAULT_JOBCOMP_STATEFILE)
         return self.cfg.getConfigValue(SECTION, STATEFILE, DEFAULT_STATEFILE)
     
     def getNodes(self,node_str):
@@ -170,54 +757,18 @@ class Slurm:
         "compute-3-29"
         "compute-10-[11,13-14,16]",
         "compute-1-[0-1,3-18,20-24,26,28-30,32],compute-11-12,compute-13-[25-26,28-32],compute-14-[1-12,15,30-31],compute-2-[1-2,6-18,21,23,26-29],compute-4-[4-5,7-9,12-13,15-18,20-21,23-28,30-34],compute-5-[2,5,9-11,13,15-16,22,26,28],compute-6-[28,31-34],compute-7-[2,4-5,7]"]
-        """
-        nodes = []
-        if '],' in node_str:
-            elements = node_str.split('],')
-        else:
-            elements = [node_str]
-
-        for element in elements:
-            if '[' in element:
-                parts = element.split('[')
-
-                for sequence in parts[1].split(','):
-                    sequence = sequence.rstrip(']')
-                    if '-' in  sequence:
-                        numbers = sequence.split('-')
-                        numlength = len(numbers[0])
-
-                        for i in range(int(numbers[0]),int(numbers[1])+1):
-                            nodes.append(parts[0] + "{0:0>{width}}".format(i,width=numlength))
-                    else:
-                        nodes.append(parts[0] + sequence)
-            else:
-                nodes += [element]
+        "rack[1-2]-node[01-02]"
 
-        return nodes
+        The result is cached and shared between calls, and must not be modified.
+        """
+        return hostlist.expand(node_str)
 
     def getProcessors(self, tresdict):
         """
-        Gets the configured "processors" unit from a TRES field.
+        Gets the configured "processors" unit from a parsed TRES field, memory
+        is in MiB.
         """
-
-        ## Extract the configured unit
-        value = tresdict.get(self.processors_unit, 0)
-
-        ## Convert memory to MiB, if needed
-        if self.processors_unit == 'mem':
-            if value.endswith('M'):
-                value = int(value[:-1])
-            elif value.endswith('G'):
-                value = int(value[:-1]) * 1024
-            elif value.endswith('T'):
-                value = int(value[:-1]) * 1024**2
-            else:
-                value = int(value)
-        else:
-            value = int(value)
-
-        return value
+        return tresdict.get(self.processors_unit, 0)
 
     def getCharge(self, tresdict, wall_time):
         """
@@ -245,34 +796,29 @@ class Slurm:
             return None
 
         # Transforms a string 'billing=5,cpu=2,mem=24G,node=1' into a dict
-        # { 'billing': 5, 'cpu': 2, 'mem': '24G', 'node': 1 }
-        tres = log_entry[9]
-        tresdict = dict((k.strip(), v.strip()) for k, v in
-                        (item.split('=') for item in tres.split(','))) if tres else dict()
-
+        # { 'billing': 5, 'cpu': 2, 'mem': 24576, 'node': 1 }
+        # If the planner fetched AllocCPUS instead, the field is just '2'
+        tresdict = tres.parse(log_entry[9])
 
         # extract data from the workload trace (log_entry)
         job_id       = str(log_entry[0])
         user_name    = log_entry[1]
         queue        = log_entry[2]
-        submit_time  = time.mktime(common.datetimeFromIsoStr(log_entry[3]).timetuple())
-        start_time   = time.mktime(common.datetimeFromIsoStr(log_entry[4]).timetuple())
-        end_time     = time.mktime(common.datetimeFromIsoStr(log_entry[5]).timetuple())
+        submit_time  = timestamp.fromIsoStr(log_entry[3])
+        start_time   = timestamp.fromIsoStr(log_entry[4])
+        end_time     = timestamp.fromIsoStr(log_entry[5])
         account_name = log_entry[6]
         utilized_cpu = common.getSeconds(log_entry[8])
         wall_time    = common.getSeconds(log_entry[7])
         processors   = self.getProcessors(tresdict)
-        gpus         = tresdict.get('gres/gpu')
         charge       = self.getCharge(tresdict, wall_time)
-        hosts        = self.getNodes(log_entry[10])
         nnodes       = int(log_entry[11])
 
         # clean data and create various composite entries from the work load trace
         job_identifier = job_id
         fqdn_job_id = hostname + ':' + job_id
         if self.idtimestamp:
-            record_id_timestamp = re.sub("[-:TZ]","",usagerecord.epoch2isoTime(start_time)) # remove characters
-            record_id = fqdn_job_id + ':' + record_id_timestamp
+            record_id = fqdn_job_id + ':' + start_time.id_time
         else:
             record_id = fqdn_job_id
 
@@ -283,7 +829,7 @@ class Slurm:
         mapped_project = project_map.get(account_name)
         if mapped_project is not None:
             voi = usagerecord.VOInformation()
-            voi.type = 'lrmsurgen-projectmap'
+            voi.type_ = 'lrmsurgen-projectmap'
             voi.name = mapped_project
             vo_info = [voi]
 
@@ -297,12 +843,16 @@ class Slurm:
         ur.machine_name     = hostname
         ur.queue            = queue
         ur.processors       = processors
-        ur.gpus             = gpus
+        if self.alloc_resources:
+            # a copy, the parsed TRES are cached and shared between jobs
+            ur.alloc_res    = dict(tresdict)
+        else:
+            ur.gpus         = tresdict.get('gres/gpu')
         ur.node_count       = nnodes
-        ur.host             = ','.join(hosts)
-        ur.submit_time      = usagerecord.epoch2isoTime(submit_time)
-        ur.start_time       = usagerecord.epoch2isoTime(start_time)
-        ur.end_time         = usagerecord.epoch2isoTime(end_time)
+        ur.host             = log_entry[10] if self.compress_hosts else hostlist.expandString(log_entry[10])
+        ur.submit_time      = submit_time.ur_time
+        ur.start_time       = start_time.ur_time
+        ur.end_time         = end_time.ur_time
         ur.cpu_duration     = utilized_cpu
         ur.wall_duration    = wall_time
         ur.project_name     = account_name
@@ -312,39 +862,270 @@ class Slurm:
         if charge is not None:
             ur.charge = charge
 
+        # Usage folded in from the job steps, see aggregateSteps(). The cpu
+        # time is then user plus system time, as all of it is known
+        if isinstance(log_entry[-1], dict):
+            usage = log_entry[-1]
+            if usage['steps'] > 0:
+                ur.user_time    = usage['user_cpu']
+                ur.kernel_time  = usage['system_cpu']
+                ur.memory       = usage['max_rss'] // 1024
+            else:
+                ur.user_time    = utilized_cpu
+                ur.kernel_time  = common.getSeconds(log_entry[SYSTEM_CPU_INDEX])
+            ur.cpu_duration     = ur.user_time + ur.kernel_time
+
         return ur
 
-    def generateUsageRecords(self, hostname, user_map, project_map):
+    def commitState(self):
         """
-        Starts the UR generation process.
+        Write the current state to disk, so a restart continues from here.
         """
-        self.missing_user_mappings = {}
+        common.writeGeneratorState(self)
 
-        tlp = SlurmBackend(self.state, int(self.cfg.getConfigValue(SECTION, MAX_DAYS, MAX_DAYS_DEFAULT)), self.cfg.getConfigValue(SECTION, USERS, USERS_DEFAULT))
-        
-        count = 0
-        while True:
-            log_entry = tlp.getNextLogEntry()
+    def sendState(self):
+        """
+        Send the current state to the parent process, in a cluster worker
+        process.
+        """
+        self.updates.put((self.cluster, self.state, self.resume))
 
-            if log_entry is None:
-                break # no more log entries
+    def createCheckpointManager(self):
+        """
+        Create the checkpoint manager for the usage records written by this
+        process.
+        """
+        records = self.cfg.getConfigValue(SECTION, CHECKPOINT_RECORDS, DEFAULT_CHECKPOINT_RECORDS)
+        write_state = self.sendState if self.updates is not None else None
+        return common.CheckpointManager(self, records, write_state=write_state)
+
+    def writeWindows(self, tlp, hostname, user_map, project_map, count=0, skip=0, skip_job_id=None):
+        """
+        Write the usage records of all windows of the sacct backend 'tlp'.
+        The state is committed after each window, and by the checkpoint
+        manager within a window, once any record has been written.
 
+        The first 'skip' entries of the first window are assumed to be
+        written already, the last of them must have the job id 'skip_job_id'.
+        Returns the total number of written records, and whether the skipped
+        entries matched. If fetching a window fails, IOError is raised and
+        the state is not advanced past the records written from it.
+        """
+        window_start = self.state
+        for window_end, log_entries in tlp.getWindows():
+            if self.steps == STEPS_AGGREGATE:
+                log_entries = aggregateSteps(log_entries)
+
+            position = 0
+            for log_entry in log_entries:
+                position += 1
+                if position <= skip:
+                    if position == skip and log_entry[0] != skip_job_id:
+                        logging.warning('Entry %d of the window ending %s is job %s, expected %s' % (position, window_end, log_entry[0], skip_job_id))
+                        return count, False
+                    continue
+
+                ur = self.createUsageRecord(log_entry, hostname, user_map, project_map)
+
+                if ur is not None:
+                    ur_file = common.writeUr(ur,self.cfg)
+                    count = count + 1
+
+                    # the windows before this one are done, even if empty, and
+                    # a resumed run starts from this window only
+                    self.state = window_start
+                    self.resume = (window_end, position, log_entry[0])
+                    self.checkpoint.written(ur_file)
+
+            if skip > position:
+                logging.warning('The window ending %s has only %d entries, expected at least %d' % (window_end, position, skip))
+                return count, False
+            skip = 0
+
+            # the state may only advance past completely written windows, and
+            # only once an entry is written
+            self.resume = None
+            window_start = window_end
+            if count > 0:
+                self.state = window_end
+                self.checkpoint.commit()
+
+        return count, True
+
+    def generateJobCompUsageRecords(self, hostname, user_map, project_map):
+        """
+        Starts the UR generation process, reading the job completion log.
+        """
+        log_file = self.cfg.getConfigValue(SECTION, JOBCOMP_LOG, DEFAULT_JOBCOMP_LOG)
+        self.checkpoint = self.createCheckpointManager()
+
+        jlp = SlurmJobCompParser(log_file, *self.state)
+
+        count = 0
+        for log_entry in jlp.getSacctEntries():
             ur = self.createUsageRecord(log_entry, hostname, user_map, project_map)
-            
-            if ur is not None: 
-                common.writeUr(ur,self.cfg)            
+
+            if ur is not None:
+                ur_file = common.writeUr(ur,self.cfg)
                 count = count + 1
-            
-        # only update state if a entry i written
-        if count > 0:
-            self.state = tlp.end_str
-            
+
+                self.state = (jlp.inode, jlp.offset)
+                self.checkpoint.written(ur_file)
+
+        self.state = (jlp.inode, jlp.offset)
+        self.checkpoint.commit()
+
+        logging.info('Total number of UR written = %d' % count)
+
+    def generateMultiClusterUsageRecords(self, user_map, project_map):
+        """
+        Starts the UR generation process for all configured clusters, in a
+        pool of worker processes. The checkpoints of the workers are collected
+        here and written to the common state file.
+        """
+        # probed here once, the workers find it in the cache
+        getCapabilities(self.cfg)
+
+        manager = multiprocessing.Manager()
+        updates = manager.Queue()
+        workers = min(len(self.clusters), os.cpu_count() or 1)
+        executor = futures.ProcessPoolExecutor(max_workers=workers, initializer=initClusterWorker, initargs=(updates,))
+
+        count = 0
+        failed = []
+        try:
+            jobs = {}
+            for cluster, hostname in self.clusters:
+                state, resume = self.cluster_states[cluster]
+                job = executor.submit(generateClusterUsageRecords, self.cfg, cluster, hostname, state, resume, user_map, project_map)
+                jobs[job] = cluster
+
+            pending = set(jobs)
+            while pending:
+                done, pending = futures.wait(pending, timeout=1)
+
+                # the checkpoints of a finished worker are all queued by now
+                while True:
+                    try:
+                        cluster, state, resume = updates.get_nowait()
+                    except queue.Empty:
+                        break
+                    self.cluster_states[cluster] = (state, resume)
+                    self.commitState()
+
+                for job in done:
+                    cluster = jobs[job]
+                    try:
+                        cluster_count, state, resume, missing_user_mappings = job.result()
+                    except Exception as e:
+                        logging.error('Failed to generate usage records for cluster %s: %s' % (cluster, str(e)))
+                        failed.append(cluster)
+                        continue
+                    logging.info('Number of UR written for cluster %s = %d' % (cluster, cluster_count))
+                    count += cluster_count
+                    self.missing_user_mappings.update(missing_user_mappings)
+                    self.cluster_states[cluster] = (state, resume)
+                    self.commitState()
+        finally:
+            executor.shutdown(wait=True)
+            manager.shutdown()
+
         logging.info('Total number of UR written = %d' % count)
+        if failed:
+            raise Exception('Failed to generate usage records for cluster(s) %s' % ','.join(failed))
+
+    def generateUsageRecords(self, hostname, user_map, project_map):
+        """
+        Starts the UR generation process. If clusters are configured, the
+        machine names of the clusters are used instead of 'hostname'.
+        """
+        self.missing_user_mappings = {}
+
+        if self.source == SOURCE_JOBCOMP:
+            return self.generateJobCompUsageRecords(hostname, user_map, project_map)
+
+        if self.clusters:
+            return self.generateMultiClusterUsageRecords(user_map, project_map)
+
+        count = self.generateSacctUsageRecords(hostname, user_map, project_map)
+        logging.info('Total number of UR written = %d' % count)
+
+    def generateSacctUsageRecords(self, hostname, user_map, project_map):
+        """
+        Write the usage records from sacct, from the state up to now. Returns
+        the number of written records.
+        """
+        user_list = self.cfg.getConfigValue(SECTION, USERS, USERS_DEFAULT)
+        self.checkpoint = self.createCheckpointManager()
+        need_tres = self.alloc_resources or self.processors_unit != 'cpu' or self.charge_unit is not None
+        plan = planQuery(getCapabilities(self.cfg), self.steps, need_tres)
+        if self.cluster is not None:
+            plan = dict(plan, options=plan['options'] + ' --clusters=%s' % self.cluster)
+
+        count = 0
+        if self.resume is not None:
+            # finish the window a previous run was interrupted in. If it can
+            # not be fetched, writeWindows raises and the state stays here
+            window_end, position, job_id = self.resume
+            logging.info('Resuming window %s - %s after entry %d (job %s)' % (self.state, window_end, position, job_id))
+            tlp = SlurmWindowBackend(self.state, 0, 1, user_list, plan, windows=[(self.state, window_end)])
+            count, matched = self.writeWindows(tlp, hostname, user_map, project_map, count, position, job_id)
+            if not matched:
+                # sacct output changed, write the whole window again
+                tlp = SlurmWindowBackend(self.state, 0, 1, user_list, plan, windows=[(self.state, window_end)])
+                count, _ = self.writeWindows(tlp, hostname, user_map, project_map, count)
+            self.resume = None
+            self.state = window_end
+
+        workers = int(self.cfg.getConfigValue(SECTION, SACCT_WORKERS, DEFAULT_SACCT_WORKERS))
+        if workers > 1:
+            window_hours = int(self.cfg.getConfigValue(SECTION, WINDOW_HOURS, DEFAULT_WINDOW_HOURS))
+            tlp = SlurmWindowBackend(self.state, window_hours, workers, user_list, plan)
+        else:
+            tlp = SlurmBackend(self.state, int(self.cfg.getConfigValue(SECTION, MAX_DAYS, MAX_DAYS_DEFAULT)), user_list, plan)
+
+        count, _ = self.writeWindows(tlp, hostname, user_map, project_map, count)
+
+        return count
 
     def parseGeneratorState(self,state):        
         """
         Get state of where to the UR generation has reached in the log.
-        This is returns the last jobid processed.
+        This is the start time of the next window to fetch, optionally
+        followed by the end time of that window, the number of entries
+        already written from it, and the job id of the last of them.
+
+        With several clusters, this is kept for each cluster, as
+        "cluster=state" separated by ';'.
+
+        When reading the job completion log, the state is the inode of the log
+        file and the byte offset to continue from.
+        """
+        if self.source == SOURCE_JOBCOMP:
+            if state:
+                inode, offset = state.split()
+                self.state = (int(inode), int(offset))
+            else:
+                self.state = (None, 0)
+            return
+
+        if self.clusters:
+            cluster_states = {}
+            for item in (state or '').split(';'):
+                cluster, _, cluster_state = item.partition('=')
+                if cluster:
+                    cluster_states[cluster.strip()] = cluster_state
+            self.cluster_states = {}
+            for cluster, _ in self.clusters:
+                self.cluster_states[cluster] = self.parseSacctState(cluster_states.get(cluster))
+            return
+
+        self.state, self.resume = self.parseSacctState(state)
+
+    def parseSacctState(self, state):
+        """
+        Parse the sacct state of a single cluster, returns the start time and
+        the resume position (or None).
         """
         if state is None or len(state) == 0:
             # no statefile -> we start from 50000 (DEFAULT_STATEFILE_DEFAULT) seconds / 5.7 days ago
@@ -352,8 +1133,23 @@ class Slurm:
             dt = datetime.datetime.now()-datetime.timedelta(seconds=sfd)
             state = dt.isoformat().split('.')[0]
 
-        self.state = state
+        fields = state.split()
+        resume = None
+        if len(fields) == 4:
+            resume = (fields[1], int(fields[2]), fields[3])
+        return fields[0], resume
 
-    def createGeneratorState(self):
-        return self.state
+    def createSacctState(self, state, resume):
+        if resume is not None:
+            return '%s %s %d %s' % ((state,) + resume)
+        return state
 
+    def createGeneratorState(self):
+        if self.source == SOURCE_JOBCOMP:
+            if self.state[0] is None:
+                return ''
+            return '%d %d' % self.state
+        if self.clusters:
+            return ';'.join('%s=%s' % (cluster, self.createSacctState(*self.cluster_states[cluster]))
+                            for cluster, _ in self.clusters)
+        return self.createSacctState(self.state, self.resume)
@@ -0,0 +1,44 @@
+#
+# Timestamp conversion for LRMS log parsing
+#
+# Module for the SGAS Batch system Reporting Tool (BaRT).
+#
+# The backends need every submit, start and end time in three forms: seconds
+# since epoch, the ISO time used in the usage record, and the compact form
+# used in record ids. These are computed together, and cached, as many jobs
+# share the same submit and end seconds.
+
+import time
+import collections
+from functools import lru_cache
+
+CACHE_SIZE = 65536
+
+Timestamp = collections.namedtuple('Timestamp', ['epoch', 'ur_time', 'id_time'])
+
+
+def fromEpoch(epoch):
+    """
+    Convert seconds since epoch to a Timestamp.
+    """
+    return _fromEpoch(int(epoch))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _fromEpoch(epoch):
+    gmt = time.gmtime(epoch)[0:6]
+    return Timestamp(epoch,
+                     '%04d-%02d-%02dT%02d:%02d:%02dZ' % gmt,
+                     '%04d%02d%02d%02d%02d%02d' % gmt)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def fromIsoStr(dt_str):
+    """
+    Convert a local time iso string, 'YYYY-MM-DDTHH:MM:SS' with an optional
+    fractional part, to a Timestamp.
+    """
+    local = (int(dt_str[0:4]), int(dt_str[5:7]), int(dt_str[8:10]),
+             int(dt_str[11:13]), int(dt_str[14:16]), int(dt_str[17:19]),
+             0, 0, -1)
+    return _fromEpoch(int(time.mktime(local)))
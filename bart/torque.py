@@ -9,10 +9,14 @@
 # Copyright: Nordic Data Grid Facility (2009, 2010)
 
 import os
+import mmap
 import time
 import logging
+import collections
+from functools import lru_cache
+from concurrent import futures
 
-from bart import common
+from bart import common, filewatch, hostlist, timestamp
 from bart.usagerecord import usagerecord
 
 SECTION = 'torque'
@@ -23,76 +27,377 @@ DEFAULT_STATEFILE = SECTION + '.state'
 SPOOL_DIR = 'spooldir'
 DEFAULT_SPOOL_DIR = '/var/spool/torque'
 
+# Number of worker processes reading complete past day files in parallel,
+# when catching up over several days.
+BACKFILL_WORKERS = 'backfill_workers'
+DEFAULT_BACKFILL_WORKERS = 1
+
+# Report the hosts of a job as a compressed host list, e.g. "node[001-128]",
+# rather than as a comma separated list of all hosts.
+COMPRESS_HOSTS = 'compress_hosts'
+DEFAULT_COMPRESS_HOSTS = 'false'
+
+# Seconds between checks of the accounting log with --follow, when it can not
+# be watched with inotify.
+POLL_INTERVAL = 'poll_interval'
+DEFAULT_POLL_INTERVAL = filewatch.DEFAULT_POLL_INTERVAL
+
+# Longest wait for a change with --follow, before checking for a new day.
+FOLLOW_TIMEOUT = 60
+
 CONFIG = {
             STATEFILE:       { 'required': False },
             SPOOL_DIR:       { 'required': False },
+            BACKFILL_WORKERS: { 'required': False, type: 'int' },
+            COMPRESS_HOSTS:  { 'required': False, type: 'bool' },
+            POLL_INTERVAL:   { 'required': False, type: 'int' },
           }
 
 TORQUE_DATE_FORMAT = '%Y%m%d'
 
+CACHE_SIZE = 4096
+
+Resources = collections.namedtuple('Resources', ['host', 'node_count', 'core_count', 'warning'])
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def getCoreCount(nodes):
+    """
+    Find number of cores used by parsing the Resource_List.nodes value
+    {<node_count> | <hostname>} [:ppn=<ppn>][:<property>[:<property>]...] [+ ...]
+    http://www.clusterresources.com/torquedocs21/2.1jobsubmission.shtml#nodeExamples
+    """
+    cores = 0
+    for node_req in nodes.split('+'):
+        listTmp = node_req.split(':')
+        if listTmp[0].isdigit():
+            first = int(listTmp[0])
+        else:
+            first = 1
+
+        cores += first
+        if len(listTmp) > 1:
+            for e in listTmp:
+                if len(e) > 3:
+                    if e[0:3] == 'ppn':
+                        cores -= first
+                        cores += first*int(e.split('=')[1])
+                        break
+    return cores
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def getResources(exec_host, ncpus=None, nodes=None, mppwidth=None, size=None, mppnodect=None, mppnppn=None, compress_hosts=False):
+    """
+    Work out the hosts, node count and core count of a job from the raw
+    exec_host and Resource_List values (None if missing). Wide jobs have
+    huge exec_host values, and array jobs repeat the same ones, so the
+    result is cached.
+
+    Returns the host list as reported in the usage record, the node count,
+    the core count, and a warning to log for the job, or None.
+    """
+    hosts = tuple(collections.OrderedDict.fromkeys(hc.split('/')[0] for hc in exec_host.split('+')))
+    if compress_hosts:
+        host = hostlist.compress(hosts)
+    else:
+        host = ','.join(hosts)
+
+    # initial value
+    node_count = len(hosts)
+    warning = None
+
+    if ncpus is not None:
+        core_count = int(ncpus)
+    elif nodes is not None:
+        core_count = getCoreCount(nodes)
+    # mppwidth is used on e.g. Cray machines instead of ncpus / nodes
+    elif mppwidth is not None or size is not None:
+        if mppwidth is not None:
+            core_count = int(mppwidth)
+        # older versions on e.g. Cray machines use "size" as keyword for mppwidth or core_count
+        else:
+            core_count = int(size)
+        # get node count, mppnodect exist only in newer versions
+        if mppnodect is not None:
+            node_count = int(mppnodect)
+        else:
+            warning = 'Missing mppnodect (will guess from "core count"/mppnppn)'
+            try:
+                node_count = core_count // int(mppnppn)
+            except (TypeError, ValueError, ZeroDivisionError):
+                warning = 'Unable to calculate node count (will guess from host list)'
+                # keep the default of len(hosts) given above
+    else:
+        warning = 'Missing processor count (will guess from host list)'
+        # assume the number of exec hosts is the core count (possibly not right)
+        core_count = len(hosts)
+
+    return Resources(host, node_count, core_count, warning)
+
+# offset of the record type in a line, after the "MM/DD/YYYY HH:MM:SS" date
+RECORD_TYPE_OFFSET = 19
+END_RECORD = b';E;'
+
+# size of the chunks in which compressed logs are decompressed
+CHUNK_SIZE = 1024 * 1024
+
+class TorqueRecord:
+    """
+    Lazy view of a Torque job end (E) record. Only the job id is decoded up
+    front, the key=value pairs are searched for and decoded when asked for.
+    """
+    def __init__(self, record):
+        # record is the part of the line after ";E;"
+        semicolon = record.find(b';')
+        self.jobid = record[:semicolon].decode('utf-8', 'replace')
+        # the leading space lets every key be found as b' key='
+        self.message = b' ' + record[semicolon+1:]
+        self.values = { 'entrytype': 'E', 'jobid': self.jobid }
+
+
+    def lookup(self, key):
+        """
+        Return the value of key, or None if the record does not have it.
+        """
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+
+        value = None
+        needle = b' ' + key.encode('utf-8') + b'='
+        start = self.message.find(needle)
+        if start != -1:
+            start += len(needle)
+            end = self.message.find(b' ', start)
+            if end == -1:
+                end = len(self.message)
+            value = self.message[start:end].decode('utf-8', 'replace')
+
+        self.values[key] = value
+        return value
+
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        if value is None:
+            return default
+        return value
+
+
+
 class TorqueLogParser:
     """
     Parser for torque accounting log.
+
+    The log file is memory mapped and scanned for job end records with byte
+    searches, other records are never decoded. If only a compressed sibling
+    of the log file exists (e.g. 20120612.gz), it is decompressed in chunks
+    which are scanned the same way. Only complete lines are returned, a
+    partially written last line is left for the next run.
+
+    After each entry, entry_offset is the byte offset of its line and offset
+    where the next line starts, in the decompressed data.
     """
     def __init__(self, log_file):
         self.log_file = log_file
         self.file_ = None
+        self.map_ = None
+        self.inode = None
+        self.compressed = False
+        # the scanned data, starting at byte offset base of the log
+        self.data = b''
+        self.base = 0
+        self.offset = 0
+        self.entry_offset = None
 
 
     def openFile(self):
-        self.file_ = open(self.log_file)
-
-
-    def splitLineEntry(self, line):
-        line_tokens = line.split(' ')
-        fields = {}
+        path, opener = common.findLogFile(self.log_file)
+        self.compressed = opener is not open
+        self.file_ = opener(path, 'rb')
+        self.inode = os.stat(path).st_ino
+        self.data = b''
+        self.base = 0
+        if not self.compressed and os.fstat(self.file_.fileno()).st_size > 0:
+            self.map_ = mmap.mmap(self.file_.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = self.map_
+        # empty files can not be mapped
+
+
+    def close(self):
+        if self.map_ is not None:
+            self.map_.close()
+        if self.file_ is not None:
+            self.file_.close()
+        self.file_ = None
+        self.map_ = None
+        self.data = b''
 
-        start_fields = line_tokens[1].split(';')
-        fields['entrytype'] = start_fields[1]
-        fields['jobid'] = start_fields[2]
-        fields['user'] = start_fields[3].split('=')[1]
 
-        for e in line_tokens:
-            e = e.strip()
-            r = e.split('=')
-            if len(r) >= 2:
-                fields[r[0]] = '='.join(r[1:len(r)])
+    def refresh(self):
+        """
+        Make the data appended to a plain log file since it was opened, or
+        last refreshed, available for reading.
+        """
+        if self.file_ is None or self.compressed:
+            return
 
-        return fields
+        fileno = self.file_.fileno()
+        if os.fstat(fileno).st_size > len(self.data):
+            # the returned records are copies, so the old map can go
+            if self.map_ is not None:
+                self.map_.close()
+            self.map_ = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            self.data = self.map_
 
 
-    def getNextLogLine(self):
+    def seek(self, offset):
+        """
+        Continue reading at offset.
+        """
         if self.file_ is None:
             self.openFile()
 
-        while True:
-            line = self.file_.readline()
-            if line == '': #last line
-                return None
-            if line[20] == 'E':
-                return line
+        if self.compressed and not self.base <= offset <= self.base + len(self.data):
+            self.file_.seek(offset)
+            self.data = b''
+            self.base = offset
+        self.offset = offset
+
+
+    def fill(self):
+        """
+        Drop the data before offset and add the next chunk of a compressed
+        log. Returns False if there is no more data.
+        """
+        if not self.compressed:
+            return False
+
+        chunk = self.file_.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+
+        self.data = self.data[self.offset-self.base:] + chunk
+        self.base = self.offset
+        return True
 
 
     def getNextLogEntry(self):
-        line = self.getNextLogLine()
-        if line is None:
-            return None
-        return self.splitLineEntry(line)
+        if self.file_ is None:
+            self.openFile()
+
+        while True:
+            data = self.data
+            pos = data.find(END_RECORD, self.offset - self.base)
+            if pos == -1:
+                # no more end records in the data, skip the complete lines
+                last_line_end = data.rfind(b'\n', self.offset - self.base)
+                if last_line_end != -1:
+                    self.offset = self.base + last_line_end + 1
+                if not self.fill():
+                    return None
+                continue
+
+            line_start = data.rfind(b'\n', 0, pos) + 1
+            line_end = data.find(b'\n', pos)
+            if line_end == -1:
+                # the line continues in the next chunk, or the last line is
+                # still being written
+                self.offset = self.base + line_start
+                if not self.fill():
+                    return None
+                continue
+
+            self.offset = self.base + line_end + 1
+            if pos - line_start == RECORD_TYPE_OFFSET:
+                self.entry_offset = self.base + line_start
+                return TorqueRecord(data[pos+len(END_RECORD):line_end])
+            # ';E;' in the middle of another record, skip it
 
 
     def spoolToEntry(self, entry_id):
+        """
+        Read up to and including the first entry of job entry_id, returns
+        False if there is no such entry.
+        """
         while True:
             log_entry = self.getNextLogEntry()
-            if log_entry is None or log_entry['jobid'] == entry_id:
-                break
+            if log_entry is None:
+                return False
+            if log_entry['jobid'] == entry_id:
+                return True
+
+
+    def resumeAfterEntry(self, entry_id, inode, offset):
+        """
+        Continue after the entry of job entry_id, which starts at offset in
+        the file with the given inode. The job id is only used to check that
+        the file is still the same, if not, the file is searched for the job
+        id. Returns False if the entry could not be found, reading then
+        starts from the beginning of the file.
+        """
+        if self.file_ is None:
+            self.openFile()
+
+        # a compressed log has a new inode, but the same offsets
+        if (inode == self.inode or self.compressed) and offset is not None:
+            self.seek(offset)
+            log_entry = self.getNextLogEntry()
+            if log_entry is not None and log_entry['jobid'] == entry_id and self.entry_offset == offset:
+                return True
+            logging.warning('Entry at offset %d in %s is not job %s, searching for it' % (offset, self.log_file, entry_id))
+
+        self.seek(0)
+        if self.spoolToEntry(entry_id):
+            return True
+
+        self.seek(0)
+        return False
+
+def backfillLogFile(cfg, torque_date, torque_date_today, hostname, user_map, vo_map):
+    """
+    Write the usage records of a complete day file, run in a worker process.
+    The records are synced to disk, but the state is left to the parent.
+    Returns the state after the file, (job id, inode, offset) or None if no
+    record was written, and the missing user mappings.
+    """
+    torque = Torque(cfg)
+    torque.missing_user_mappings = {}
+    checkpoint = common.CheckpointManager(torque, records=0, seconds=0)
+
+    if torque.processLogFile(torque_date, torque_date_today, None, hostname, user_map, vo_map, checkpoint) == 0:
+        return None, torque.missing_user_mappings
+
+    # the worker may not be used again, hand over its segment
+    checkpoint.syncUsageRecords(seal=True)
+    return (torque.state_job_id, torque.state_inode, torque.state_offset), torque.missing_user_mappings
+
 
 class Torque:
     state = None
+    state_job_id = None
+    state_log_file = None
+    state_inode = None
+    state_offset = None
     cfg = None
     missing_user_mappings = None
     
     def __init__(self, cfg):
         self.cfg = cfg
+        self.compress_hosts = cfg.getConfigValueBool(SECTION, COMPRESS_HOSTS, DEFAULT_COMPRESS_HOSTS)
         
     def getStateFile(self):
         """
@@ -102,34 +407,16 @@ class Torque:
 
     def getCoreCount(self,nodes):
         """
-        Find number of cores used by parsing the Resource_List.nodes value
-        {<node_count> | <hostname>} [:ppn=<ppn>][:<property>[:<property>]...] [+ ...]
-        http://www.clusterresources.com/torquedocs21/2.1jobsubmission.shtml#nodeExamples
-        """
-        cores = 0
-        for node_req in nodes.split('+'):
-            listTmp = node_req.split(':')
-            if listTmp[0].isdigit():
-                first = int(listTmp[0])
-            else:
-                first = 1
-
-            cores += first
-            if len(listTmp) > 1:
-                for e in listTmp:
-                    if len(e) > 3:
-                        if e[0:3] == 'ppn':
-                            cores -= first
-                            cores += first*int(e.split('=')[1])
-                            break
-        return cores
+        Find number of cores used by parsing the Resource_List.nodes value,
+        see getCoreCount().
+        """
+        return getCoreCount(nodes)
     
     def getSeconds(self,torque_timestamp):
         """
         Convert time string in the form HH:MM:SS to seconds
         """
-        (hours, minutes, seconds) = torque_timestamp.split(':')
-        return int(hours)*3600 + int(minutes)*60 + int(seconds)
+        return common.getSeconds(torque_timestamp)
     
     def createUsageRecord(self, log_entry, hostname, user_map, vo_map):
         """
@@ -141,42 +428,22 @@ class Torque:
         user_name    = log_entry['user']
         queue        = log_entry['queue']
         account      = log_entry.get('account')
-        submit_time  = int(log_entry['ctime'])
-        start_time   = int(log_entry['start'])
-        end_time     = int(log_entry['end'])
+        submit_time  = timestamp.fromEpoch(log_entry['ctime'])
+        start_time   = timestamp.fromEpoch(log_entry['start'])
+        end_time     = timestamp.fromEpoch(log_entry['end'])
         utilized_cpu = self.getSeconds(log_entry['resources_used.cput'])
         wall_time    = self.getSeconds(log_entry['resources_used.walltime'])
 
-        hosts = list(set([hc.split('/')[0] for hc in log_entry['exec_host'].split('+')]))
-
-        # initial value
-        node_count = len(hosts)
-
-        if log_entry.has_key('Resource_List.ncpus'):
-            core_count = int(log_entry['Resource_List.ncpus'])
-        elif log_entry.has_key('Resource_List.nodes'):
-            core_count = self.getCoreCount(log_entry['Resource_List.nodes'])
-        # mppwidth is used on e.g. Cray machines instead of ncpus / nodes
-        elif log_entry.has_key('Resource_List.mppwidth') or log_entry.has_key('Resource_List.size'):
-            if log_entry.has_key('Resource_List.mppwidth'):
-                core_count = int(log_entry['Resource_List.mppwidth'])
-            # older versions on e.g. Cray machines use "size" as keyword for mppwidth or core_count
-            elif log_entry.has_key('Resource_List.size'):
-                core_count = int(log_entry['Resource_List.size'])
-            # get node count, mppnodect exist only in newer versions
-            if log_entry.has_key('Resource_List.mppnodect'):
-                node_count = int(log_entry['Resource_List.mppnodect'])
-            else:
-                logging.warning('Missing mppnodect for entry: %s (will guess from "core count"/mppnppn)' % job_id)
-                try:
-                    node_count = core_count / int(log_entry['Resource_List.mppnppn'])
-                except:
-                    logging.warning('Unable to calculate node count for entry: %s (will guess from host list)' % job_id)
-                    # keep the default of len(hosts) given above
-        else:
-            logging.warning('Missing processor count for entry: %s (will guess from host list)' % job_id)
-            # assume the number of exec hosts is the core count (possibly not right)
-            core_count = len(hosts)
+        resources = getResources(log_entry['exec_host'],
+                                 log_entry.get('Resource_List.ncpus'),
+                                 log_entry.get('Resource_List.nodes'),
+                                 log_entry.get('Resource_List.mppwidth'),
+                                 log_entry.get('Resource_List.size'),
+                                 log_entry.get('Resource_List.mppnodect'),
+                                 log_entry.get('Resource_List.mppnppn'),
+                                 self.compress_hosts)
+        if resources.warning is not None:
+            logging.warning('%s for entry: %s' % (resources.warning, job_id))
 
         # clean data and create various composite entries from the work load trace
         if job_id.isdigit() and hostname is not None:
@@ -207,12 +474,12 @@ class Torque:
         ur.machine_name     = hostname
         ur.queue            = queue
         ur.project_name     = account
-        ur.processors       = core_count
-        ur.node_count       = node_count
-        ur.host             = ','.join(hosts)
-        ur.submit_time      = usagerecord.epoch2isoTime(submit_time)
-        ur.start_time       = usagerecord.epoch2isoTime(start_time)
-        ur.end_time         = usagerecord.epoch2isoTime(end_time)
+        ur.processors       = resources.core_count
+        ur.node_count       = resources.node_count
+        ur.host             = resources.host
+        ur.submit_time      = submit_time.ur_time
+        ur.start_time       = start_time.ur_time
+        ur.end_time         = end_time.ur_time
         ur.cpu_duration     = utilized_cpu
         ur.wall_duration    = wall_time
         ur.vo_info         += vo_info
@@ -221,82 +488,214 @@ class Torque:
         return ur
 
 
-    def generateUsageRecords(self,hostname, user_map, vo_map):
+    def getAccountingDir(self):
+        torque_spool_dir = self.cfg.getConfigValue(SECTION, SPOOL_DIR, DEFAULT_SPOOL_DIR)
+        return os.path.join(torque_spool_dir, 'server_priv', 'accounting')
+
+
+    def processLogFile(self, torque_date, torque_date_today, job_id, hostname, user_map, vo_map, checkpoint):
         """
-        Starts the UR generation process.
+        Write the usage records of the log file of a day, continuing after
+        the entry of job_id if given. Returns the number of written records.
         """
+        log_file = os.path.join(self.getAccountingDir(), torque_date)
+        tlp = TorqueLogParser(log_file)
+        try:
+            tlp.openFile()
+        except IOError as e:
+            if torque_date != torque_date_today: # todays entry might not exist yet
+                logging.error('Error reading log file at %s for date %s (%s)' % (log_file, torque_date, str(e)))
+            return 0
+
+        try:
+            if job_id is not None:
+                if not tlp.resumeAfterEntry(job_id, self.state_inode, self.state_offset):
+                    logging.warning('Job %s not found in log file %s, reading all of it' % (job_id, log_file))
+
+            return self.writeLogEntries(tlp, torque_date, hostname, user_map, vo_map, checkpoint)
+        finally:
+            tlp.close()
 
-        torque_spool_dir = self.cfg.getConfigValue(SECTION, SPOOL_DIR, DEFAULT_SPOOL_DIR)
-        torque_accounting_dir = os.path.join(torque_spool_dir, 'server_priv', 'accounting')
 
+    def writeLogEntries(self, tlp, torque_date, hostname, user_map, vo_map, checkpoint):
+        """
+        Write the usage records of the remaining entries of an open log file.
+        Returns the number of written records.
+        """
+        count = 0
+        while True:
+            log_entry = tlp.getNextLogEntry()
+            if log_entry is None:
+                return count # no more log entries
+
+            ur = self.createUsageRecord(log_entry, hostname, user_map, vo_map)
+            ur_file = common.writeUr(ur,self.cfg)
+            count += 1
+
+            self.state_job_id = log_entry['jobid']
+            self.state_log_file = torque_date
+            self.state_inode = tlp.inode
+            self.state_offset = tlp.entry_offset
+            checkpoint.written(ur_file)
+
+
+    def generateUsageRecords(self,hostname, user_map, vo_map):
+        """
+        Starts the UR generation process.
+
+        The day files from the day of the state on are found by listing the
+        log directory once. The day of the state, which may be partly done,
+        and the last file, which may still be growing, are read here. With
+        backfill_workers larger than 1, the complete days in between are read
+        in parallel by worker processes, and committed in date order.
+        """
         torque_date_today = time.strftime(TORQUE_DATE_FORMAT, time.gmtime())
-        
-        job_id = self.state_job_id
-        torque_date = self.state_log_file
+        workers = int(self.cfg.getConfigValue(SECTION, BACKFILL_WORKERS, DEFAULT_BACKFILL_WORKERS))
 
         self.missing_user_mappings = {}
+        checkpoint = common.CheckpointManager(self)
+
+        log_dir = self.getAccountingDir()
+        try:
+            dates = common.getLogFileDates(log_dir, self.state_log_file, torque_date_today, TORQUE_DATE_FORMAT)
+        except OSError as e:
+            logging.error('Error listing log files in %s (%s)' % (log_dir, str(e)))
+            return
+
+        if dates and dates[0] == self.state_log_file:
+            self.processLogFile(dates.pop(0), torque_date_today, self.state_job_id, hostname, user_map, vo_map, checkpoint)
+
+        backfill_dates = dates[:-1]
+        if workers > 1 and len(backfill_dates) > 1:
+            logging.info('Reading %d day files with %d workers' % (len(backfill_dates), workers))
+            checkpoint.commit()
+            executor = futures.ProcessPoolExecutor(max_workers=workers)
+            try:
+                jobs = [ executor.submit(backfillLogFile, self.cfg, torque_date, torque_date_today, hostname, user_map, vo_map)
+                         for torque_date in backfill_dates ]
+                # commit in date order, so the state never goes backwards
+                for torque_date, job in zip(backfill_dates, jobs):
+                    state, missing_user_mappings = job.result()
+                    self.missing_user_mappings.update(missing_user_mappings)
+                    if state is not None:
+                        self.state_job_id, self.state_inode, self.state_offset = state
+                        self.state_log_file = torque_date
+                        checkpoint.commit()
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            for torque_date in backfill_dates:
+                self.processLogFile(torque_date, torque_date_today, None, hostname, user_map, vo_map, checkpoint)
 
-        while True:
-            log_file = os.path.join(torque_accounting_dir, torque_date)
-            tlp = TorqueLogParser(log_file)
-            if job_id is not None:
-                try:
-                    tlp.spoolToEntry(job_id)
-                except IOError as e:
-                    logging.error('Error spooling log file at %s for date %s to %s (%s)' % (log_file, torque_date, job_id, str(e)) )
-                    job_id = None
-                    continue
+        if dates:
+            self.processLogFile(dates[-1], torque_date_today, None, hostname, user_map, vo_map, checkpoint)
+
+        checkpoint.commit()
 
-            while True:
-                try:
-                    log_entry = tlp.getNextLogEntry()
-                except IOError as e:
-                    if torque_date == torque_date_today: # todays entry might not exist yet
-                        break
-                    logging.error('Error reading log file at %s for date %s (%s)' % (log_file, torque_date, str(e)))
-                    break
 
-                if log_entry is None:
-                    break # no more log entries
+    def openFollowedLogFile(self, torque_date):
+        """
+        Open the log file of a day for following, continuing after the entry
+        of the state if it is in that file. Returns None if the file does not
+        exist yet.
+        """
+        log_file = os.path.join(self.getAccountingDir(), torque_date)
+        tlp = TorqueLogParser(log_file)
+        try:
+            tlp.openFile()
+        except IOError:
+            return None
 
-                job_id = log_entry['jobid']
+        if self.state_log_file == torque_date and self.state_job_id is not None:
+            if not tlp.resumeAfterEntry(self.state_job_id, self.state_inode, self.state_offset):
+                logging.warning('Job %s not found in log file %s, reading all of it' % (self.state_job_id, log_file))
+        return tlp
 
-                ur = self.createUsageRecord(log_entry, hostname, user_map, vo_map)
-                common.writeUr(ur,self.cfg)
-                
-                self.state_job_id = job_id
-                self.state_log_file = torque_date
-                common.writeGeneratorState(self)
-                
-                job_id = None
 
-            if torque_date == torque_date_today:
-                break
+    def followUsageRecords(self, hostname, user_map, vo_map):
+        """
+        Catch up as generateUsageRecords does, then keep today's log file open
+        and write the usage records of jobs as they end, until interrupted.
+
+        The log is read again whenever the accounting directory changes, which
+        is waited for with inotify, or by polling if that is not available.
+        After midnight the old day file is read to its end, and following
+        continues in the new one. The state is committed after every batch of
+        records, and when stopping.
+        """
+        torque_date = time.strftime(TORQUE_DATE_FORMAT, time.gmtime())
+        self.generateUsageRecords(hostname, user_map, vo_map)
+        # generateUsageRecords may have passed midnight
+        torque_date = max(torque_date, self.state_log_file)
+
+        accounting_dir = self.getAccountingDir()
+        poll_interval = int(self.cfg.getConfigValue(SECTION, POLL_INTERVAL, DEFAULT_POLL_INTERVAL))
+        watcher = filewatch.getWatcher(accounting_dir, poll_interval)
+        checkpoint = common.CheckpointManager(self)
+        logging.info('Following log files in %s' % accounting_dir)
+
+        tlp = None
+        try:
+            while True:
+                # taken before reading, so a day file is only left once it
+                # has been read after midnight
+                torque_date_today = time.strftime(TORQUE_DATE_FORMAT, time.gmtime())
+
+                if tlp is None:
+                    tlp = self.openFollowedLogFile(torque_date)
+                if tlp is not None:
+                    tlp.refresh()
+                    self.writeLogEntries(tlp, torque_date, hostname, user_map, vo_map, checkpoint)
+                    if checkpoint.pending:
+                        checkpoint.commit()
+
+                if torque_date != torque_date_today:
+                    logging.info('Log file %s done, continuing with %s' % (torque_date, torque_date_today))
+                    if tlp is not None:
+                        tlp.close()
+                        tlp = None
+                    torque_date = torque_date_today
+                    continue
 
-            torque_date = common.getIncrementalDate(torque_date, TORQUE_DATE_FORMAT)
-            job_id = None
+                watcher.wait(FOLLOW_TIMEOUT)
+        finally:
+            if tlp is not None:
+                tlp.close()
+            watcher.close()
+            checkpoint.commit()
 
     def parseGeneratorState(self,state):        
         """
-        Get state of where to the UR generation has reached in the log.
+        Get state of where to the UR generation has reached in the log: the
+        job id of the last written entry and the log file, optionally followed
+        by the inode of the log file and the byte offset of the entry.
         """
         job_id = None
         log_file = None
+        inode = None
+        offset = None
         if state is None or len(state) == 0:            
             # Empty state data happens sometimes, usually NFS is involved :-|
             # Start from yesterday (24 hours back), this should be fine assuming (at least) daily invokation.
             t_old = time.time() - (24 * 3600)
             log_file = time.strftime(TORQUE_DATE_FORMAT, time.gmtime(t_old))
         else:
-            job_id, log_file = state.split(' ', 2)
+            fields = state.split()
+            job_id, log_file = fields[0:2]
             if job_id == '-':
                 job_id = None
+            if len(fields) == 4:
+                inode, offset = int(fields[2]), int(fields[3])
 
         self.state_job_id = job_id
         self.state_log_file = log_file
+        self.state_inode = inode
+        self.state_offset = offset
 
     def createGeneratorState(self):
         """
         Create the current state of where to the UR generation has reached.
         """
+        if self.state_job_id is not None and self.state_inode is not None:
+            return '%s %s %d %d' % (self.state_job_id, self.state_log_file, self.state_inode, self.state_offset)
         return '%s %s' % (self.state_job_id or '-', self.state_log_file)
@@ -0,0 +1,70 @@
+#
+# Slurm TRES parsing
+#
+# Module for the SGAS Batch system Reporting Tool (BaRT).
+#
+# Parses Slurm trackable resource strings, e.g.
+#
+#   "billing=5,cpu=2,energy=1234,mem=24G,node=1,gres/gpu=2"
+#
+# into normalized integer values. There are only a handful of distinct TRES
+# strings among all the jobs of a cluster, so the results are cached.
+
+import math
+from functools import lru_cache
+
+CACHE_SIZE = 4096
+
+# TRES types that are sizes, they are normalized to MiB, which is also the
+# unit Slurm uses when no suffix is given
+SIZE_TYPES = ('mem', 'vmem', 'fs/disk')
+
+# sacct abbreviates large values with a suffix, in steps of 1024
+SUFFIXES = { 'K': 1, 'M': 2, 'G': 3, 'T': 4, 'P': 5 }
+
+
+def parseValue(tres_type, value):
+    """
+    Convert a single TRES value to an integer, sizes in MiB and everything
+    else (cpu, node, billing, energy, gres/*, ...) as a plain count. Sizes
+    are rounded up, so a small size is not reported as nothing.
+    """
+    value = value.strip()
+    if not value:
+        return 0
+
+    exponent = 0
+    if value[-1] in SUFFIXES:
+        exponent = SUFFIXES[value[-1]]
+        value = value[:-1]
+        if tres_type in SIZE_TYPES:
+            # the base unit of sizes is already M
+            exponent -= 2
+
+    amount = float(value) * 1024**exponent
+    if tres_type in SIZE_TYPES:
+        # rounded first, so float noise does not round e.g. 1024.0000001 up
+        return int(math.ceil(round(amount, 6)))
+    return int(amount)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse(tres):
+    """
+    Parse a TRES string into a dict of TRES type to integer value, in the
+    order of the string. A plain number, as in the AllocCPUS field, is taken
+    as the number of cpus.
+
+    The result is cached and shared between calls, and must not be modified.
+    """
+    if not tres:
+        return {}
+
+    if '=' not in tres:
+        return { 'cpu': parseValue('cpu', tres) }
+
+    values = {}
+    for item in tres.split(','):
+        tres_type, _, value = item.partition('=')
+        values[tres_type.strip()] = parseValue(tres_type.strip(), value)
+    return values
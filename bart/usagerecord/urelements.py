@@ -43,6 +43,9 @@ SUBMIT_HOST         = QName("{%s}SubmitHost"     % OGF_UR_NAMESPACE)
 MACHINE_NAME        = QName("{%s}MachineName"    % OGF_UR_NAMESPACE)
 HOST                = QName("{%s}Host"           % OGF_UR_NAMESPACE)
 QUEUE               = QName("{%s}Queue"          % OGF_UR_NAMESPACE)
+MEMORY              = QName("{%s}Memory"         % OGF_UR_NAMESPACE)
+STORAGE_UNIT        = QName("{%s}storageUnit"    % OGF_UR_NAMESPACE)
+METRIC              = QName("{%s}metric"         % OGF_UR_NAMESPACE)
 
 
 # third party tag names from here on
@@ -7,7 +7,9 @@
 # Author: Henrik Thostrup Jensen <htj@ndgf.org>
 # Copyright: Nordic Data Grid Facility (2009, 2010)
 
+import sys
 import time
+import array
 from bart import __version__
 
 from bart.usagerecord import urelements as ur
@@ -41,10 +43,61 @@ register_namespace('vo', ur.SGAS_VO_NAMESPACE)
 register_namespace('sgas', ur.SGAS_UR_NAMESPACE)
 register_namespace('logger', ur.LOGGER_NAMESPACE)
 
+# the same prefixes, for the direct serialization in toXML
+NAMESPACE_PREFIXES = {
+    ur.OGF_UR_NAMESPACE  : 'ur',
+    ur.DEISA_NAMESPACE   : 'deisa',
+    ur.SGAS_VO_NAMESPACE : 'vo',
+    ur.SGAS_UR_NAMESPACE : 'sgas',
+    ur.LOGGER_NAMESPACE  : 'logger',
+}
+
+def prefixedName(qname):
+    uri, local_name = qname.text[1:].split('}')
+    return NAMESPACE_PREFIXES[uri] + ':' + local_name
+
+# prefixed names of all the usage record elements and attributes
+NAMES = dict( (qname, prefixedName(qname)) for qname in vars(ur).values()
+              if isinstance(qname, ur.QName) and qname.text[1:].split('}')[0] in NAMESPACE_PREFIXES )
+
+# xmlns declarations of the root element, ElementTree sorts them on prefix
+XMLNS = dict( (prefix, ' xmlns:%s="%s"' % (prefix, uri)) for uri, prefix in NAMESPACE_PREFIXES.items() )
+
+
+def escapeText(text):
+    """
+    Escape element text, as ElementTree does.
+    """
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def escapeAttribute(text):
+    """
+    Escape an attribute value, as ElementTree does.
+    """
+    text = escapeText(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '\r' in text:
+        text = text.replace('\r', '&#13;')
+    if '\n' in text:
+        text = text.replace('\n', '&#10;')
+    if '\t' in text:
+        text = text.replace('\t', '&#09;')
+    return text
+
 
 
 class VOInformation:
 
+    __slots__ = ('name', 'type_', 'issuer', 'attributes')
+
     def __init__(self, name=None, type_=None, issuer=None):
         self.name = name
         self.type_ = type_
@@ -55,6 +108,17 @@ class VOInformation:
 
 class UsageRecord:
 
+    # no instance dict, there can be many records in memory at once
+    __slots__ = ('record_id', 'global_job_id', 'local_job_id', 'global_user_name', 'local_user_id',
+                 'job_name', 'status', 'machine_name', 'queue', 'host', 'node_count', 'processors',
+                 'gpus', 'memory', 'alloc_res', 'submit_time', 'end_time', 'start_time', 'project_name',
+                 'submit_host', 'wall_duration', 'cpu_duration', 'charge', 'vo_info',
+                 'user_time', 'kernel_time', 'exit_code', 'major_page_faults', 'runtime_environments')
+
+    # logger attributes, the same for all records
+    logger_name    = ur.LOGGER_NAME
+    logger_version = ur.LOGGER_VERSION
+
     def __init__(self):
         self.record_id          = None
         self.global_job_id      = None
@@ -68,7 +132,9 @@ class UsageRecord:
         self.host               = None
         self.node_count         = None
         self.processors         = None
-        self.alloc_res          = dict()
+        self.gpus               = None
+        self.memory             = None # max rss, in KiB
+        self.alloc_res          = dict() # resource type -> amount
         self.submit_time        = None
         self.end_time           = None
         self.start_time         = None
@@ -84,9 +150,6 @@ class UsageRecord:
         self.exit_code          = None
         self.major_page_faults  = None
         self.runtime_environments = []
-        # logger attributes
-        self.logger_name        = ur.LOGGER_NAME
-        self.logger_version     = ur.LOGGER_VERSION
 
 
     def generateTree(self):
@@ -149,10 +212,19 @@ class UsageRecord:
         if self.host           is not None :  setElement(ure, ur.HOST, self.host)
         if self.node_count     is not None :  setElement(ure, ur.NODE_COUNT, self.node_count)
         if self.processors     is not None :  setElement(ure, ur.PROCESSORS, self.processors)
-        if self.gpus           is not None :
+        if self.gpus           is not None and "gres/gpu" not in self.alloc_res :
             gpus = ET.SubElement(ure, ur.ALLOC_RESOURCE)
             gpus.set(ur.RESOURCE_TYPE, "gres/gpu")
             gpus.set(ur.RESOURCE_AMOUNT, str(self.gpus))
+        for resource_type, amount in self.alloc_res.items():
+            alloc_res = ET.SubElement(ure, ur.ALLOC_RESOURCE)
+            alloc_res.set(ur.RESOURCE_TYPE, resource_type)
+            alloc_res.set(ur.RESOURCE_AMOUNT, str(amount))
+        if self.memory         is not None :
+            memory = ET.SubElement(ure, ur.MEMORY)
+            memory.set(ur.STORAGE_UNIT, "KB")
+            memory.set(ur.METRIC, "max")
+            memory.text = str(self.memory)
         if self.submit_host    is not None :  setElement(ure, ur.SUBMIT_HOST, self.submit_host)
         if self.project_name   is not None :  setElement(ure, ur.PROJECT_NAME, self.project_name)
         if self.submit_time    is not None :  setElement(ure, ur.SUBMIT_TIME, self.submit_time)
@@ -177,11 +249,262 @@ class UsageRecord:
         return ET.ElementTree(ure)
 
 
+    def toXML(self, create_time=None):
+        """
+        Return the usage record as an XML document, in bytes. The createTime
+        is now, unless create_time is given.
+
+        The document is written directly from the prefixed names, without
+        building a tree, and is byte for byte the same as generateTree
+        serialized by ElementTree: namespaces declared on the root element
+        sorted on prefix, attributes in the order they are set, and empty
+        elements as <tag />.
+        """
+        parts = []
+        add = parts.append
+        prefixes = set([ 'ur', 'logger' ])
+
+        def element(name, text):
+            text = escapeText(str(text))
+            if text:
+                add('<%s>%s</%s>' % (name, text, name))
+            else:
+                add('<%s />' % name)
+
+        assert self.record_id is not None, "No recordId specified, cannot generate usage record"
+        add('<%s %s="%s" %s="%s" />' % (NAMES[ur.RECORD_IDENTITY],
+                                        NAMES[ur.RECORD_ID], escapeAttribute(self.record_id),
+                                        NAMES[ur.CREATE_TIME], create_time or gm2isoTime(time.gmtime())))
+
+        if self.global_job_id is not None or self.local_job_id is not None:
+            add('<%s>' % NAMES[ur.JOB_IDENTITY])
+            if self.global_job_id is not None:
+                element(NAMES[ur.GLOBAL_JOB_ID], self.global_job_id)
+            if self.local_job_id is not None:
+                element(NAMES[ur.LOCAL_JOB_ID], self.local_job_id)
+            add('</%s>' % NAMES[ur.JOB_IDENTITY])
+
+        if self.global_user_name is not None or self.local_job_id is not None:
+            add('<%s>' % NAMES[ur.USER_IDENTITY])
+            start = len(parts)
+            if self.local_user_id is not None:
+                element(NAMES[ur.LOCAL_USER_ID], self.local_user_id)
+            if self.global_user_name is not None:
+                element(NAMES[ur.GLOBAL_USER_NAME], self.global_user_name)
+
+            # vo stuff belongs under user identity
+            for voi in self.vo_info:
+                prefixes.add('vo')
+                if voi.type_ is not None:
+                    add('<%s %s="%s">' % (NAMES[ur.VO], NAMES[ur.VO_TYPE], escapeAttribute(voi.type_)))
+                else:
+                    add('<%s>' % NAMES[ur.VO])
+                element(NAMES[ur.VO_NAME], voi.name)
+                if voi.issuer is not None:
+                    element(NAMES[ur.VO_ISSUER], voi.issuer)
+
+                for attrs in voi.attributes:
+                    group, role, capability = attrs
+                    add('<%s>' % NAMES[ur.VO_ATTRIBUTE])
+                    element(NAMES[ur.VO_GROUP], group)
+                    if role is not None:
+                        element(NAMES[ur.VO_ROLE], role)
+                    if capability is not None:
+                        element(NAMES[ur.VO_CAPABILITY], capability)
+                    add('</%s>' % NAMES[ur.VO_ATTRIBUTE])
+                add('</%s>' % NAMES[ur.VO])
+
+            if len(parts) == start:
+                parts[-1] = '<%s />' % NAMES[ur.USER_IDENTITY]
+            else:
+                add('</%s>' % NAMES[ur.USER_IDENTITY])
+
+        if self.job_name       is not None :  element(NAMES[ur.JOB_NAME], self.job_name)
+        if self.charge         is not None :  element(NAMES[ur.CHARGE], self.charge)
+        if self.status         is not None :  element(NAMES[ur.STATUS], self.status)
+        if self.machine_name   is not None :  element(NAMES[ur.MACHINE_NAME], self.machine_name)
+        if self.queue          is not None :  element(NAMES[ur.QUEUE], self.queue)
+        if self.host           is not None :  element(NAMES[ur.HOST], self.host)
+        if self.node_count     is not None :  element(NAMES[ur.NODE_COUNT], self.node_count)
+        if self.processors     is not None :  element(NAMES[ur.PROCESSORS], self.processors)
+        alloc_res = list(self.alloc_res.items())
+        if self.gpus           is not None and "gres/gpu" not in self.alloc_res :
+            alloc_res.insert(0, ("gres/gpu", self.gpus))
+        for resource_type, amount in alloc_res:
+            prefixes.add('sgas')
+            add('<%s %s="%s" %s="%s" />' % (NAMES[ur.ALLOC_RESOURCE],
+                                            NAMES[ur.RESOURCE_TYPE], escapeAttribute(resource_type),
+                                            NAMES[ur.RESOURCE_AMOUNT], escapeAttribute(str(amount))))
+        if self.memory         is not None :
+            memory = escapeText(str(self.memory))
+            add('<%s %s="KB" %s="max"' % (NAMES[ur.MEMORY], NAMES[ur.STORAGE_UNIT], NAMES[ur.METRIC]))
+            add('>%s</%s>' % (memory, NAMES[ur.MEMORY]) if memory else ' />')
+        if self.submit_host    is not None :  element(NAMES[ur.SUBMIT_HOST], self.submit_host)
+        if self.project_name   is not None :  element(NAMES[ur.PROJECT_NAME], self.project_name)
+        if self.submit_time    is not None :
+            prefixes.add('deisa')
+            element(NAMES[ur.SUBMIT_TIME], self.submit_time)
+        if self.start_time     is not None :  element(NAMES[ur.START_TIME], self.start_time)
+        if self.end_time       is not None :  element(NAMES[ur.END_TIME], self.end_time)
+        if self.wall_duration  is not None :  element(NAMES[ur.WALL_DURATION], "PT%fS" % self.wall_duration)
+        if self.cpu_duration   is not None :  element(NAMES[ur.CPU_DURATION], "PT%fS" % self.cpu_duration)
+        # sgas attributes
+        start = len(parts)
+        if self.user_time      is not None :  element(NAMES[ur.USER_TIME], "PT%fS" % self.user_time)
+        if self.kernel_time    is not None :  element(NAMES[ur.KERNEL_TIME], "PT%fS" % self.kernel_time)
+        if self.exit_code      is not None :  element(NAMES[ur.EXIT_CODE], self.exit_code)
+        if self.major_page_faults is not None :
+            element(NAMES[ur.MAJOR_PAGE_FAULTS], self.major_page_faults)
+        for renv in self.runtime_environments:
+            element(NAMES[ur.RUNTIME_ENVIRONMENT], renv)
+        if len(parts) > start:
+            prefixes.add('sgas')
+
+        # set logger name and version
+        add('<%s %s="%s">%s</%s>' % (NAMES[ur.LOGGER_NAME], NAMES[ur.LOGGER_VERSION], escapeAttribute(LOGGER_VERSION_VALUE),
+                                     escapeText(LOGGER_NAME_VALUE), NAMES[ur.LOGGER_NAME]))
+
+        root = NAMES[ur.JOB_USAGE_RECORD]
+        xml = '<%s%s>%s</%s>' % (root, ''.join(XMLNS[prefix] for prefix in sorted(prefixes)), ''.join(parts), root)
+        return XML_HEADER + xml.encode('utf-8', 'xmlcharrefreplace')
+
+
     def writeXML(self, filename):
-        tree = self.generateTree()
         with open(filename, 'wb') as f:
-            f.write(XML_HEADER)
-            tree.write(f, encoding='utf-8')
+            f.write(self.toXML())
+
+
+
+class UsageRecordBatch:
+    """
+    Columnar container of usage records, for keeping many of them in memory.
+
+    Each field is a list of values, one per record, or an array when all of
+    them are integers or all floats. A field that no record has set takes no
+    space, and strings that repeat between records (user, queue, project,
+    host, ...) are interned. Containers (vo information,
+    allocated resources, runtime environments) are stored as tuples, shared
+    between records with the same values.
+
+    Records are rebuilt on access, changing them does not change the batch.
+    """
+    # fields that take their values from a small set
+    INTERNED = frozenset([ 'local_user_id', 'global_user_name', 'machine_name', 'queue', 'host',
+                           'project_name', 'submit_host', 'status', 'exit_code' ])
+    CONTAINERS = frozenset([ 'alloc_res', 'vo_info', 'runtime_environments' ])
+    TYPECODES = { int: 'q', float: 'd' }
+
+    def __init__(self, records=()):
+        self.size = 0
+        self.columns = {}
+        self.shared = {}
+        for record in records:
+            self.append(record)
+
+
+    def share(self, value):
+        return self.shared.setdefault(value, value)
+
+
+    def append(self, record):
+        for field in UsageRecord.__slots__:
+            value = getattr(record, field)
+            if field in self.CONTAINERS:
+                if not value:
+                    value = None
+                elif field == 'alloc_res':
+                    value = self.share(tuple(value.items()))
+                elif field == 'vo_info':
+                    value = self.share(tuple( (voi.name, voi.type_, voi.issuer, tuple(map(tuple, voi.attributes)))
+                                              for voi in value ))
+                else:
+                    value = self.share(tuple(value))
+            elif field in self.INTERNED and type(value) is str:
+                value = sys.intern(value)
+
+            column = self.columns.get(field)
+            if column is None:
+                if value is None:
+                    continue
+                # numbers are kept unboxed, as long as all of them are of the same type
+                if self.size == 0 and type(value) in self.TYPECODES:
+                    column = array.array(self.TYPECODES[type(value)])
+                else:
+                    column = [ None ] * self.size
+                self.columns[field] = column
+            elif type(column) is not list and type(value) is not type(column[0]):
+                column = self.columns[field] = list(column)
+
+            try:
+                column.append(value)
+            except OverflowError:
+                column = self.columns[field] = list(column)
+                column.append(value)
+        self.size += 1
+
+
+    def __len__(self):
+        return self.size
+
+
+    def rebuild(self, index, containers=None):
+        """
+        Rebuild the record at index. If containers is a dict, containers are
+        only rebuilt once per value and shared through it.
+        """
+        record = UsageRecord()
+        for field, column in self.columns.items():
+            value = column[index]
+            if value is None:
+                continue
+            if field not in self.CONTAINERS:
+                setattr(record, field, value)
+                continue
+            key = (field, value)
+            if containers is not None and key in containers:
+                setattr(record, field, containers[key])
+                continue
+
+            if field == 'alloc_res':
+                value = dict(value)
+            elif field == 'vo_info':
+                vo_info = []
+                for name, type_, issuer, attributes in value:
+                    voi = VOInformation(name, type_, issuer)
+                    voi.attributes = list(attributes)
+                    vo_info.append(voi)
+                value = vo_info
+            elif field == 'runtime_environments':
+                value = list(value)
+            if containers is not None:
+                containers[key] = value
+            setattr(record, field, value)
+        return record
+
+
+    def __getitem__(self, index):
+        if not -self.size <= index < self.size:
+            raise IndexError('usage record batch index out of range')
+        return self.rebuild(index)
+
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self[index]
+
+
+    def recordIds(self):
+        return list(self.columns.get('record_id', [ None ] * self.size))
+
+
+    def toXML(self):
+        """
+        Return the XML documents of all the records in the batch, in bytes,
+        with the same createTime.
+        """
+        create_time = gm2isoTime(time.gmtime())
+        containers = {}
+        return [ self.rebuild(index, containers).toXML(create_time) for index in range(self.size) ]
 
 
 # ----
@@ -56,7 +56,7 @@ setup(name='sgas-bart',
       url='http://www.sgas.se/',
       packages=['bart','bart.usagerecord',
                     'bart.ext', 'bart.ext.isodate'],
-      scripts = ['bart-logger', 'bart-registrant'],
+      scripts = ['bart-logger', 'bart-registrant', 'bart-spool-migrate'],
       cmdclass = cmdclasses,
 
       data_files = [
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the duration parsing done for every Slurm record (Elapsed and
+# UserCPU), comparing the old strptime based common.getSeconds with the
+# current one on a synthetic sacct dump.
+#
+# Usage: python benchmark_durations.py [number of lines]
+
+import random
+import time
+import logging
+
+import sys
+sys.path.append("..")
+
+from bart import common
+
+DEFAULT_LINES = 1000000
+
+def oldGetSeconds(time_str):
+    """
+    The strptime based getSeconds, as it was before the compiled parser.
+    """
+
+    if not time_str:
+        return 0
+
+    time_str = time_str.split('.')[0]
+
+    if '-' in time_str:
+        days, time_str = time_str.split('-')
+        st = time.strptime(time_str, '%H:%M:%S')
+        sec = int(days)*86400+st.tm_hour*3600+st.tm_min*60+st.tm_sec
+    else:
+        try:
+            st = time.strptime(time_str, '%H:%M:%S')
+            sec = st.tm_hour*3600+st.tm_min*60+st.tm_sec
+        except ValueError:
+            try:
+                st = time.strptime(time_str, '%M:%S')
+                sec = st.tm_min*60+st.tm_sec
+            except ValueError:
+                logging.error('String: %s does not match time format.' % time_str)
+                return -1
+
+    return sec
+
+def duration(rnd):
+    seconds = rnd.randint(0, 7*86400)
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if days:
+        return '%d-%02d:%02d:%02d' % (days, hours, minutes, seconds)
+    if hours:
+        return '%02d:%02d:%02d' % (hours, minutes, seconds)
+    return '%02d:%02d.%03d' % (minutes, seconds, rnd.randint(0, 999))
+
+def sacctDump(lines):
+    """
+    Synthetic sacct --parsable2 output, with a realistic share of short jobs
+    and repeated values.
+    """
+    rnd = random.Random(42)
+    durations = [ duration(rnd) for _ in range(20000) ] + [ '00:00:00', '00:01:00', '00:00:01' ] * 2000
+    dump = []
+    for i in range(lines):
+        dump.append('%d|user%d|batch|2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|proj%d|%s|%s|billing=5,cpu=2,mem=24G,node=1|node%d|1'
+                    % (i, i % 500, i % 50, rnd.choice(durations), rnd.choice(durations), i % 1000))
+    return dump
+
+def run(get_seconds, dump):
+    start = time.time()
+    for line in dump:
+        fields = line.split('|')
+        get_seconds(fields[7])
+        get_seconds(fields[8])
+    return len(dump) / (time.time() - start)
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_LINES
+    dump = sacctDump(lines)
+
+    old = run(oldGetSeconds, dump)
+    new = run(common.getSeconds, dump)
+
+    print("records: %d" % lines)
+    print("old getSeconds: %12.0f records/s" % old)
+    print("new getSeconds: %12.0f records/s" % new)
+    print("speedup:        %12.1fx" % (new / old))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the usage record serialization done for every written record,
+# comparing ElementTree serialization of generateTree with the direct
+# UsageRecord.toXML, on records like the ones the Slurm backend creates, and
+# the memory taken by a list of such records with that of a UsageRecordBatch.
+#
+# Usage: python benchmark_usagerecord.py [number of records]
+
+import time
+import tracemalloc
+
+import sys
+sys.path.append("..")
+
+from bart.usagerecord import usagerecord
+from bart.usagerecord.usagerecord import UsageRecord, VOInformation, UsageRecordBatch
+
+try:
+    from xml.etree import ElementTree as ET
+except ImportError:
+    from elementtree import ElementTree as ET
+
+DEFAULT_RECORDS = 100000
+
+def treeXML(ur):
+    return usagerecord.XML_HEADER + ET.tostring(ur.generateTree().getroot(), encoding='utf-8')
+
+def slurmRecords(count):
+    records = []
+    for i in range(count):
+        ur = UsageRecord()
+        ur.record_id        = 'cluster.example.org:%d.cluster.example.org' % i
+        ur.local_job_id     = str(i)
+        ur.global_job_id    = ur.record_id
+        ur.local_user_id    = 'user%d' % (i % 500)
+        ur.global_user_name = '/O=Grid/CN=User %d' % (i % 500)
+        ur.machine_name     = 'cluster.example.org'
+        ur.queue            = 'batch'
+        ur.project_name     = 'proj%d' % (i % 50)
+        ur.processors       = 2
+        ur.node_count       = 1
+        ur.host             = 'node%03d' % (i % 1000)
+        ur.alloc_res        = { 'billing': 5, 'cpu': 2, 'mem': 24576, 'node': 1 }
+        ur.submit_time      = '2012-06-12T17:37:43Z'
+        ur.start_time       = '2012-06-13T00:41:03Z'
+        ur.end_time         = '2012-06-18T00:41:29Z'
+        ur.wall_duration    = 432026
+        ur.cpu_duration     = 864052
+        ur.exit_code        = 0
+        ur.vo_info          = [ VOInformation(name='proj%d' % (i % 50), type_='bart-vomap') ]
+        records.append(ur)
+    return records
+
+def run(serialize, records):
+    start = time.time()
+    for ur in records:
+        serialize(ur)
+    return len(records) / (time.time() - start)
+
+def memory(create, count):
+    tracemalloc.start()
+    kept = create(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / float(count)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORDS
+    records = slurmRecords(count)
+
+    tree = run(treeXML, records)
+    direct = run(UsageRecord.toXML, records)
+
+    print("records: %d" % count)
+    print("generateTree + ElementTree: %10.0f records/s" % tree)
+    print("toXML:                      %10.0f records/s" % direct)
+    print("speedup:                    %10.1fx" % (direct / tree))
+
+
+    del records
+    listed = memory(slurmRecords, count)
+    batched = memory(lambda count: UsageRecordBatch(slurmRecords(count)), count)
+    print("list of UsageRecord:        %10.0f bytes/record" % listed)
+    print("UsageRecordBatch:           %10.0f bytes/record" % batched)
+
+if __name__ == '__main__':
+    main()
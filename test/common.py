@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import os
 import random
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 from pwd import getpwuid
 
 import sys
 sys.path.append("..")
  
 from bart import common
+from bart.usagerecord import usagerecord
+import bart.config
+
+def readFile(path, mode='r'):
+    with open(path, mode) as f:
+        return f.read()
 
 class TestSequenceFunctions(unittest.TestCase):
 
@@ -15,7 +25,7 @@ class TestSequenceFunctions(unittest.TestCase):
         pass
 
     def test_getSeconds(self):
-        print "Testing getSeconds()"
+        print("Testing getSeconds()")
         self.assertEqual(common.getSeconds("1:0"), 1*60+0, "Wrong number of seconds..")
         self.assertEqual(common.getSeconds("1:1:0"), 1*3600+1*60+0, "Wrong number of seconds..")
         self.assertEqual(common.getSeconds("1-1:1:0"), 1*86400+1*3600+1*60+0, "Wrong number of seconds..")
@@ -27,16 +37,229 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(common.getSeconds("4-3:2:1.33"), 4*86400+3*3600+2*60+1, "Wrong number of seconds..")
         self.assertEqual(common.getSeconds("Smurf"), -1, "Failed to detect error...")
         self.assertEqual(common.getSeconds("1:a:3"), -1, "Failed to detect error...")
-        self.assertEqual(common.getSeconds(""), -1, "Failed to detect error...")
+        # empty fields, e.g. the UserCPU of a job that never ran, are no time
+        self.assertEqual(common.getSeconds(""), 0, "Empty string is not 0 seconds")
         try:
             self.assertEqual(common.getSeconds("-1:2:3"), -1, "Failed to detect error...")
         except:
             pass
         
     def test_datetimeFromIsoStr(self):
-        print "Testing datetimeFromIsoStr"
+        print("Testing datetimeFromIsoStr")
         self.assertEqual(common.datetimeFromIsoStr("2012-01-02T08:09:10").__str__(), "2012-01-02 08:09:10", "Not Equal..")
         self.assertEqual(common.datetimeFromIsoStr("2010-10-12T18:19:20").__str__(), "2010-10-12 18:19:20", "Not Equal..")
-        
+
+    def test_CheckpointManager(self):
+        state_dir = tempfile.mkdtemp()
+        try:
+            lrms = MyLrms(state_dir)
+            checkpoint = common.CheckpointManager(lrms, records=2, seconds=0)
+            state_file = os.path.join(state_dir, 'test.state')
+
+            lrms.state = 'one'
+            checkpoint.written()
+            self.assertFalse(os.path.exists(state_file), "Committed too early")
+
+            lrms.state = 'two'
+            checkpoint.written()
+            self.assertEqual(readFile(state_file), 'two', "Not committed")
+
+            lrms.state = 'three'
+            checkpoint.written()
+            checkpoint.commit()
+            self.assertEqual(readFile(state_file), 'three', "Not committed")
+            self.assertEqual(os.listdir(state_dir), [ 'test.state' ], "Temporary file left")
+        finally:
+            shutil.rmtree(state_dir)
+
+    def test_getSpoolShard(self):
+        self.assertEqual(common.getSpoolShard('host:1234', 'flat'), '')
+        shard = common.getSpoolShard('host:1234', 'hashed')
+        self.assertEqual(len(shard), 2)
+        self.assertEqual(common.getSpoolShard('host:1234', 'hashed'), shard, "Not stable")
+        self.assertEqual(common.getSpoolShard('host:1234', 'date', 1339515460), '20120612')
+        self.assertRaises(ValueError, common.getSpoolShard, 'host:1234', 'deep')
+
+    def test_migrateSpool(self):
+        log_dir = tempfile.mkdtemp()
+        try:
+            for directory in [ 'urs', 'state', 'archive' ]:
+                os.mkdir(os.path.join(log_dir, directory))
+            for path in [ 'urs/host:1', 'urs/host:2', 'state/host:1', 'archive/host:3' ]:
+                open(os.path.join(log_dir, path), 'w').close()
+                os.utime(os.path.join(log_dir, path), (1339515460, 1339515460))
+
+            self.assertEqual(common.migrateSpool(log_dir, 'date'), 3)
+            self.assertEqual(sorted(common.listSpoolFiles(os.path.join(log_dir, 'urs'))),
+                             [ '20120612/host:1', '20120612/host:2' ])
+            self.assertEqual(common.listSpoolFiles(os.path.join(log_dir, 'state')), [ '20120612/host:1' ])
+            self.assertEqual(common.listSpoolFiles(os.path.join(log_dir, 'archive')), [ '20120612/host:3' ])
+
+            self.assertEqual(common.migrateSpool(log_dir, 'date'), 0)
+            self.assertEqual(common.migrateSpool(log_dir, 'flat'), 3)
+            self.assertEqual(common.listSpoolFiles(os.path.join(log_dir, 'state')), [ 'host:1' ])
+            self.assertEqual(common.listSpoolFiles(os.path.join(log_dir, 'segments')), [])
+        finally:
+            shutil.rmtree(log_dir)
+
+    def test_SegmentWriter(self):
+        segment_dir = tempfile.mkdtemp()
+        try:
+            # unsealed segment of a process that is gone
+            open(os.path.join(segment_dir, '20120612T000000-999999999-1.seg.part'), 'w').close()
+            writer = common.SegmentWriter(segment_dir)
+            self.assertEqual(os.listdir(segment_dir), [], "Stale segment left")
+
+            writer.append('host:1', b'<a/>')
+            writer.append('host:2', b'<bb/>')
+            self.assertFalse([ name for name in os.listdir(segment_dir) if name.endswith('.seg') ], "Sealed too early")
+
+            writer.seal()
+            names = sorted(os.listdir(segment_dir))
+            self.assertEqual([ os.path.splitext(name)[1] for name in names ], [ '.idx', '.seg' ])
+            self.assertEqual(readFile(os.path.join(segment_dir, names[0])), '0 4 host:1\n4 5 host:2\n')
+            self.assertEqual(readFile(os.path.join(segment_dir, names[1]), 'rb'), b'<a/><bb/>')
+        finally:
+            shutil.rmtree(segment_dir)
+
+    def test_SegmentWriter_checkpoint(self):
+        segment_dir = tempfile.mkdtemp()
+        try:
+            writer = common.SegmentWriter(segment_dir)
+            writer.append('host:1', b'<a/>')
+            writer.checkpoint()
+            writer.append('host:2', b'<bb/>')
+            writer.checkpoint()
+            writer.append('host:3', b'<c/>')
+            names = sorted(os.listdir(segment_dir))
+            self.assertEqual([ name.split('.', 1)[1] for name in names ], [ 'idx.part', 'seg.part' ], "Sealed at a checkpoint")
+            self.assertEqual(readFile(os.path.join(segment_dir, names[0])), '0 4 host:1\n4 5 host:2\n')
+
+            # as left by a process that is gone, cut back to the committed records
+            base = names[0][:-len('.idx.part')]
+            stale = base.replace('-%d-' % os.getpid(), '-999999999-')
+            writer.file_.close()
+            for name in names:
+                os.rename(os.path.join(segment_dir, name), os.path.join(segment_dir, name.replace(base, stale)))
+            common.SegmentWriter(segment_dir)
+            self.assertEqual(sorted(os.listdir(segment_dir)), [ stale + '.idx', stale + '.seg' ])
+            self.assertEqual(readFile(os.path.join(segment_dir, stale + '.idx')), '0 4 host:1\n4 5 host:2\n')
+            self.assertEqual(readFile(os.path.join(segment_dir, stale + '.seg'), 'rb'), b'<a/><bb/>')
+
+            # old enough to be sealed at a checkpoint
+            writer = common.SegmentWriter(segment_dir, max_age=0)
+            writer.append('host:4', b'<d/>')
+            writer.checkpoint()
+            self.assertFalse([ name for name in os.listdir(segment_dir) if name.endswith('.part') ], "Not sealed")
+            self.assertEqual(len([ name for name in os.listdir(segment_dir) if name.endswith('.seg') ]), 2)
+        finally:
+            shutil.rmtree(segment_dir)
+
+    def test_SegmentWriter_batch(self):
+        segment_dir = tempfile.mkdtemp()
+        try:
+            writer = common.SegmentWriter(segment_dir, batch_size=2)
+            records = []
+            for i in range(3):
+                ur = usagerecord.UsageRecord()
+                ur.record_id = 'host:%d' % i
+                records.append(ur)
+
+            self.assertEqual(writer.add(records[0]), None)
+            batch = writer.add(records[1])
+            self.assertEqual(batch.recordIds(), [ 'host:0', 'host:1' ])
+            self.assertEqual(writer.add(records[2]), None)
+            self.assertEqual(os.listdir(segment_dir), [], "Batch written before appendBatch")
+
+            writer.appendBatch(batch)
+            writer.seal()
+            index = [ name for name in os.listdir(segment_dir) if name.endswith('.idx') ]
+            self.assertEqual([ line.split()[2] for line in readFile(os.path.join(segment_dir, index[0])).splitlines() ],
+                             [ 'host:0', 'host:1', 'host:2' ])
+        finally:
+            shutil.rmtree(segment_dir)
+
+    def test_segment_checkpoints(self):
+        log_dir = tempfile.mkdtemp()
+        segment_dir = os.path.join(log_dir, common.SEGMENTS_DIRECTORY)
+        try:
+            lrms = MyLrms(log_dir, { bart.config.LOGDIR: log_dir,
+                                     bart.config.SPOOL_LAYOUT: 'segment',
+                                     bart.config.WRITER_THREADS: '0' })
+            checkpoint = common.CheckpointManager(lrms, seconds=0)
+            self.assertEqual(checkpoint.records, common.SEGMENT_BATCH_SIZE)
+
+            batches = []
+            writeSegmentBatch = common.writeSegmentBatch
+            def countingWriteSegmentBatch(segment_writer, batch):
+                batches.append(len(batch))
+                writeSegmentBatch(segment_writer, batch)
+
+            # more records than a checkpoint interval, the last batch is not full
+            count = 2 * common.SEGMENT_BATCH_SIZE + 500
+            with mock.patch('bart.common.writeSegmentBatch', countingWriteSegmentBatch):
+                for i in range(count):
+                    ur = usagerecord.UsageRecord()
+                    ur.record_id = 'host:%d' % i
+                    common.writeUr(ur, lrms.cfg)
+                    lrms.state = str(i)
+                    checkpoint.written()
+            self.assertEqual(batches, [ common.SEGMENT_BATCH_SIZE ] * 2)
+            self.assertEqual(readFile(os.path.join(log_dir, 'test.state')), str(2 * common.SEGMENT_BATCH_SIZE - 1))
+
+            # the checkpoints committed full batches to a single open segment
+            names = sorted(os.listdir(segment_dir))
+            self.assertEqual([ name.split('.', 1)[1] for name in names ], [ 'idx.part', 'seg.part' ])
+            self.assertEqual(len(readFile(os.path.join(segment_dir, names[0])).splitlines()), 2 * common.SEGMENT_BATCH_SIZE)
+
+            common.syncSpool(seal=True)
+            index = [ name for name in os.listdir(segment_dir) if name.endswith('.idx') ]
+            self.assertEqual(len(index), 1)
+            self.assertEqual(len(readFile(os.path.join(segment_dir, index[0])).splitlines()), count)
+        finally:
+            common.segment_writers.pop(segment_dir, None)
+            shutil.rmtree(log_dir)
+
+    def test_UsageRecordWriter(self):
+        written = []
+        def write(i):
+            if i == 3:
+                raise IOError("disk full")
+            written.append(i)
+
+        writer = common.UsageRecordWriter(2, 2)
+        for i in range(3):
+            writer.submit(write, i)
+        writer.flush()
+        self.assertEqual(sorted(written), [ 0, 1, 2 ])
+
+        writer.submit(write, 3)
+        self.assertRaises(IOError, writer.flush)
+        writer.flush()
+
+class MyConfig():
+    def __init__(self, state_dir, values=None):
+        self.state_dir = state_dir
+        # options of [common], everything else has its default
+        self.values = values or {}
+
+    def getConfigValue(self, section, value, default=None):
+        if section == bart.config.SECTION_COMMON and value == bart.config.STATEDIR:
+            return self.state_dir
+        if section == bart.config.SECTION_COMMON:
+            return self.values.get(value, default)
+        return default
+
+class MyLrms():
+    def __init__(self, state_dir, values=None):
+        self.cfg = MyConfig(state_dir, values)
+        self.state = None
+
+    def getStateFile(self):
+        return 'test.state'
+
+    def createGeneratorState(self):
+        return self.state
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sys
+sys.path.append("..")
+
+from bart.maui import *
+from bart.config import BartMapFile
+from bart import config
+import bart.maui
+
+def statsLine(job_id, user, state, tasks='2', hosts='n1:n2'):
+    fields = [ str(i) for i in range(FIELD_COUNT) ]
+    fields[JOB_ID] = job_id
+    fields[USER_NAME] = user
+    fields[JOB_STATE] = state
+    fields[REQ_CLASS] = '[batch:1]'
+    fields[SUBMIT_TIME] = '1339515460'
+    fields[START_TIME] = '1339515461'
+    fields[END_TIME] = '1339522663'
+    fields[ALLOC_TASKS] = tasks
+    fields[ACCOUNT_NAME] = '[NONE]'
+    fields[UTILIZED_CPU] = '1200.5'
+    fields[TASK_CORES] = '4'
+    fields[HOSTS] = hosts
+    return ' '.join(fields)
+
+LOG_LINES = [
+    "VERSION 230",
+    statsLine('4711', 'magnus', 'Removed'),
+    statsLine('4712', 'magnus', 'Completed'),
+    "4713 0 1 erik 4 5 Completed short line",
+    statsLine('4714', 'erik', 'Completed', tasks='1', hosts='n3'),
+]
+
+class MyConfig():
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+
+    def getConfigValue(self, section, value, default=None):
+        if section == bart.maui.SECTION and value == bart.maui.SPOOL_DIR:
+            return self.tmp_dir
+        if section == config.SECTION_COMMON and value == config.LOGDIR:
+            return os.path.join(self.tmp_dir, 'urs')
+        return default
+
+class MyCheckpoint():
+    def __init__(self):
+        self.ur_files = []
+
+    def written(self, ur_file=None):
+        self.ur_files.append(ur_file)
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, STATS_DIR))
+        self.log_file = os.path.join(self.tmp_dir, STATS_DIR, 'Tue_Jun_12_2012')
+        with open(self.log_file, 'w') as f:
+            f.write('\n'.join(LOG_LINES) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_projectEntry(self):
+        entry = MauiEntry._make(projectEntry(statsLine('4712', 'magnus', 'Completed').split()))
+        self.assertEqual(entry.job_id, '4712')
+        self.assertEqual(entry.job_state, 'Completed')
+        self.assertEqual(entry.hosts, 'n1:n2')
+
+    def test_resumeAfterEntry(self):
+        mlp = MauiLogParser(self.log_file)
+        self.assertTrue(mlp.resumeAfterEntry('4712', None, None))
+        offset = mlp.entry_offset
+        self.assertEqual(mlp.getNextLogEntry()[0], '4713')
+        mlp.file_.close()
+
+        mlp = MauiLogParser(self.log_file)
+        mlp.openFile()
+        self.assertTrue(mlp.resumeAfterEntry('4713', mlp.inode, offset + len(LOG_LINES[2]) + 1))
+        self.assertEqual(mlp.getNextLogEntry()[0], '4714')
+        mlp.file_.close()
+
+    def test_processLogFile(self):
+        maui = Maui(MyConfig(self.tmp_dir))
+        maui.missing_user_mappings = {}
+        checkpoint = MyCheckpoint()
+        count = maui.processLogFile('Tue_Jun_12_2012', 'Wed_Jun_13_2012', None, 'server.example.com',
+                                    BartMapFile(), BartMapFile(), 'maui.example.com', checkpoint)
+        self.assertEqual(count, 2)
+        self.assertEqual([ os.path.basename(f) for f in checkpoint.ur_files ],
+                         [ 'server.example.com:4712.maui.example.com', 'server.example.com:4714.maui.example.com' ])
+        self.assertEqual(maui.state_job_id, '4714')
+
+    def test_invalidFieldCount(self):
+        with open(os.path.join(self.tmp_dir, 'stats', 'Wed_Jun_13_2012'), 'w') as f:
+            f.write('\n'.join([ "4715 0 1 erik 4 5 Removed short line",
+                                 statsLine('4716', 'erik', 'Completed') + ' 44',
+                                 statsLine('4717', 'erik', 'Completed') ]) + '\n')
+        maui = Maui(MyConfig(self.tmp_dir))
+        maui.missing_user_mappings = {}
+        checkpoint = MyCheckpoint()
+        with self.assertLogs(level='ERROR') as logs:
+            count = maui.processLogFile('Wed_Jun_13_2012', 'Wed_Jun_13_2012', None, 'server.example.com',
+                                        BartMapFile(), BartMapFile(), None, checkpoint)
+        self.assertEqual(count, 1)
+        self.assertEqual(maui.state_job_id, '4717')
+        # short lines are rejected whatever their state
+        self.assertIn('contains entry with 9 fields. First field: 4715', logs.output[1])
+        self.assertIn('contains entry with 45 fields. First field: 4716', logs.output[4])
+
+    def test_createUsageRecord(self):
+        maui = Maui(MyConfig(self.tmp_dir))
+        maui.missing_user_mappings = {}
+        entry = MauiEntry._make(projectEntry(statsLine('4712', 'magnus', 'Completed').split()))
+        ur = maui.createUsageRecord(entry, 'server.example.com', BartMapFile(), BartMapFile(), None)
+        self.assertEqual(ur.record_id, 'server.example.com:4712')
+        self.assertEqual(ur.queue, 'batch')
+        self.assertEqual(ur.processors, 8)
+        self.assertEqual(ur.node_count, 2)
+        self.assertEqual(ur.host, 'n1,n2')
+        self.assertEqual(ur.wall_duration, 7202)
+        self.assertEqual(ur.cpu_duration, 1200.5)
+        self.assertEqual(ur.project_name, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import datetime
 import random
+import shutil
+import tempfile
 import unittest
-from pwd import getpwuid
+from unittest import mock
+from concurrent import futures
 
 import sys
 sys.path.append("..")
  
 from bart.slurm import *
 from bart.config import BartMapFile
+from bart import timestamp
 import bart.config
 
 node_list_examples = [
@@ -29,7 +36,7 @@ node_list_examples = [
             { 'from': "compute-1-[0-1,3-18,20-24,26,28-30,32]",
                 'ref': ['compute-1-0', 'compute-1-1', 'compute-1-3', 'compute-1-4', 'compute-1-5', 'compute-1-6', 'compute-1-7', 'compute-1-8', 'compute-1-9', 'compute-1-10', 'compute-1-11', 'compute-1-12', 'compute-1-13', 'compute-1-14', 'compute-1-15', 'compute-1-16', 'compute-1-17', 'compute-1-18', 'compute-1-20', 'compute-1-21', 'compute-1-22', 'compute-1-23', 'compute-1-24', 'compute-1-26', 'compute-1-28', 'compute-1-29', 'compute-1-30', 'compute-1-32'] },
             { 'from': "compute-11-12,compute-13-[25-26,28-32]",
-                'ref': ['compute-11-12,compute-13-25', 'compute-11-12,compute-13-26', 'compute-11-12,compute-13-28', 'compute-11-12,compute-13-29', 'compute-11-12,compute-13-30', 'compute-11-12,compute-13-31', 'compute-11-12,compute-13-32'] },
+                'ref': ['compute-11-12', 'compute-13-25', 'compute-13-26', 'compute-13-28', 'compute-13-29', 'compute-13-30', 'compute-13-31', 'compute-13-32'] },
             { 'from': "compute-14-[1-12,15,30-31]",
                 'ref': ['compute-14-1', 'compute-14-2', 'compute-14-3', 'compute-14-4', 'compute-14-5', 'compute-14-6', 'compute-14-7', 'compute-14-8', 'compute-14-9', 'compute-14-10', 'compute-14-11', 'compute-14-12', 'compute-14-15', 'compute-14-30', 'compute-14-31'] },
             { 'from': "compute-2-[1-2,6-18,21,23,26-29]",
@@ -39,35 +46,84 @@ node_list_examples = [
             { 'from': "compute-5-[2,5,9-11,13,15-16,22,26,28],compute-6-[28,31-34],compute-7-[2,4-5,7]",
                 'ref': ['compute-5-2', 'compute-5-5', 'compute-5-9', 'compute-5-10', 'compute-5-11', 'compute-5-13', 'compute-5-15', 'compute-5-16', 'compute-5-22', 'compute-5-26', 'compute-5-28', 'compute-6-28', 'compute-6-31', 'compute-6-32', 'compute-6-33', 'compute-6-34', 'compute-7-2', 'compute-7-4', 'compute-7-5', 'compute-7-7'] },
             { 'from': "compute-10-[11,13-14,16],compute-1-[0-1,3-18,20-24,26,28-30,32],compute-11-12,compute-13-[25-26,28-32],compute-14-[1-12,15,30-31],compute-2-[1-2,6-18,21,23,26-29],compute-4-[4-5,7-9,12-13,15-18,20-21,23-28,30-34],compute-5-[2,5,9-11,13,15-16,22,26,28],compute-6-[28,31-34],compute-7-[2,4-5,7]", 
-                'ref': ['compute-10-11', 'compute-10-13', 'compute-10-14', 'compute-10-16', 'compute-1-0', 'compute-1-1', 'compute-1-3', 'compute-1-4', 'compute-1-5', 'compute-1-6', 'compute-1-7', 'compute-1-8', 'compute-1-9', 'compute-1-10', 'compute-1-11', 'compute-1-12', 'compute-1-13', 'compute-1-14', 'compute-1-15', 'compute-1-16', 'compute-1-17', 'compute-1-18', 'compute-1-20', 'compute-1-21', 'compute-1-22', 'compute-1-23', 'compute-1-24', 'compute-1-26', 'compute-1-28', 'compute-1-29', 'compute-1-30', 'compute-1-32', 'compute-11-12,compute-13-25', 'compute-11-12,compute-13-26', 'compute-11-12,compute-13-28', 'compute-11-12,compute-13-29', 'compute-11-12,compute-13-30', 'compute-11-12,compute-13-31', 'compute-11-12,compute-13-32', 'compute-14-1', 'compute-14-2', 'compute-14-3', 'compute-14-4', 'compute-14-5', 'compute-14-6', 'compute-14-7', 'compute-14-8', 'compute-14-9', 'compute-14-10', 'compute-14-11', 'compute-14-12', 'compute-14-15', 'compute-14-30', 'compute-14-31', 'compute-2-1', 'compute-2-2', 'compute-2-6', 'compute-2-7', 'compute-2-8', 'compute-2-9', 'compute-2-10', 'compute-2-11', 'compute-2-12', 'compute-2-13', 'compute-2-14', 'compute-2-15', 'compute-2-16', 'compute-2-17', 'compute-2-18', 'compute-2-21', 'compute-2-23', 'compute-2-26', 'compute-2-27', 'compute-2-28', 'compute-2-29', 'compute-4-4', 'compute-4-5', 'compute-4-7', 'compute-4-8', 'compute-4-9', 'compute-4-12', 'compute-4-13', 'compute-4-15', 'compute-4-16', 'compute-4-17', 'compute-4-18', 'compute-4-20', 'compute-4-21', 'compute-4-23', 'compute-4-24', 'compute-4-25', 'compute-4-26', 'compute-4-27', 'compute-4-28', 'compute-4-30', 'compute-4-31', 'compute-4-32', 'compute-4-33', 'compute-4-34', 'compute-5-2', 'compute-5-5', 'compute-5-9', 'compute-5-10', 'compute-5-11', 'compute-5-13', 'compute-5-15', 'compute-5-16', 'compute-5-22', 'compute-5-26', 'compute-5-28', 'compute-6-28', 'compute-6-31', 'compute-6-32', 'compute-6-33', 'compute-6-34', 'compute-7-2', 'compute-7-4', 'compute-7-5', 'compute-7-7'] },
+                'ref': ['compute-10-11', 'compute-10-13', 'compute-10-14', 'compute-10-16', 'compute-1-0', 'compute-1-1', 'compute-1-3', 'compute-1-4', 'compute-1-5', 'compute-1-6', 'compute-1-7', 'compute-1-8', 'compute-1-9', 'compute-1-10', 'compute-1-11', 'compute-1-12', 'compute-1-13', 'compute-1-14', 'compute-1-15', 'compute-1-16', 'compute-1-17', 'compute-1-18', 'compute-1-20', 'compute-1-21', 'compute-1-22', 'compute-1-23', 'compute-1-24', 'compute-1-26', 'compute-1-28', 'compute-1-29', 'compute-1-30', 'compute-1-32', 'compute-11-12', 'compute-13-25', 'compute-13-26', 'compute-13-28', 'compute-13-29', 'compute-13-30', 'compute-13-31', 'compute-13-32', 'compute-14-1', 'compute-14-2', 'compute-14-3', 'compute-14-4', 'compute-14-5', 'compute-14-6', 'compute-14-7', 'compute-14-8', 'compute-14-9', 'compute-14-10', 'compute-14-11', 'compute-14-12', 'compute-14-15', 'compute-14-30', 'compute-14-31', 'compute-2-1', 'compute-2-2', 'compute-2-6', 'compute-2-7', 'compute-2-8', 'compute-2-9', 'compute-2-10', 'compute-2-11', 'compute-2-12', 'compute-2-13', 'compute-2-14', 'compute-2-15', 'compute-2-16', 'compute-2-17', 'compute-2-18', 'compute-2-21', 'compute-2-23', 'compute-2-26', 'compute-2-27', 'compute-2-28', 'compute-2-29', 'compute-4-4', 'compute-4-5', 'compute-4-7', 'compute-4-8', 'compute-4-9', 'compute-4-12', 'compute-4-13', 'compute-4-15', 'compute-4-16', 'compute-4-17', 'compute-4-18', 'compute-4-20', 'compute-4-21', 'compute-4-23', 'compute-4-24', 'compute-4-25', 'compute-4-26', 'compute-4-27', 'compute-4-28', 'compute-4-30', 'compute-4-31', 'compute-4-32', 'compute-4-33', 'compute-4-34', 'compute-5-2', 'compute-5-5', 'compute-5-9', 'compute-5-10', 'compute-5-11', 'compute-5-13', 'compute-5-15', 'compute-5-16', 'compute-5-22', 'compute-5-26', 'compute-5-28', 'compute-6-28', 'compute-6-31', 'compute-6-32', 'compute-6-33', 'compute-6-34', 'compute-7-2', 'compute-7-4', 'compute-7-5', 'compute-7-7'] },
+            { 'from': "node[01-03]",
+                'ref': ['node01', 'node02', 'node03'] },
+            { 'from': "rack[1-2]-node[01-02]",
+                'ref': ['rack1-node01', 'rack1-node02', 'rack2-node01', 'rack2-node02'] },
+            { 'from': "login1,rack[1,3]-node[8-9],gpu[1-2]",
+                'ref': ['login1', 'rack1-node8', 'rack1-node9', 'rack3-node8', 'rack3-node9', 'gpu1', 'gpu2'] },
         ]
 
 class MyConfig():
+    def __init__(self, values=None):
+        # (section, option) -> value, everything else has its default
+        self.values = values or {}
+
     def getConfigValue(self,section,value,default=None):
-        if section == bart.slurm.SECTION and value == bart.slurm.STATEFILE_DEFAULT:
-                return bart.slurm.DEFAULT_STATEFILE_DEFAULT
-        raise Exception("getConfigValue")        
+        return self.values.get((section, value), default)
 
     def getConfigValueBool(self,section,value,default=None):
-        if section == bart.slurm.SECTION and value == bart.slurm.IDTIMESTAMP:
-                return bart.slurm.DEFAULT_IDTIMESTAMP
-        raise Exception("getConfigValue")        
+        return str(self.getConfigValue(section, value, default)).lower() in ('true', 'yes', '1')
+
+SACCT_HEADER = '|'.join(FIELDS)
+
+CAPABILITIES = { 'version': '22.05.3', 'states': [ 'cd', 'f' ], 'json': False,
+                 'noconvert': True, 'tres': [ 'cpu', 'mem', 'node' ] }
+
+def sacctEntry(job_id, user='magnus'):
+    return "%s|%s|batch|2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|snic020-11-15|5-00:00:26|00:00:10|cpu=96,node=2|t-cn[1014,1016]|2" % (job_id, user)
+
+def jobCompLine(job_id, state='COMPLETED'):
+    return ("JobId=%s UserId=magnus(1000) GroupId=users(100) Name=my job JobState=%s Partition=batch "
+            "TimeLimit=60 StartTime=2012-06-13T00:41:03 EndTime=2012-06-13T01:41:03 NodeList=t-cn[1014,1016] "
+            "NodeCnt=2 ProcCnt=96 WorkDir=/home/magnus/my dir Account=snic020-11-15 "
+            "SubmitTime=2012-06-12T17:37:43\n" % (job_id, state))
+
+class MyCheckpoint():
+    def __init__(self, slurm, records=0):
+        self.slurm = slurm
+        self.records = records
+        self.pending = 0
+        self.commits = []
+
+    def written(self, ur_file=None):
+        self.pending += 1
+        if self.records > 0 and self.pending >= self.records:
+            self.commit()
+
+    def commit(self):
+        self.pending = 0
+        self.commits.append(self.slurm.createGeneratorState())
 
 class TestSequenceFunctions(unittest.TestCase):
 
     def setUp(self):
+        # the sacct times below are local time in Sweden
+        self.addCleanup(self.restoreTimezone, os.environ.get('TZ'))
+        os.environ['TZ'] = 'Europe/Stockholm'
+        time.tzset()
+        timestamp.fromIsoStr.cache_clear()
         self.slurm = Slurm(MyConfig())
 
+    def restoreTimezone(self, tz):
+        if tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+        timestamp.fromIsoStr.cache_clear()
+
     def test_getNodes(self):
         for n in node_list_examples:
-            print self.slurm.getNodes(n['from'])
-            print n['ref']
+            print(self.slurm.getNodes(n['from']))
+            print(n['ref'])
             self.assertSetEqual(set(self.slurm.getNodes(n['from'])), set(n['ref']), "Set is not Equal")
        
     def test_createUsageRecord(self):
-        print "Testing createUsageRecord()"        
-        log_entry = "90560|1000|batch|2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|snic020-11-15|5-00:00:26|00:00:00|96|t-cn[1014,1016]".split("|");
-        log_entry2 = "90560|||2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|snic020-11-15|5-00:00:26|00:00:00|96|t-cn[1014,1016]".split("|");
+        print("Testing createUsageRecord()")        
+        log_entry = "90560|magnus|batch|2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|snic020-11-15|5-00:00:26|00:00:00|96|t-cn[1014,1016]|2".split("|");
+        log_entry2 = "90560|||2012-06-12T17:37:43|2012-06-13T00:41:03|2012-06-18T00:41:29|snic020-11-15|5-00:00:26|00:00:00|96|t-cn[1014,1016]|2".split("|");
         # log_entry, hostname, user_map, project_map, missing_user_mappings, idtimestamp)
         user_map = BartMapFile()
         project_map = BartMapFile()
@@ -76,11 +132,11 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.record_id, "hostname.example.com:90560:20120612224103", "bad record_id")
         self.assertEqual(ur.local_job_id, "90560", "bad local_job_id")
         self.assertEqual(ur.global_job_id, "hostname.example.com:90560", "bad global_job_id")
-        self.assertEqual(ur.local_user_id, getpwuid(1000)[0], "bad local_user_id")
+        self.assertEqual(ur.local_user_id, "magnus", "bad local_user_id")
         self.assertEqual(ur.global_user_name, None, "bad global_user_name")
         self.assertEqual(ur.machine_name, "hostname.example.com", "bad machine_name")
         self.assertEqual(ur.queue, "batch", "bad queue")
-        self.assertEqual(ur.processors, "96", "bad processors")
+        self.assertEqual(ur.processors, 96, "bad processors")
         self.assertEqual(ur.node_count, 2, "bad node_count")
         self.assertEqual(ur.host, "t-cn1014,t-cn1016", "bad host")
         self.assertEqual(ur.submit_time, "2012-06-12T15:37:43Z", "bad submit_time")
@@ -97,11 +153,11 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.record_id, "hostname.example.com:90560:20120612224103", "bad record_id %s" % ur.record_id)
         self.assertEqual(ur.local_job_id, "90560", "bad local_job_id")
         self.assertEqual(ur.global_job_id, "hostname.example.com:90560", "bad global_job_id")
-        self.assertEqual(ur.local_user_id, getpwuid(1000)[0], "bad local_user_id")
+        self.assertEqual(ur.local_user_id, "magnus", "bad local_user_id")
         self.assertEqual(ur.global_user_name, None, "bad global_user_name")
         self.assertEqual(ur.machine_name, "hostname.example.com", "bad machine_name")
         self.assertEqual(ur.queue, "batch", "bad queue")
-        self.assertEqual(ur.processors, "96", "bad processors")
+        self.assertEqual(ur.processors, 96, "bad processors")
         self.assertEqual(ur.node_count, 2, "bad node_count")
         self.assertEqual(ur.host, "t-cn1014,t-cn1016", "bad host")
         self.assertEqual(ur.submit_time, "2012-06-12T15:37:43Z", "bad submit_time")
@@ -115,15 +171,15 @@ class TestSequenceFunctions(unittest.TestCase):
         self.slurm.missing_user_mappings = {}
         ur = self.slurm.createUsageRecord(log_entry,'hostname.example.com',user_map,project_map)
         
-        self.assertEqual(self.slurm.missing_user_mappings, {getpwuid(1000)[0]: True}, "bad missing_user_map %s" % self.slurm.missing_user_mappings)
+        self.assertEqual(self.slurm.missing_user_mappings, {"magnus": True}, "bad missing_user_map %s" % self.slurm.missing_user_mappings)
         self.assertEqual(ur.record_id, "hostname.example.com:90560:20120612224103", "bad record_id %s" % ur.record_id)
         self.assertEqual(ur.local_job_id, "90560", "bad local_job_id")
         self.assertEqual(ur.global_job_id, "hostname.example.com:90560", "bad global_job_id")
-        self.assertEqual(ur.local_user_id, getpwuid(1000)[0], "bad local_user_id")
+        self.assertEqual(ur.local_user_id, "magnus", "bad local_user_id")
         self.assertEqual(ur.global_user_name, None, "bad global_user_name")
         self.assertEqual(ur.machine_name, "hostname.example.com", "bad machine_name")
         self.assertEqual(ur.queue, "batch", "bad queue")
-        self.assertEqual(ur.processors, "96", "bad processors")
+        self.assertEqual(ur.processors, 96, "bad processors")
         self.assertEqual(ur.node_count, 2, "bad node_count")
         self.assertEqual(ur.host, "t-cn1014,t-cn1016", "bad host")
         self.assertEqual(ur.submit_time, "2012-06-12T15:37:43Z", "bad submit_time")
@@ -134,7 +190,7 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.project_name, "snic020-11-15", "bad project_name %s" % ur.project_name)
         self.assertEqual(ur.vo_info, [], "bad vo_info %s" % ur.vo_info)
         
-        user_map.map_ = { getpwuid(1000)[0] :"magnus@hpc2n.umu.se"};
+        user_map.map_ = { "magnus" :"magnus@hpc2n.umu.se"};
         self.slurm.missing_user_mappings = {}
         ur = self.slurm.createUsageRecord(log_entry,'hostname.example.com',user_map,project_map)
         
@@ -146,7 +202,7 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.global_user_name, "magnus@hpc2n.umu.se", "bad global_user_name %s" % ur.global_user_name)
         self.assertEqual(ur.machine_name, "hostname.example.com", "bad machine_name")
         self.assertEqual(ur.queue, "batch", "bad queue")
-        self.assertEqual(ur.processors, "96", "bad processors")
+        self.assertEqual(ur.processors, 96, "bad processors")
         self.assertEqual(ur.node_count, 2, "bad node_count")
         self.assertEqual(ur.host, "t-cn1014,t-cn1016", "bad host")
         self.assertEqual(ur.submit_time, "2012-06-12T15:37:43Z", "bad submit_time")
@@ -157,7 +213,7 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.project_name, "snic020-11-15", "bad project_name %s" % ur.project_name)
         self.assertEqual(ur.vo_info, [], "bad vo_info %s" % ur.vo_info)
         
-        user_map.map_ = { getpwuid(1000)[0] :"magnus@hpc2n.umu.se"}
+        user_map.map_ = { "magnus" :"magnus@hpc2n.umu.se"}
         project_map.map_ = {"snic020-11-15":"foo"}
         self.slurm.missing_user_mappings = {}
         ur = self.slurm.createUsageRecord(log_entry,'hostname.example.com',user_map,project_map)
@@ -166,11 +222,11 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.record_id, "hostname.example.com:90560:20120612224103", "bad record_id %s" % ur.record_id)
         self.assertEqual(ur.local_job_id, "90560", "bad local_job_id")
         self.assertEqual(ur.global_job_id, "hostname.example.com:90560", "bad global_job_id")
-        self.assertEqual(ur.local_user_id, getpwuid(1000)[0], "bad local_user_id")
+        self.assertEqual(ur.local_user_id, "magnus", "bad local_user_id")
         self.assertEqual(ur.global_user_name, "magnus@hpc2n.umu.se", "bad global_user_name %s" % ur.global_user_name)
         self.assertEqual(ur.machine_name, "hostname.example.com", "bad machine_name")
         self.assertEqual(ur.queue, "batch", "bad queue")
-        self.assertEqual(ur.processors, "96", "bad processors")
+        self.assertEqual(ur.processors, 96, "bad processors")
         self.assertEqual(ur.node_count, 2, "bad node_count")
         self.assertEqual(ur.host, "t-cn1014,t-cn1016", "bad host")
         self.assertEqual(ur.submit_time, "2012-06-12T15:37:43Z", "bad submit_time")
@@ -179,20 +235,346 @@ class TestSequenceFunctions(unittest.TestCase):
         self.assertEqual(ur.cpu_duration, 0, "bad cpu_duration %s" % ur.cpu_duration)
         self.assertEqual(ur.wall_duration, 432026, "bad wall_duration %s" % ur.wall_duration)
         self.assertEqual(ur.project_name, "snic020-11-15", "bad project_name %s" % ur.project_name)
-        self.assertEqual(ur.vo_info[0].type, "lrmsurgen-projectmap", "bad vo_info.type %s" % ur.vo_info[0].type)
+        self.assertEqual(ur.vo_info[0].type_, "lrmsurgen-projectmap", "bad vo_info.type_ %s" % ur.vo_info[0].type_)
         self.assertEqual(ur.vo_info[0].name, "foo", "bad vo_info.name %s" % ur.vo_info[0].name)
 
-        user_map.map_ = { getpwuid(1000)[0] :"magnus@hpc2n.umu.se"}
+        user_map.map_ = { "magnus" :"magnus@hpc2n.umu.se"}
         project_map.map_ = {"snic020-11-15":"foo"}
         self.slurm.missing_user_mappings = {}
         ur = self.slurm.createUsageRecord(log_entry2,'hostname.example.com',user_map,project_map)
         self.assertIsNone(ur,"Should never return !None")
         
+    def test_versioncmp(self):
+        self.assertEqual(versioncmp("17.11.0", "17.11.0"), 0)
+        self.assertEqual(versioncmp("17.11.1", "17.11.0"), 1)
+        self.assertEqual(versioncmp("17.2.0", "17.11.0"), -1)
+        self.assertEqual(versioncmp("17.11", "17.11.0"), -1)
+        self.assertEqual(versioncmp("17.11.0-1", "17.11.0"), 1)
+
+    def test_planQuery(self):
+        capabilities = { 'version': '22.05.3', 'states': [ 'cd', 'f', 'oom' ], 'json': True,
+                         'noconvert': True, 'tres': [ 'cpu', 'mem', 'node', 'billing' ] }
+        plan = planQuery(capabilities, STEPS_SKIP, False)
+        self.assertEqual(plan['fields'][ALLOC_TRES_INDEX], 'AllocCPUS')
+        self.assertEqual(plan['options'], '--duplicates --allocations --noconvert --parsable2')
+        self.assertEqual(plan['states'], 'cd,f,oom')
+
+        plan = planQuery(capabilities, STEPS_AGGREGATE, True)
+        self.assertEqual(plan['fields'], FIELDS + STEP_FIELDS)
+        self.assertEqual(plan['options'], '--duplicates --noconvert --parsable2')
+
+        capabilities['tres'].append('gres/gpu')
+        capabilities['noconvert'] = False
+        plan = planQuery(capabilities, STEPS_SKIP, False)
+        self.assertEqual(plan['fields'], FIELDS)
+        self.assertEqual(plan['options'], '--duplicates --allocations --parsable2')
+
+    def test_alloc_resources(self):
+        log_entry = sacctEntry(1).split('|')
+        log_entry[9] = 'cpu=4,mem=8G,node=1,gres/gpu=2'
+        # off by default, only the GPUs are reported as before
+        ur = self.slurm.createUsageRecord(log_entry, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual((ur.gpus, ur.alloc_res), (2, {}))
+
+        slurm = Slurm(MyConfig({ (SECTION, ALLOC_RESOURCES): 'true' }))
+        ur = slurm.createUsageRecord(log_entry, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual(ur.alloc_res, { 'cpu': 4, 'mem': 8192, 'node': 1, 'gres/gpu': 2 })
+
+        # a record's TRES can be changed without changing those of other jobs
+        ur.alloc_res['mem'] = 1
+        ur = slurm.createUsageRecord(log_entry, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual(ur.alloc_res['mem'], 8192)
+
+    def test_aggregateSteps(self):
+        def entry(job_id, user_cpu, system_cpu, max_rss):
+            fields = (sacctEntry(job_id) + '|%s|%s' % (system_cpu, max_rss)).split('|')
+            fields[8] = user_cpu
+            return fields
+
+        entries = [ entry('10', '00:00:10', '00:00:02', ''),
+                    entry('10.batch', '00:01:00', '00:00:05', '2048K'),
+                    entry('10.0', '00:02:00', '00:00:10', '1M'),
+                    entry('11', '00:00:30', '00:00:03', '') ]
+        jobs = list(aggregateSteps(entries))
+        self.assertEqual([ job[0] for job in jobs ], [ '10', '11' ])
+        self.assertEqual(jobs[0][-1], { 'steps': 2, 'user_cpu': 180, 'system_cpu': 15, 'max_rss': 2048 * 1024 })
+        self.assertEqual(jobs[1][-1]['steps'], 0)
+
+        self.slurm.missing_user_mappings = {}
+        ur = self.slurm.createUsageRecord(jobs[0], 'host', BartMapFile(), BartMapFile())
+        self.assertEqual((ur.user_time, ur.kernel_time, ur.cpu_duration, ur.memory), (180, 15, 195, 2048))
+        # without steps, the times of the allocation are used
+        ur = self.slurm.createUsageRecord(jobs[1], 'host', BartMapFile(), BartMapFile())
+        self.assertEqual((ur.user_time, ur.kernel_time, ur.cpu_duration), (30, 3, 33))
+
+    def test_aggregateSteps_invalid(self):
+        def entry(job_id, user_cpu, system_cpu='00:00:01'):
+            fields = (sacctEntry(job_id) + '|%s|' % system_cpu).split('|')
+            fields[8] = user_cpu
+            return fields
+
+        # an unparsable cpu time counts as 0, a step out of order is left out
+        entries = [ entry('12', '00:00:10'),
+                    entry('12.batch', 'INVALID'),
+                    entry('12.0', ' 00:01:00', ''),
+                    entry('13', '00:00:30'),
+                    entry('12.1', '00:05:00') ]
+        with self.assertLogs(level='WARNING') as logs:
+            jobs = list(aggregateSteps(entries))
+        self.assertEqual([ job[0] for job in jobs ], [ '12', '13' ])
+        self.assertEqual(jobs[0][-1], { 'steps': 2, 'user_cpu': 60, 'system_cpu': 1, 'max_rss': 0 })
+        self.assertEqual(jobs[1][-1]['steps'], 0)
+        warnings = [ line for line in logs.output if line.startswith('WARNING') ]
+        self.assertEqual(len(warnings), 2)
+        self.assertIn('12.batch: Invalid cpu time INVALID', warnings[0])
+        self.assertIn('12.1 does not follow', warnings[1])
+
     def test_state_file(self):
-        print "Testing: state file"
+        print("Testing: state file")
         self.slurm.parseGeneratorState(None)
         self.assertIsNotNone(self.slurm.state,"Should never return None")
         
         
+class TestSacct(unittest.TestCase):
+    """
+    Runs the sacct backends on canned sacct output, by replacing the sacct
+    command line with one that prints it.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.values = { (bart.config.SECTION_COMMON, bart.config.LOGDIR): self.tmp_dir,
+                        (bart.config.SECTION_COMMON, bart.config.STATEDIR): self.tmp_dir,
+                        (bart.config.SECTION_COMMON, bart.config.WRITER_THREADS): '0',
+                        (SECTION, MAX_DAYS): '0' }
+        self.slurm = Slurm(MyConfig(self.values))
+        self.slurm.missing_user_mappings = {}
+        self.slurm.state = '2012-06-12T00:00:00'
+        self.slurm.checkpoint = MyCheckpoint(self.slurm)
+
+    def sacctOutput(self, name, entries, status=0):
+        """
+        Return a command printing the sacct output, exiting with status.
+        """
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join([ SACCT_HEADER ] + entries) + '\n')
+        return 'cat %s; exit %d' % (path, status)
+
+    def written(self):
+        """
+        Return the job ids of the written usage records.
+        """
+        urs = os.path.join(self.tmp_dir, 'urs')
+        if not os.path.isdir(urs):
+            return []
+        return sorted( name.split(':')[1] for name in os.listdir(urs) )
+
+    def generate(self, commands):
+        """
+        Run generateSacctUsageRecords, with commands mapping the start time of
+        each sacct query to its command. Other queries find nothing.
+        """
+        empty = self.sacctOutput('empty', [])
+        def sacctCommand(starttime, endtime, user_list, plan):
+            return commands.get(starttime, empty)
+
+        self.slurm.createCheckpointManager = lambda: self.slurm.checkpoint
+        with mock.patch('bart.slurm.sacctCommand', sacctCommand), \
+             mock.patch('bart.slurm.getCapabilities', lambda cfg: CAPABILITIES):
+            return self.slurm.generateSacctUsageRecords('host', BartMapFile(), BartMapFile())
+
+    def test_streamCommand(self):
+        self.assertEqual(list(streamCommand("printf 'a\\n\\nb|c\\n'")), [ 'a', '', 'b|c' ])
+        lines = streamCommand("echo a; exit 3")
+        self.assertEqual(next(lines), 'a')
+        self.assertRaises(IOError, next, lines)
+
+    def test_SlurmBackend(self):
+        command = self.sacctOutput('sacct', [ sacctEntry(1), '', sacctEntry(2) ])
+        with mock.patch('bart.slurm.sacctCommand', lambda *args: command):
+            tlp = SlurmBackend('2012-06-12T00:00:00', 0, None, None)
+            windows = list(tlp.getWindows())
+            self.assertEqual(len(windows), 1)
+            entries = list(windows[0][1])
+        self.assertEqual([ entry[0] for entry in entries ], [ '1', '2' ])
+        self.assertEqual(len(entries[0]), len(FIELDS))
+
+    def test_spoolCommand(self):
+        spool = spoolCommand("printf 'a\\nb\\n'")
+        self.assertEqual(spool.read(), b'a\nb\n')
+        spool.close()
+        self.assertRaises(IOError, spoolCommand, "echo a; exit 1")
+
+    def test_SlurmWindowBackend_windows(self):
+        start = (datetime.datetime.now() - datetime.timedelta(hours=50)).replace(microsecond=0).isoformat()
+        tlp = SlurmWindowBackend(start, 24, 2, None, None)
+        self.assertEqual(len(tlp.windows), 3)
+        self.assertEqual(tlp.windows[0][0], start)
+        for (_, end), (next_start, _) in zip(tlp.windows, tlp.windows[1:]):
+            self.assertEqual(end, next_start, "Windows not contiguous")
+        self.assertEqual(tlp.end_str, tlp.windows[-1][1])
+
+    def windowCommands(self, failing=None):
+        # the first window is the slowest to fetch, it is still written first
+        commands = {
+            '2012-06-12T00:00:00': 'sleep 0.2; ' + self.sacctOutput('w1', [ sacctEntry(1), sacctEntry(2) ]),
+            '2012-06-13T00:00:00': self.sacctOutput('w2', [ sacctEntry(3) ], status=1 if failing == 2 else 0),
+            '2012-06-14T00:00:00': self.sacctOutput('w3', [ sacctEntry(4) ]),
+        }
+        return lambda starttime, endtime, user_list, plan: commands[starttime]
+
+    WINDOWS = [ ('2012-06-12T00:00:00', '2012-06-13T00:00:00'),
+                ('2012-06-13T00:00:00', '2012-06-14T00:00:00'),
+                ('2012-06-14T00:00:00', '2012-06-15T00:00:00') ]
+
+    def test_writeWindows_windows(self):
+        with mock.patch('bart.slurm.sacctCommand', self.windowCommands()):
+            tlp = SlurmWindowBackend(self.slurm.state, 24, 3, None, None, windows=self.WINDOWS)
+            count, matched = self.slurm.writeWindows(tlp, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual((count, matched), (4, True))
+        self.assertEqual(self.written(), [ '1', '2', '3', '4' ])
+        self.assertEqual(self.slurm.checkpoint.commits, [ end for _, end in self.WINDOWS ])
+
+    def test_writeWindows_window_failure(self):
+        with mock.patch('bart.slurm.sacctCommand', self.windowCommands(failing=2)):
+            tlp = SlurmWindowBackend(self.slurm.state, 24, 3, None, None, windows=self.WINDOWS)
+            self.assertRaises(IOError, self.slurm.writeWindows, tlp, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual(self.written(), [ '1', '2' ])
+        self.assertEqual(self.slurm.checkpoint.commits, [ '2012-06-13T00:00:00' ])
+        self.assertEqual(self.slurm.state, '2012-06-13T00:00:00')
+
+    def test_writeWindows_empty_windows(self):
+        empty = self.sacctOutput('empty', [])
+        commands = { '2012-06-14T00:00:00': self.sacctOutput('w3', [ sacctEntry(4), sacctEntry(5) ]) }
+        sacctCommand = lambda starttime, endtime, user_list, plan: commands.get(starttime, empty)
+
+        # interrupted after the first record of the third window
+        self.slurm.checkpoint = MyCheckpoint(self.slurm, records=1)
+        with mock.patch('bart.slurm.sacctCommand', sacctCommand):
+            tlp = SlurmWindowBackend(self.slurm.state, 24, 3, None, None, windows=self.WINDOWS)
+            self.slurm.writeWindows(tlp, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual(self.slurm.checkpoint.commits[0], '2012-06-14T00:00:00 2012-06-15T00:00:00 1 4')
+
+        # resuming queries only that window, and writes the rest of it
+        for name in os.listdir(os.path.join(self.tmp_dir, 'urs')):
+            os.unlink(os.path.join(self.tmp_dir, 'urs', name))
+        self.slurm.state, self.slurm.resume = self.slurm.parseSacctState(self.slurm.checkpoint.commits[0])
+        self.slurm.checkpoint = MyCheckpoint(self.slurm)
+        self.assertEqual(self.generate(commands), 1)
+        self.assertEqual(self.written(), [ '5' ])
+
+    def test_SlurmJobCompParser(self):
+        log_file = os.path.join(self.tmp_dir, 'jobcomp.log')
+        with open(log_file, 'w') as f:
+            f.write(jobCompLine(1) + jobCompLine(2, 'RUNNING') + jobCompLine(3) + 'JobId=4 UserId')
+
+        jlp = SlurmJobCompParser(log_file)
+        entries = list(jlp.getSacctEntries())
+        self.assertEqual([ entry[0] for entry in entries ], [ '1', '3' ])
+        self.assertEqual(entries[0][1:3], [ 'magnus', 'batch' ])
+        self.assertEqual(entries[0][7], '1:00:00')
+        self.assertEqual(entries[0][10:], [ 't-cn[1014,1016]', '2' ])
+        # the incomplete last line is left for the next run
+        self.assertEqual(jlp.offset, os.path.getsize(log_file) - len('JobId=4 UserId'))
+        state = (jlp.inode, jlp.offset)
+
+        # the log is rotated after the entry is completed
+        with open(log_file, 'a') as f:
+            f.write(jobCompLine(4)[len('JobId=4 UserId'):])
+        os.rename(log_file, log_file + '.1')
+        with open(log_file, 'w') as f:
+            f.write(jobCompLine(5))
+
+        jlp = SlurmJobCompParser(log_file, *state)
+        self.assertEqual([ entry[0] for entry in jlp.getSacctEntries() ], [ '4', '5' ])
+        self.assertEqual((jlp.inode, jlp.offset), (os.stat(log_file).st_ino, os.path.getsize(log_file)))
+
+        jlp = SlurmJobCompParser(log_file, jlp.inode, jlp.offset)
+        self.assertEqual(list(jlp.getSacctEntries()), [])
+
+    def test_getCapabilities(self):
+        probes = []
+        def probe():
+            probes.append(1)
+            return CAPABILITIES
+
+        cfg = MyConfig(self.values)
+        with mock.patch('bart.slurm.probeCapabilities', probe):
+            self.assertEqual(getCapabilities(cfg), CAPABILITIES)
+            self.assertEqual(getCapabilities(cfg), CAPABILITIES)
+            self.assertEqual(len(probes), 1, "Cache not used")
+
+            # concurrent probes each write their own temporary file
+            self.values[(SECTION, CAPABILITIES_TTL)] = '0'
+            executor = futures.ThreadPoolExecutor(max_workers=8)
+            results = list(executor.map(lambda _: getCapabilities(cfg), range(16)))
+            executor.shutdown()
+        self.assertEqual(results, [ CAPABILITIES ] * 16)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), [ CAPABILITIES_FILE ])
+
+    def test_generateMultiClusterUsageRecords(self):
+        self.values[(SECTION, CLUSTERS)] = 'a:a.example.org,b'
+        slurm = Slurm(MyConfig(self.values))
+        slurm.missing_user_mappings = {}
+        slurm.parseGeneratorState('a=2012-06-12T00:00:00;b=2012-06-12T00:00:00')
+
+        commands = { '--clusters=a': self.sacctOutput('a', [ sacctEntry(1), sacctEntry(2) ]),
+                     '--clusters=b': self.sacctOutput('b', [ sacctEntry(3, 'erik') ]) }
+        empty = self.sacctOutput('empty', [])
+        def sacctCommand(starttime, endtime, user_list, plan):
+            if starttime != '2012-06-12T00:00:00':
+                return empty
+            return commands[plan['options'].split()[-1]]
+
+        # the workers are forked, and inherit the patches
+        with mock.patch('bart.slurm.sacctCommand', sacctCommand), \
+             mock.patch('bart.slurm.getCapabilities', lambda cfg: CAPABILITIES):
+            slurm.generateMultiClusterUsageRecords(BartMapFile(), BartMapFile())
+
+        urs = sorted(os.listdir(os.path.join(self.tmp_dir, 'urs')))
+        self.assertEqual([ name.rsplit(':', 1)[0] for name in urs ],
+                         [ 'a.example.org:1', 'a.example.org:2', 'b:3' ])
+        self.assertEqual(sorted(slurm.missing_user_mappings), [ 'erik', 'magnus' ])
+
+        with open(os.path.join(self.tmp_dir, DEFAULT_STATEFILE)) as f:
+            state = f.read()
+        cluster_states = dict( item.split('=') for item in state.split(';') )
+        self.assertEqual(sorted(cluster_states), [ 'a', 'b' ])
+        for cluster_state in cluster_states.values():
+            self.assertTrue(cluster_state > '2012-06-12T00:00:00', "State not advanced %s" % state)
+
+    def test_writeWindows_failure(self):
+        command = self.sacctOutput('sacct', [ sacctEntry(1), sacctEntry(2) ], status=1)
+        with mock.patch('bart.slurm.sacctCommand', lambda *args: command):
+            tlp = SlurmBackend('2012-06-12T00:00:00', 0, None, None)
+            self.assertRaises(IOError, self.slurm.writeWindows, tlp, 'host', BartMapFile(), BartMapFile())
+        self.assertEqual(self.slurm.state, '2012-06-12T00:00:00', "State advanced past a failed window")
+        self.assertEqual(self.slurm.checkpoint.commits, [])
+
+    def test_resume(self):
+        command = self.sacctOutput('sacct', [ sacctEntry(1), sacctEntry(2), sacctEntry(3) ])
+        self.slurm.resume = ('2012-06-13T00:00:00', 1, '1')
+        self.assertEqual(self.generate({ '2012-06-12T00:00:00': command }), 2)
+        self.assertEqual(self.written(), [ '2', '3' ])
+        self.assertEqual(self.slurm.checkpoint.commits[0], '2012-06-13T00:00:00')
+        self.assertEqual(self.slurm.resume, None)
+
+    def test_resume_changed(self):
+        # the entry at the resume position is not the expected job
+        command = self.sacctOutput('sacct', [ sacctEntry(1), sacctEntry(2) ])
+        self.slurm.resume = ('2012-06-13T00:00:00', 1, '7')
+        self.assertEqual(self.generate({ '2012-06-12T00:00:00': command }), 2)
+        self.assertEqual(self.written(), [ '1', '2' ])
+
+    def test_resume_failure(self):
+        command = self.sacctOutput('sacct', [ sacctEntry(1), sacctEntry(2) ], status=1)
+        self.slurm.resume = ('2012-06-13T00:00:00', 1, '1')
+        self.assertRaises(IOError, self.generate, { '2012-06-12T00:00:00': command })
+        self.assertEqual(self.slurm.state, '2012-06-12T00:00:00', "State advanced past a failed window")
+        self.assertEqual(self.slurm.resume, ('2012-06-13T00:00:00', 1, '1'))
+        self.assertEqual(self.slurm.checkpoint.commits, [])
+        self.assertEqual(self.written(), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import unittest
+
+import sys
+sys.path.append("..")
+
+from bart import common, timestamp
+from bart.usagerecord import usagerecord
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(self.restoreTimezone, os.environ.get('TZ'))
+        os.environ['TZ'] = 'Europe/Stockholm'
+        time.tzset()
+        timestamp.fromIsoStr.cache_clear()
+
+    def restoreTimezone(self, tz):
+        if tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = tz
+        time.tzset()
+        timestamp.fromIsoStr.cache_clear()
+
+    def test_fromIsoStr(self):
+        for iso_str in ("2012-06-12T17:37:43", "2012-03-25T02:30:00", "2012-10-28T02:30:00", "2012-06-12T17:37:43.123"):
+            epoch = time.mktime(common.datetimeFromIsoStr(iso_str).timetuple())
+            ts = timestamp.fromIsoStr(iso_str)
+            self.assertEqual(ts.epoch, int(epoch), "bad epoch for %s" % iso_str)
+            self.assertEqual(ts.ur_time, usagerecord.epoch2isoTime(epoch), "bad ur_time for %s" % iso_str)
+            self.assertEqual(ts.id_time, re.sub("[-:TZ]", "", usagerecord.epoch2isoTime(epoch)), "bad id_time for %s" % iso_str)
+
+    def test_fromEpoch(self):
+        ts = timestamp.fromEpoch("1339522663")
+        self.assertEqual(ts, (1339522663, "2012-06-12T17:37:43Z", "20120612173743"))
+        self.assertIs(timestamp.fromEpoch(1339522663), ts, "conversion not cached")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import sys
+sys.path.append("..")
+
+from bart.torque import *
+from bart.config import BartMapFile
+from bart import common, filewatch
+import bart.config
+import bart.torque
+
+LOG_LINES = [
+    "06/12/2012 17:37:40;Q;4711.server;queue=batch",
+    "06/12/2012 17:37:41;S;4711.server;user=magnus group=users jobname=test queue=batch ctime=1339515460 exec_host=n1/0",
+    "06/12/2012 17:37:42;D;4712.server;requestor=magnus@server comment=job;E;in a value",
+    "06/12/2012 17:37:43;E;4711.server;user=magnus group=users jobname=test queue=batch ctime=1339515460 qtime=1339515460 etime=1339515460 start=1339515461 owner=magnus@server exec_host=n1/0+n1/1+n2/0 Resource_List.nodes=2:ppn=2 Resource_List.walltime=01:00:00 session=1234 end=1339522663 Exit_status=0 resources_used.cput=00:10:00 resources_used.mem=1024kb resources_used.vmem=2048kb resources_used.walltime=02:00:03",
+    "06/12/2012 17:38:00;E;4713.server;user=erik queue=long ctime=1339515460 start=1339515461 end=1339522663 exec_host=n3/0 Resource_List.ncpus=8 Exit_status=1 resources_used.cput=100:00:00 resources_used.walltime=02:00:02",
+    "short line",
+]
+
+class MyConfig():
+    def __init__(self, compress_hosts='false', values=None):
+        self.compress_hosts = compress_hosts
+        # (section, option) -> value, everything else has its default
+        self.values = values or {}
+
+    def getConfigValue(self, section, value, default=None):
+        return self.values.get((section, value), default)
+
+    def getConfigValueBool(self, section, value, default=None):
+        if section == bart.torque.SECTION and value == bart.torque.COMPRESS_HOSTS:
+            return self.compress_hosts == 'true'
+        raise Exception("getConfigValueBool")
+
+def writeLog(log_file, data, mode='w'):
+    with open(log_file, mode) as f:
+        f.write(data)
+
+def readFile(path):
+    with open(path) as f:
+        return f.read()
+
+def endLine(job_id):
+    return LOG_LINES[4].replace('4713.server', '%s.server' % job_id) + '\n'
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, '20120612')
+        writeLog(self.log_file, '\n'.join(LOG_LINES) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_getNextLogEntry(self):
+        tlp = TorqueLogParser(self.log_file)
+        entry = tlp.getNextLogEntry()
+        self.assertEqual(entry['jobid'], '4711.server')
+        self.assertEqual(entry['user'], 'magnus')
+        self.assertEqual(entry['exec_host'], 'n1/0+n1/1+n2/0')
+        self.assertEqual(entry['resources_used.walltime'], '02:00:03')
+        self.assertTrue('Resource_List.nodes' in entry)
+        self.assertFalse('Resource_List.ncpus' in entry)
+        self.assertEqual(entry.get('account'), None)
+        self.assertRaises(KeyError, lambda: entry['account'])
+
+        entry = tlp.getNextLogEntry()
+        self.assertEqual(entry['jobid'], '4713.server')
+        self.assertEqual(tlp.getNextLogEntry(), None)
+        tlp.close()
+
+    def test_partial_line(self):
+        writeLog(self.log_file, LOG_LINES[3].replace('4711', '4714'), 'a')
+        tlp = TorqueLogParser(self.log_file)
+        self.assertEqual([ tlp.getNextLogEntry()['jobid'] for _ in range(2) ], [ '4711.server', '4713.server' ])
+        self.assertEqual(tlp.getNextLogEntry(), None)
+        tlp.close()
+
+    def test_empty_file(self):
+        writeLog(self.log_file, '')
+        tlp = TorqueLogParser(self.log_file)
+        self.assertEqual(tlp.getNextLogEntry(), None)
+        tlp.close()
+
+    def test_refresh(self):
+        writeLog(self.log_file, '')
+        tlp = TorqueLogParser(self.log_file)
+        self.assertEqual(tlp.getNextLogEntry(), None)
+
+        writeLog(self.log_file, LOG_LINES[3] + '\n' + LOG_LINES[4][:40], 'a')
+        tlp.refresh()
+        self.assertEqual(tlp.getNextLogEntry()['jobid'], '4711.server')
+        self.assertEqual(tlp.getNextLogEntry(), None)
+
+        # the rest of the partially written line
+        writeLog(self.log_file, LOG_LINES[4][40:] + '\n', 'a')
+        tlp.refresh()
+        self.assertEqual(tlp.getNextLogEntry()['jobid'], '4713.server')
+        self.assertEqual(tlp.getNextLogEntry(), None)
+        tlp.close()
+
+    def test_watcher(self):
+        watcher = filewatch.getWatcher(self.tmp_dir, poll_interval=0.01)
+        try:
+            if isinstance(watcher, filewatch.InotifyWatcher):
+                self.assertFalse(watcher.wait(0.01))
+            writeLog(os.path.join(self.tmp_dir, '20120613'), LOG_LINES[3] + '\n')
+            self.assertTrue(watcher.wait(1))
+        finally:
+            watcher.close()
+
+    def test_resumeAfterEntry(self):
+        tlp = TorqueLogParser(self.log_file)
+        tlp.getNextLogEntry()
+        inode, offset = tlp.inode, tlp.entry_offset
+        tlp.close()
+
+        tlp = TorqueLogParser(self.log_file)
+        self.assertTrue(tlp.resumeAfterEntry('4711.server', inode, offset))
+        self.assertEqual(tlp.getNextLogEntry()['jobid'], '4713.server')
+        tlp.close()
+
+        # wrong offset, found by searching for the job id
+        tlp = TorqueLogParser(self.log_file)
+        self.assertTrue(tlp.resumeAfterEntry('4711.server', inode, 0))
+        self.assertEqual(tlp.getNextLogEntry()['jobid'], '4713.server')
+        tlp.close()
+
+        # unknown job, start from the beginning
+        tlp = TorqueLogParser(self.log_file)
+        self.assertFalse(tlp.resumeAfterEntry('4799.server', None, None))
+        self.assertEqual(tlp.getNextLogEntry()['jobid'], '4711.server')
+        tlp.close()
+
+    def test_generatorState(self):
+        torque = Torque(MyConfig())
+        torque.parseGeneratorState('4711.server 20120612')
+        self.assertEqual((torque.state_job_id, torque.state_inode, torque.state_offset), ('4711.server', None, None))
+        self.assertEqual(torque.createGeneratorState(), '4711.server 20120612')
+        torque.parseGeneratorState('4711.server 20120612 1234 5678')
+        self.assertEqual((torque.state_log_file, torque.state_inode, torque.state_offset), ('20120612', 1234, 5678))
+        self.assertEqual(torque.createGeneratorState(), '4711.server 20120612 1234 5678')
+
+    def test_compressed(self):
+        data = ('\n'.join(LOG_LINES) + '\n').encode('utf-8')
+        tlp = TorqueLogParser(self.log_file)
+        tlp.getNextLogEntry()
+        offset = tlp.entry_offset
+        tlp.close()
+        os.remove(self.log_file)
+
+        chunk_size = bart.torque.CHUNK_SIZE
+        bart.torque.CHUNK_SIZE = 7
+        try:
+            for suffix, opener in ( ('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open) ):
+                with opener(self.log_file + suffix, 'wb') as f:
+                    f.write(data)
+
+                tlp = TorqueLogParser(self.log_file)
+                self.assertEqual([ tlp.getNextLogEntry()['jobid'] for _ in range(2) ], [ '4711.server', '4713.server' ])
+                self.assertEqual(tlp.getNextLogEntry(), None)
+                tlp.close()
+
+                # the offset of the uncompressed file is still valid
+                tlp = TorqueLogParser(self.log_file)
+                self.assertTrue(tlp.resumeAfterEntry('4711.server', None, offset))
+                self.assertEqual(tlp.getNextLogEntry()['jobid'], '4713.server')
+                tlp.close()
+
+                os.remove(self.log_file + suffix)
+        finally:
+            bart.torque.CHUNK_SIZE = chunk_size
+
+    def spoolConfig(self, spool_dir, workers=1):
+        """
+        Return a config with the accounting logs and the spool in spool_dir.
+        """
+        accounting_dir = os.path.join(spool_dir, 'server_priv', 'accounting')
+        if not os.path.isdir(accounting_dir):
+            os.makedirs(accounting_dir)
+        return MyConfig(values={ (bart.torque.SECTION, bart.torque.SPOOL_DIR): spool_dir,
+                                 (bart.torque.SECTION, bart.torque.BACKFILL_WORKERS): str(workers),
+                                 (bart.config.SECTION_COMMON, bart.config.LOGDIR): os.path.join(spool_dir, 'urs'),
+                                 (bart.config.SECTION_COMMON, bart.config.STATEDIR): spool_dir,
+                                 (bart.config.SECTION_COMMON, bart.config.WRITER_THREADS): '0' })
+
+    def test_backfill(self):
+        results = []
+        for workers in (1, 3):
+            spool_dir = os.path.join(self.tmp_dir, 'spool%d' % workers)
+            torque = Torque(self.spoolConfig(spool_dir, workers))
+            for day in range(12, 17):
+                writeLog(os.path.join(torque.getAccountingDir(), '201206%02d' % day),
+                         endLine(day * 100 + 1) + endLine(day * 100 + 2))
+            torque.parseGeneratorState('1201.server 20120612')
+            torque.generateUsageRecords('server', BartMapFile(), BartMapFile())
+
+            urs = sorted(os.listdir(os.path.join(spool_dir, 'urs', 'urs')))
+            state = readFile(os.path.join(spool_dir, torque.getStateFile()))
+            results.append((urs, state.split()[:2]))
+
+        # the complete days in between are read by 3 workers, with the same result
+        self.assertEqual(results[0][0], [ 'server:%d.server' % job for day in range(12, 17)
+                                          for job in (day * 100 + 1, day * 100 + 2) if job != 1201 ])
+        self.assertEqual(results[0][1], [ '1602.server', '20120616' ])
+        self.assertEqual(results[1], results[0])
+
+    def test_followUsageRecords(self):
+        spool_dir = os.path.join(self.tmp_dir, 'spool')
+        torque = Torque(self.spoolConfig(spool_dir))
+        log_dir = torque.getAccountingDir()
+        writeLog(os.path.join(log_dir, '20120612'), endLine(4711))
+        torque.parseGeneratorState('- 20120612')
+
+        today = [ '20120612' ]
+        strftime = time.strftime
+        def todayStrftime(fmt, t=None):
+            if fmt == TORQUE_DATE_FORMAT:
+                return today[0]
+            return strftime(fmt, t) if t is not None else strftime(fmt)
+
+        # each wait is a change in the accounting directory
+        def firstChange():
+            writeLog(os.path.join(log_dir, '20120612'), endLine(4712), 'a')
+        def midnight():
+            writeLog(os.path.join(log_dir, '20120612'), endLine(4713), 'a')
+            writeLog(os.path.join(log_dir, '20120613'), endLine(4714))
+            today[0] = '20120613'
+        def stop():
+            raise KeyboardInterrupt()
+
+        changes = [ firstChange, midnight, stop ]
+        watcher = mock.Mock()
+        watcher.wait.side_effect = lambda timeout: changes.pop(0)()
+
+        with mock.patch('bart.torque.time.strftime', todayStrftime), \
+             mock.patch('bart.torque.filewatch.getWatcher', return_value=watcher):
+            self.assertRaises(KeyboardInterrupt, torque.followUsageRecords, 'server', BartMapFile(), BartMapFile())
+
+        self.assertEqual(sorted(os.listdir(os.path.join(spool_dir, 'urs', 'urs'))),
+                         [ 'server:%d.server' % job for job in (4711, 4712, 4713, 4714) ])
+        # the old day file was read to its end before moving on
+        self.assertEqual(watcher.wait.call_count, 3)
+        self.assertTrue(watcher.close.called)
+        state = readFile(os.path.join(spool_dir, torque.getStateFile()))
+        self.assertEqual(state.split()[:2], [ '4714.server', '20120613' ])
+
+    def test_getLogFileDates(self):
+        for name in [ '20120610', '20120613', '20120611.gz', '20120611', '20120620', 'notes.txt' ]:
+            writeLog(os.path.join(self.tmp_dir, name), '')
+        self.assertEqual(common.getLogFileDates(self.tmp_dir, '20120611', '20120619', TORQUE_DATE_FORMAT),
+                         [ '20120611', '20120612', '20120613' ])
+        self.assertEqual(common.getLogFileDates(self.tmp_dir, '20120621', '20120622', TORQUE_DATE_FORMAT), [])
+
+    def test_createUsageRecord(self):
+        torque = Torque(MyConfig())
+        torque.missing_user_mappings = {}
+        tlp = TorqueLogParser(self.log_file)
+        ur = torque.createUsageRecord(tlp.getNextLogEntry(), 'server.example.com', BartMapFile(), BartMapFile())
+        self.assertEqual(ur.record_id, 'server.example.com:4711.server')
+        self.assertEqual(ur.processors, 4)
+        self.assertEqual(ur.node_count, 2)
+        self.assertEqual(sorted(ur.host.split(',')), [ 'n1', 'n2' ])
+        self.assertEqual(ur.cpu_duration, 600)
+        self.assertEqual(ur.wall_duration, 7203)
+        self.assertEqual(ur.exit_code, '0')
+
+        ur = torque.createUsageRecord(tlp.getNextLogEntry(), 'server.example.com', BartMapFile(), BartMapFile())
+        self.assertEqual(ur.processors, 8)
+        self.assertEqual(ur.cpu_duration, 360000)
+        tlp.close()
+
+    def test_getResources(self):
+        resources = getResources('n01/0+n01/1+n02/0+n03/0+login/0', nodes='3:ppn=2')
+        self.assertEqual(resources, ('n01,n02,n03,login', 4, 6, None))
+        resources = getResources('n01/0+n01/1+n02/0+n03/0+login/0', nodes='3:ppn=2', compress_hosts=True)
+        self.assertEqual(resources.host, 'n[01-03],login')
+        resources = getResources('c1/0+c2/0', mppwidth='64', mppnppn='32')
+        self.assertEqual(resources.node_count, 2)
+        self.assertEqual(resources.core_count, 64)
+        self.assertNotEqual(resources.warning, None)
+        resources = getResources('c1/0+c2/0')
+        self.assertEqual((resources.node_count, resources.core_count), (2, 2))
+        self.assertIs(getResources('c1/0+c2/0'), resources)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import sys
+sys.path.append("..")
+
+from bart import tres
+from bart.usagerecord import usagerecord
+from bart.usagerecord import urelements as ur
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(tres.parse("billing=5,cpu=2,mem=24G,node=1"),
+                         { 'billing': 5, 'cpu': 2, 'mem': 24576, 'node': 1 })
+        self.assertEqual(tres.parse("cpu=96,mem=500M,energy=1234,gres/gpu=4,gres/gpu:a100=4"),
+                         { 'cpu': 96, 'mem': 500, 'energy': 1234, 'gres/gpu': 4, 'gres/gpu:a100': 4 })
+        self.assertEqual(tres.parse("cpu=1,mem=1.50T,fs/disk=512K,billing=2K"),
+                         { 'cpu': 1, 'mem': 1572864, 'fs/disk': 1, 'billing': 2048 })
+        # sizes are rounded up to whole MiB
+        self.assertEqual(tres.parse("mem=1.1G,vmem=0.5,fs/disk=1536K"), { 'mem': 1127, 'vmem': 1, 'fs/disk': 2 })
+        self.assertEqual(tres.parse("mem=4096"), { 'mem': 4096 })
+        self.assertEqual(tres.parse("96"), { 'cpu': 96 })
+        self.assertEqual(tres.parse(""), {})
+
+    def test_parse_order(self):
+        self.assertEqual(list(tres.parse("node=1,cpu=2,gres/gpu=1")), [ 'node', 'cpu', 'gres/gpu' ])
+
+    def test_parse_cached(self):
+        self.assertIs(tres.parse("billing=5,cpu=2,mem=24G,node=1"), tres.parse("billing=5,cpu=2,mem=24G,node=1"))
+
+    def test_alloc_res(self):
+        u = usagerecord.UsageRecord()
+        u.record_id = "host:1"
+        u.alloc_res = tres.parse("cpu=2,mem=1G,gres/gpu=1")
+        resources = [ (e.get(ur.RESOURCE_TYPE), e.get(ur.RESOURCE_AMOUNT))
+                      for e in u.generateTree().getroot().findall(ur.ALLOC_RESOURCE.text) ]
+        self.assertEqual(resources, [ ('cpu', '2'), ('mem', '1024'), ('gres/gpu', '1') ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import re
+import random
+import unittest
+
+import sys
+sys.path.append("..")
+
+from bart.usagerecord import usagerecord
+from bart.usagerecord.usagerecord import UsageRecord, VOInformation, UsageRecordBatch
+
+try:
+    from xml.etree import ElementTree as ET
+except ImportError:
+    from elementtree import ElementTree as ET
+
+CREATE_TIME = re.compile(b'createTime="[^"]*"')
+
+TEXTS = [ 'plain', '', 'a & b', '<tag>', 'quote " and \'', 'tab\tnew\nline\r', u'räksmörgås', u'☃' ]
+
+def treeXML(ur):
+    return usagerecord.XML_HEADER + ET.tostring(ur.generateTree().getroot(), encoding='utf-8')
+
+def randomUsageRecord(rnd):
+    def maybe(value):
+        return value if rnd.random() < 0.7 else None
+
+    ur = UsageRecord()
+    ur.record_id        = rnd.choice(TEXTS) + 'host:1234'
+    ur.global_job_id    = maybe(rnd.choice(TEXTS))
+    ur.local_job_id     = maybe('1234')
+    ur.local_user_id    = maybe(rnd.choice(TEXTS))
+    ur.global_user_name = maybe(rnd.choice(TEXTS))
+    ur.job_name         = maybe(rnd.choice(TEXTS))
+    ur.charge           = maybe(rnd.randint(0, 100))
+    ur.status           = maybe('completed')
+    ur.machine_name     = maybe('host.example.org')
+    ur.queue            = maybe(rnd.choice(TEXTS))
+    ur.host             = maybe('n[001-128]')
+    ur.node_count       = maybe(rnd.randint(1, 128))
+    ur.processors       = maybe(rnd.randint(1, 4096))
+    ur.gpus             = maybe(rnd.randint(0, 8))
+    ur.memory           = maybe(rnd.choice([ rnd.randint(0, 10**8), '' ]))
+    if rnd.random() < 0.5:
+        ur.alloc_res = { 'cpu': 2, 'mem': 24576, rnd.choice([ 'gres/gpu', 'billing' ]): 5, rnd.choice(TEXTS): rnd.choice(TEXTS) }
+    ur.submit_time      = maybe('2012-06-12T17:37:43Z')
+    ur.start_time       = maybe('2012-06-13T00:41:03Z')
+    ur.end_time         = maybe('2012-06-18T00:41:29Z')
+    ur.project_name     = maybe(rnd.choice(TEXTS))
+    ur.submit_host      = maybe(rnd.choice(TEXTS))
+    ur.wall_duration    = maybe(rnd.randint(0, 10**6))
+    ur.cpu_duration     = maybe(rnd.random() * 10**6)
+    ur.user_time        = maybe(rnd.random() * 10**6)
+    ur.kernel_time      = maybe(rnd.random() * 10**3)
+    ur.exit_code        = maybe(rnd.choice([ 0, '1', '' ]))
+    ur.major_page_faults = maybe(rnd.randint(0, 100))
+    ur.runtime_environments = rnd.sample(TEXTS, rnd.randint(0, 2))
+    for _ in range(rnd.randint(0, 2)):
+        voi = VOInformation(name=rnd.choice(TEXTS), type_=maybe(rnd.choice(TEXTS)), issuer=maybe(rnd.choice(TEXTS)))
+        voi.attributes = [ (rnd.choice(TEXTS), maybe('role'), maybe(rnd.choice(TEXTS))) for _ in range(rnd.randint(0, 2)) ]
+        ur.vo_info.append(voi)
+    return ur
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def assertSameXML(self, ur):
+        # the create time is taken when serializing
+        self.assertEqual(CREATE_TIME.sub(b'', ur.toXML()), CREATE_TIME.sub(b'', treeXML(ur)))
+
+    def test_toXML_minimal(self):
+        ur = UsageRecord()
+        ur.record_id = 'host:1234'
+        self.assertSameXML(ur)
+        self.assertRaises(AssertionError, UsageRecord().toXML)
+
+    def test_toXML_random(self):
+        rnd = random.Random(42)
+        for _ in range(2000):
+            self.assertSameXML(randomUsageRecord(rnd))
+
+    def test_toXML_parses(self):
+        ur = randomUsageRecord(random.Random(7))
+        ur.job_name = 'a & <b>'
+        root = ET.fromstring(ur.toXML())
+        self.assertEqual(root.find(usagerecord.ur.JOB_NAME.text).text, 'a & <b>')
+
+    def test_slots(self):
+        ur = UsageRecord()
+        self.assertFalse(hasattr(ur, '__dict__'))
+        self.assertFalse(hasattr(VOInformation(), '__dict__'))
+        self.assertRaises(AttributeError, setattr, VOInformation(), 'type', 'bart-vomap')
+        self.assertEqual(ur.logger_name, usagerecord.ur.LOGGER_NAME)
+
+    def test_UsageRecordBatch(self):
+        rnd = random.Random(42)
+        records = [ randomUsageRecord(rnd) for _ in range(500) ]
+        batch = UsageRecordBatch(records)
+        self.assertEqual(len(batch), 500)
+        self.assertEqual(batch.recordIds(), [ ur.record_id for ur in records ])
+        self.assertEqual(batch[-1].record_id, records[-1].record_id)
+        self.assertRaises(IndexError, batch.__getitem__, 500)
+
+        documents = batch.toXML()
+        self.assertEqual(len(set( CREATE_TIME.search(document).group() for document in documents )), 1)
+        for ur, copy, document in zip(records, batch, documents):
+            for field in UsageRecord.__slots__:
+                if field != 'vo_info':
+                    self.assertEqual(getattr(copy, field), getattr(ur, field), field)
+            self.assertEqual(CREATE_TIME.sub(b'', document), CREATE_TIME.sub(b'', treeXML(ur)))
+
+    def test_UsageRecordBatch_columns(self):
+        batch = UsageRecordBatch()
+        for i in range(3):
+            ur = UsageRecord()
+            ur.record_id = 'host:%d' % i
+            ur.local_user_id = ''.join([ 'us', 'er' ])
+            ur.wall_duration = i
+            ur.cpu_duration = 2**70 if i == 2 else i
+            ur.processors = 1 if i == 0 else 1.5
+            ur.vo_info = [ VOInformation(name='proj') ]
+            batch.append(ur)
+
+        self.assertFalse('job_name' in batch.columns, "Empty column stored")
+        self.assertEqual(batch.columns['wall_duration'].typecode, 'q')
+        self.assertEqual(batch.columns['cpu_duration'], [ 0, 1, 2**70 ])
+        self.assertEqual(batch.columns['processors'], [ 1, 1.5, 1.5 ])
+        self.assertTrue(batch.columns['local_user_id'][0] is batch.columns['local_user_id'][2])
+        self.assertTrue(batch.columns['vo_info'][0] is batch.columns['vo_info'][1])
+        self.assertEqual(batch[1].vo_info[0].name, 'proj')
+
+if __name__ == '__main__':
+    unittest.main()